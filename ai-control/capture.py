@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Native screen capture through msc_x64.dll (dxgi-screen-capture) without per-frame allocations.
+On Linux the fake library from dxgi-screen-capture/fake-msc stands in for the DLL. MssCapture is
+the fallback over mss for machines where the native capture fails (Optimus laptops).
+
+Usage:
+    capture.py (bench) [--frames=<n>] [--library=<path>]
+
+Options:
+    --frames=<n>      Frames to capture [default: 500]
+    --library=<path>  Capture library, defaults to msc_x64.dll on Windows and the fake library elsewhere
+"""
+import os
+from time import monotonic, perf_counter, sleep
+
+import numpy as np
+from cffi import FFI
+
+import instrument
+import preprocess
+
+# 0x887A0027 as the signed int capture_frame() returns, no new frame since the last capture
+DXGI_ERROR_WAIT_TIMEOUT = 0x887A0027 - (1 << 32)
+FIRST_FRAME_TIMEOUT = 30.0  # Seconds a static screen may hold back the first frame
+FIRST_FRAME_RETRY = 0.005
+
+FAKE_LIBRARY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'dxgi-screen-capture', 'fake-msc',
+                            'libmsc_fake.so')
+
+CDEF = '''
+    int init(unsigned int output_skip);
+    void close();
+    int get_capture_width();
+    int get_capture_height();
+    int get_bytes_per_pixel();
+    int capture_frame(uint8_t* buffer);
+    const char* get_last_error();
+'''
+
+
+def default_library():
+    return os.environ.get('MSC_LIBRARY') or ('msc_x64.dll' if os.name == 'nt' else FAKE_LIBRARY)
+
+def aligned_empty(shape, dtype=np.uint8, align=64):
+    """np.empty whose data starts at an align byte boundary"""
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + align, np.uint8)
+    offset = (-raw.ctypes.data) % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureFinished(Exception):
+    """Raised by grab() of a capture that replays a recording once it has shown every frame"""
+
+
+class NativeCapture:
+    """
+    Capture session over the msc library. Geometry is queried once in init() and frames are captured
+    into a small pool of preallocated, aligned buffers. grab() returns a HxWx4 BGRX view into the pool
+    that stays valid for pool_size - 1 further grabs, copy or convert() it before that.
+    convert() runs the preprocess stages, or a plain resize to size (width, height).
+    Until the first frame arrives grab() retries timeouts for up to first_frame_timeout seconds.
+    """
+    def __init__(self, library=None, pool_size=3, output_skip=0, size=None, stages=None,
+                 first_frame_timeout=FIRST_FRAME_TIMEOUT):
+        self.ffi = FFI()
+        self.ffi.cdef(CDEF)
+        self.msc = self.ffi.dlopen(library or default_library())
+        self.pool_size = pool_size
+        self.output_skip = output_skip
+        self.stages = stages if stages is not None else [preprocess.Preprocess(size=size)]
+        self.first_frame_timeout = first_frame_timeout
+        self.frames = 0
+        self.timeouts = 0
+        self.previous = None
+
+    def init(self):
+        result = self.msc.init(self.output_skip)
+        if result < 0:
+            raise CaptureError(self.last_error())
+        self.width = self.msc.get_capture_width()
+        self.height = self.msc.get_capture_height()
+        self.bytes_per_pixel = self.msc.get_bytes_per_pixel()
+        if self.bytes_per_pixel != 4:
+            raise CaptureError('Expected 32-bit BGRX pixels, got %d bytes per pixel' % self.bytes_per_pixel)
+        shape = (self.height, self.width, self.bytes_per_pixel)
+        self._pool = [aligned_empty(shape) for _ in range(self.pool_size)]
+        self._pointers = [self.ffi.cast('uint8_t *', buffer.ctypes.data) for buffer in self._pool]
+        self._next = 0
+        self.convert = preprocess.compile(shape, self.stages, preprocess.BGRX)
+        self.shape = self.convert.shape
+        self.dtype = self.convert.dtype
+        return self
+
+    def last_error(self):
+        return self.ffi.string(self.msc.get_last_error()).decode(errors='replace')
+
+    def grab(self):
+        """Newest frame, or the previous one again if the screen has not changed since"""
+        with instrument.span('capture/grab'):
+            result = self.msc.capture_frame(self._pointers[self._next])
+        if result == DXGI_ERROR_WAIT_TIMEOUT:
+            self.timeouts += 1
+            if self.previous is not None:
+                return self.previous
+            result = self._first_frame()
+        if result < 0:
+            raise CaptureError(self.last_error())
+        self.previous = self._pool[self._next]
+        self._next = (self._next + 1) % self.pool_size
+        self.frames += 1
+        return self.previous
+
+    def _first_frame(self):
+        """Retry a timed out first capture, a static screen presents nothing new until it changes"""
+        deadline = monotonic() + self.first_frame_timeout
+        while True:
+            with instrument.span('capture/grab'):
+                result = self.msc.capture_frame(self._pointers[self._next])
+            if result != DXGI_ERROR_WAIT_TIMEOUT:
+                return result
+            self.timeouts += 1
+            if monotonic() >= deadline:
+                raise CaptureError('No frame captured in %g s' % self.first_frame_timeout)
+            sleep(FIRST_FRAME_RETRY)
+
+    def grab_rgb(self, out=None):
+        frame = self.grab()
+        with instrument.span('capture/convert'):
+            return self.convert(frame, out)
+
+    def close(self):
+        self.msc.close()
+
+
+class MssCapture:
+    """
+    Capture session over mss with the interface of NativeCapture. mss grabs only the screen region of
+    the first stage, the whole first monitor without one, so the stages are compiled without it.
+    Every grab is a new frame, mss cannot tell whether the screen changed.
+    """
+    def __init__(self, stages=None, size=None, monitor=1):
+        self.stages = stages if stages is not None else [preprocess.Preprocess(size=size)]
+        self.monitor = monitor
+        self.frames = 0
+        self.timeouts = 0
+        self.previous = None
+
+    def init(self):
+        from mss import mss
+        self.sct = mss()
+        region = self.stages[0].region
+        if region:
+            self.bbox = dict(zip(('left', 'top', 'width', 'height'), region))
+        else:
+            self.bbox = dict(self.sct.monitors[self.monitor])
+        self.width = self.bbox['width']
+        self.height = self.bbox['height']
+        self.convert = preprocess.compile((self.height, self.width, 4),
+                                          [self.stages[0].without_region()] + list(self.stages[1:]), preprocess.BGRX)
+        self.shape = self.convert.shape
+        self.dtype = self.convert.dtype
+        return self
+
+    def grab(self):
+        with instrument.span('capture/grab'):
+            image = self.sct.grab(self.bbox)
+        self.previous = np.frombuffer(image.raw, np.uint8).reshape(self.height, self.width, 4)
+        self.frames += 1
+        return self.previous
+
+    def grab_rgb(self, out=None):
+        frame = self.grab()
+        with instrument.span('capture/convert'):
+            return self.convert(frame, out)
+
+    def close(self):
+        self.sct.close()
+
+
+def open_session(stages, native=True):
+    """Initialised NativeCapture for stages, or MssCapture when native is off or the native capture fails"""
+    if native:
+        try:
+            return NativeCapture(stages=stages).init()
+        except (CaptureError, OSError) as e:
+            print('Native capture failed (%s), capturing with mss' % e)
+    return MssCapture(stages).init()
+
+
+def bench(frames=500, library=None):
+    session = NativeCapture(library).init()
+    out = np.empty(session.shape, session.dtype)
+    small = preprocess.compile((session.height, session.width, 4), preprocess.Preprocess(size=(240, 168)),
+                               preprocess.BGRX)
+    small_out = np.empty(small.shape, np.uint8)
+    timings = {'grab': 0.0, 'convert': 0.0, 'downscale': 0.0}
+    for _ in range(frames):
+        start = perf_counter()
+        frame = session.grab()
+        grabbed = perf_counter()
+        session.convert(frame, out)
+        converted = perf_counter()
+        small(frame, small_out)
+        timings['grab'] += grabbed - start
+        timings['convert'] += converted - grabbed
+        timings['downscale'] += perf_counter() - converted
+    session.close()
+    print('%dx%d, %d frames, %d timeouts' % (session.width, session.height, session.frames, session.timeouts))
+    for stage, total in timings.items():
+        print('%-10s %8.3f ms/frame' % (stage, total / frames * 1000))
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    if args['bench']:
+        bench(int(args['--frames']), args['--library'])
@@ -1,7 +1,15 @@
 import ctypes
-import time
+import threading
+from time import monotonic, sleep
+
+import numpy as np
 from sdl2 import *
 
+import history
+
+SAMPLE_RATE_HZ = 250
+HISTORY_SIZE = 2048  # Samples kept, 8 s at the default rate
+
 class Joystick:
     def __init__(self):
         SDL_Init(SDL_INIT_JOYSTICK)
@@ -16,15 +24,119 @@ class Joystick:
             elif event.type == SDL_JOYAXISMOTION:
                 self.axis[event.jaxis.axis] = event.jaxis.value
 
-joystick = Joystick()
-        
-def getXZ():
-    joystick.update()
-    leftMushroomX = joystick.axis.get(0)
-    leftMushroomX = 0 if leftMushroomX is None else leftMushroomX / 32768
-    rightTrigger = joystick.axis.get(5)
-    rightTrigger = 0 if rightTrigger is None else (rightTrigger + 32767) / 65536
-    leftTrigger = joystick.axis.get(2)
-    leftTrigger = 0 if leftTrigger is None else (leftTrigger + 32767) / 65536
-    return round(leftMushroomX, 2), round(rightTrigger, 2), round(leftTrigger, 2)
+    def values(self):
+        """(steering -1 - 1, throttle 0 - 1, brake 0 - 1), unrounded"""
+        leftMushroomX = self.axis.get(0)
+        leftMushroomX = 0 if leftMushroomX is None else leftMushroomX / 32768
+        rightTrigger = self.axis.get(5)
+        rightTrigger = 0 if rightTrigger is None else (rightTrigger + 32767) / 65536
+        leftTrigger = self.axis.get(2)
+        leftTrigger = 0 if leftTrigger is None else (leftTrigger + 32767) / 65536
+        return leftMushroomX, rightTrigger, leftTrigger
+
+
+class Sampler(threading.Thread):
+    """
+    Polls SDL on its own thread at rate_hz and keeps (monotonic time, steering, throttle, brake) samples
+    in a ring buffer, so controls can be looked up at the time a frame was captured instead of whenever
+    the caller's loop runs. Paced with sleep() alone, SDL raises the Windows timer resolution to 1 ms.
+    """
+    def __init__(self, rate_hz=SAMPLE_RATE_HZ, history_size=HISTORY_SIZE):
+        super().__init__(daemon=True)
+        self.period = 1.0 / rate_hz
+        self.error = None
+        self._samples = history.RingHistory(history_size, (4,), np.float64)
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+        self._running = False
+
+    def start(self):
+        self._running = True
+        super().start()
+        self._started.wait()  # SDL is opened on the sampler thread
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def stop(self):
+        self._running = False
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        try:
+            joystick = Joystick()
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self._started.set()
+        deadline = monotonic()
+        while self._running:
+            joystick.update()
+            now = monotonic()
+            steering, throttle, brake = joystick.values()
+            with self._lock:
+                self._samples.push((now, steering, throttle, brake))
+            deadline += self.period
+            if deadline < now:
+                deadline = now  # Fell behind, start over instead of polling back to back
+            sleep(max(0.0, deadline - monotonic()))
 
+    @property
+    def count(self):
+        return self._samples.count
+
+    def latest(self):
+        return self.at(float('inf'))
+
+    def since(self, count):
+        """(count, (time, steering, throttle, brake) rows) sampled after the first count, as far as the ring reaches"""
+        with self._lock:
+            new = min(self._samples.count - count, self._samples.depth)
+            rows = self._samples.window()[self._samples.depth - new:].copy() if new > 0 else np.empty((0, 4))
+            return self._samples.count, rows
+
+    def at(self, timestamp, interpolate=True):
+        """
+        (steering, throttle, brake) at a monotonic timestamp, linearly interpolated between the samples
+        around it, or the last sample before it when not interpolating. Times past the newest sample
+        get the newest values, before the oldest the oldest.
+        """
+        with self._lock:
+            n = min(self._samples.count, self._samples.depth)
+            if n == 0:
+                return 0.0, 0.0, 0.0
+            samples = self._samples.window()[-n:]
+            i = int(np.searchsorted(samples[:, 0], timestamp, side='right'))
+            if i == 0:
+                values = samples[0, 1:]
+            elif i == n or not interpolate:
+                values = samples[i - 1, 1:]
+            else:
+                before, after = samples[i - 1], samples[i]
+                weight = (timestamp - before[0]) / (after[0] - before[0])
+                values = before[1:] + (after[1:] - before[1:]) * weight
+        return tuple(float(value) for value in values)
+
+
+joystick = None
+sampler = None
+
+def start(**kwargs):
+    """Start the shared sampler, further calls return the running one"""
+    global sampler
+    if sampler is None:
+        sampler = Sampler(**kwargs).start()
+    return sampler
+
+def getXZ(digits=2):
+    """Current controls read on the calling thread, rounded to digits unless None"""
+    global joystick
+    if joystick is None:
+        joystick = Joystick()
+    joystick.update()
+    values = joystick.values()
+    if digits is None:
+        return values
+    return tuple(round(value, digits) for value in values)
@@ -1,61 +1,197 @@
-import collections
-import errno
-import json
+#!/usr/bin/env python3
+"""
+History windows (previous frames, angles and throttles) for every record of a tub.
+
+Instead of rewriting every record with its history, each tub gets one compact index of its
+ordered record ids and control columns, taken from the tub's manifest. Windows are read-only
+NumPy stride views over those columns, so manage.py builds them lazily per batch. The drive loop
+keeps the same windows in RingHistory buffers, the depths come from IMAGE_HISTORY_WINDOW and
+SENSOR_HISTORY_WINDOW in car-beamng/config.py for both.
+
+Usage:
+    history.py (build) <tub>... [--workers=<n>] [--full] [--image_window=<n>] [--sensor_window=<n>]
+
+Options:
+    --workers=<n>          Tubs indexed in parallel [default: 4]
+    --full                 Rebuild instead of indexing only records added since the last run
+    --image_window=<n>     Previous frames per record [default: 1]
+    --sensor_window=<n>    Previous angles and throttles per record [default: 10]
+"""
+import glob
 import os
-import re
+from multiprocessing import Pool
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+import manifest
+import tubfile
 
+# Default window depths
 IMAGE_HISTORY_WINDOW = 1
 SENSOR_HISTORY_WINDOW = 10
 
-IMG_KEY = 'cam/image_array'
 THROTTLE_KEY = 'user/throttle'
 ANGLE_KEY = 'user/angle'
 
-basePath = './log/log_joku/'
-# basePath = './log_small/'
-resultPath = basePath + 'output/'
-entries = [pos_json for pos_json in os.listdir(basePath) if (pos_json.endswith('.json') and pos_json != 'meta.json')]
-
-# Sort files by the number in name, btw no error handling
-entries = ((int(re.search('.+_(\d+).json', path).group(1)), path) for path in entries)
-
-img_buffer = collections.deque(maxlen=IMAGE_HISTORY_WINDOW)
-throttle_buffer = collections.deque(maxlen=SENSOR_HISTORY_WINDOW)
-angle_buffer = collections.deque(maxlen=SENSOR_HISTORY_WINDOW)
-
-if not os.path.exists(os.path.dirname(resultPath)):
-    try:
-        os.makedirs(os.path.dirname(resultPath))
-    except OSError as exc:  # Guard against race condition
-        if exc.errno != errno.EEXIST:
-            raise
-
-
-
-for cdate, file in sorted(entries):
-    with open(basePath + file, 'r+') as f:
-        data = json.load(f)
-        aImg = data.get(IMG_KEY)
-        aThrottle = data.get(THROTTLE_KEY)
-        aAngle = data.get(ANGLE_KEY)
-        if (len(img_buffer) < IMAGE_HISTORY_WINDOW or
-                len(throttle_buffer) < SENSOR_HISTORY_WINDOW):
-            print('Filling buffer')
-        else:
-            imgPath = basePath + data.get('cam/image_array')
-            data['cam/prev_images'] = list(img_buffer)
-            data['history/angle'] = list(angle_buffer)
-            data['history/throttle'] = list(throttle_buffer)
-            with open(resultPath + file, 'w') as outfile:
-                json.dump(data, outfile)
-
-        img_buffer.append(aImg)
-        throttle_buffer.append(aThrottle)
-        angle_buffer.append(aAngle)
-
-with open(basePath + 'meta.json', 'r+') as f:
-    data = json.load(f)
-    data['inputs'].extend(['cam/prev_images', 'history/angle', 'history/throttle'])
-    data['types'].extend(['custom/prev_image', 'custom/angle_array', 'custom/throttle_array'])
-    with open(resultPath + 'meta.json', 'w') as outfile:
-        json.dump(data, outfile)
+# Inputs served from the index, as history.py used to add them to meta.json
+HISTORY_INPUTS = ['cam/prev_images', 'history/angle', 'history/throttle']
+HISTORY_TYPES = ['custom/prev_image', 'custom/angle_array', 'custom/throttle_array']
+
+INDEX_FILE = os.path.join(manifest.INDEX_DIR, 'history.npz')
+RECORD_NAME = manifest.RECORD_NAME
+IMAGE_NAME = 'shot_%d.png'
+
+
+def sliding_windows(values, length):
+    """Read-only (n - length + 1, length) view of values, row j is values[j:j + length]. Nothing is copied"""
+    n = max(len(values) - length + 1, 0)
+    stride = values.strides[0]
+    return as_strided(values, shape=(n, length), strides=(stride, stride), writeable=False)
+
+
+def prev_images_input(frames):
+    """prev_images model input of an image window, a single image while the window is one frame deep"""
+    return frames[0] if len(frames) == 1 else np.asarray(frames)
+
+
+class RingHistory:
+    """
+    The last depth values of one input, for the drive loop. Every value is written twice, at p and
+    p + depth, so the window in order oldest to newest is always one contiguous slice and nothing is
+    allocated per frame. window() is a view, it changes with the next push().
+    """
+    def __init__(self, depth, shape=(), dtype=np.float32, fill=0):
+        self.depth = depth
+        self.count = 0
+        self._buffer = np.full((2 * depth,) + tuple(shape), fill, dtype)
+
+    def push(self, value):
+        self._buffer[self.count % self.depth] = value
+        self.commit()
+
+    def slot(self):
+        """Writable view of the next array value, to fill in place before commit()"""
+        return self._buffer[self.count % self.depth]
+
+    def commit(self):
+        position = self.count % self.depth
+        self._buffer[position + self.depth] = self._buffer[position]
+        self.count += 1
+
+    def window(self):
+        position = self.count % self.depth
+        return self._buffer[position:position + self.depth]
+
+    def full(self):
+        return self.count >= self.depth
+
+
+class HistoryIndex:
+    """
+    Ordered record ids and control columns of a tub. Position p has full history when p >= first,
+    its windows are the image_window frame ids and sensor_window values just before it. frames holds
+    the id of the record whose frame each record shows, records recorded as duplicates share one.
+    """
+    def __init__(self, ids, angle, throttle, image_window=IMAGE_HISTORY_WINDOW, sensor_window=SENSOR_HISTORY_WINDOW,
+                 frames=None):
+        self.ids = np.ascontiguousarray(ids, np.int64)
+        self.frames = np.ascontiguousarray(frames if frames is not None else ids, np.int64)
+        self.angle = np.ascontiguousarray(angle, np.float32)
+        self.throttle = np.ascontiguousarray(throttle, np.float32)
+        self.image_window = image_window
+        self.sensor_window = sensor_window
+        self.first = max(image_window, sensor_window)
+        self._image_windows = sliding_windows(self.frames, image_window)
+        self._angle_windows = sliding_windows(self.angle, sensor_window)
+        self._throttle_windows = sliding_windows(self.throttle, sensor_window)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self):
+        """Positions with a full history window"""
+        return np.arange(self.first, len(self.ids))
+
+    def window(self, position):
+        """History inputs of one record, as the old per-record JSON files had them"""
+        return {
+            'cam/prev_images': self._image_windows[position - self.image_window].tolist(),
+            'history/angle': self._angle_windows[position - self.sensor_window],
+            'history/throttle': self._throttle_windows[position - self.sensor_window],
+        }
+
+    def batch(self, positions):
+        """History inputs of many records at once, one gather per input"""
+        positions = np.asarray(positions)
+        return {
+            'cam/prev_images': self._image_windows[positions - self.image_window],
+            'history/angle': self._angle_windows[positions - self.sensor_window],
+            'history/throttle': self._throttle_windows[positions - self.sensor_window],
+        }
+
+    def save(self, tub_path):
+        path = os.path.join(tub_path, INDEX_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, ids=self.ids, frames=self.frames, angle=self.angle, throttle=self.throttle,
+                 windows=np.array([self.image_window, self.sensor_window]))
+        os.replace(temp_path, path)
+
+
+def read_index(tub_path):
+    path = os.path.join(tub_path, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        image_window, sensor_window = data['windows']
+        frames = data['frames'] if 'frames' in data else None
+        return HistoryIndex(data['ids'], data['angle'], data['throttle'], int(image_window), int(sensor_window),
+                            frames)
+
+def index_from_manifest(records, image_window=IMAGE_HISTORY_WINDOW, sensor_window=SENSOR_HISTORY_WINDOW):
+    return HistoryIndex(records[manifest.ID_FIELD], records[ANGLE_KEY], records[THROTTLE_KEY],
+                        image_window, sensor_window, records[manifest.FRAME_FIELD])
+
+def build_index(tub_path, incremental=True, image_window=IMAGE_HISTORY_WINDOW, sensor_window=SENSOR_HISTORY_WINDOW):
+    """
+    Index a tub from its manifest and save it. Incrementally only records added since the manifest
+    was last built are read, tubs only ever grow at the end while recording.
+    """
+    if incremental or tubfile.is_tubfile(tub_path):
+        records = manifest.load(tub_path)
+    else:
+        records = manifest.build(tub_path, incremental=False)
+    index = index_from_manifest(records, image_window, sensor_window)
+    index.save(tub_path)
+    return index
+
+def load_index(tub_path, image_window=IMAGE_HISTORY_WINDOW, sensor_window=SENSOR_HISTORY_WINDOW):
+    """Saved index of a tub, (re)built first if missing, for other windows or behind the manifest"""
+    index = read_index(tub_path)
+    records = manifest.load(tub_path)
+    if index is None or (index.image_window, index.sensor_window) != (image_window, sensor_window) \
+            or not np.array_equal(index.ids, records[manifest.ID_FIELD]) \
+            or not np.array_equal(index.frames, records[manifest.FRAME_FIELD]):
+        index = index_from_manifest(records, image_window, sensor_window)
+        index.save(tub_path)
+    return index
+
+def _build(args):
+    index = build_index(*args)
+    return args[0], len(index)
+
+def build_all(tub_paths, workers=4, incremental=True, image_window=IMAGE_HISTORY_WINDOW,
+              sensor_window=SENSOR_HISTORY_WINDOW):
+    jobs = [(path, incremental, image_window, sensor_window) for path in tub_paths]
+    with Pool(workers) as pool:
+        for tub_path, count in pool.imap_unordered(_build, jobs):
+            print('Indexed', count, 'records of', tub_path)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    tubs = [path for pattern in args['<tub>'] for path in sorted(glob.glob(pattern))]
+    build_all(tubs, int(args['--workers']), not args['--full'], int(args['--image_window']),
+              int(args['--sensor_window']))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing of the recorder, trainer and drive loop: rolling histograms and a Chrome trace.
+
+Code marks its stages with
+
+    with instrument.span('encode'):
+        ...
+
+or calls instrument.add(name, seconds) for durations it measured itself. Until configure() is called
+both return after one flag check. Once configured every duration goes into an HDR style histogram of
+its stage, log-linear buckets exact below 128 us and within 1.6% above, up to days. An exporter
+thread appends the histograms of the last interval and of the whole run as one JSON line every
+interval seconds, and the spans as events of a Chrome trace that chrome://tracing and Perfetto
+open, also after a crash since the closing bracket of the trace is optional.
+
+Usage:
+    instrument.py (report) <jsonl>
+"""
+import json
+import os
+import threading
+import time
+from time import perf_counter
+
+import numpy as np
+
+SUB_BITS = 7
+SUB_BUCKETS = 1 << SUB_BITS  # Microseconds below are counted exactly
+HALF = SUB_BUCKETS // 2
+MAX_BITS = 42  # 50 days in microseconds, longer durations land in the last bucket
+BUCKETS = (MAX_BITS - SUB_BITS + 2) * HALF
+PERCENTILES = (50, 90, 99, 99.9)
+
+EXPORT_INTERVAL = 5.0
+TRACE_LIMIT = 200000  # Trace events kept per export interval, more are counted as dropped
+
+
+def bucket(micros):
+    """Histogram bucket of a duration in whole microseconds"""
+    if micros < SUB_BUCKETS:
+        return micros if micros > 0 else 0
+    shift = micros.bit_length() - SUB_BITS
+    return min(shift * HALF + (micros >> shift), BUCKETS - 1)
+
+def bucket_values():
+    """Microseconds every bucket stands for, the middle of its range"""
+    index = np.arange(BUCKETS)
+    shift = np.maximum(index // HALF - 1, 0)
+    mantissa = index - shift * HALF
+    return ((mantissa << shift) + ((mantissa + 1) << shift) - 1) / 2.0
+
+
+class Histogram:
+    """Durations of one stage, add() costs a few hundred nanoseconds"""
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bucket(int(seconds * 1e6))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def stats(self):
+        """Count, total seconds and mean, min, percentiles and max in milliseconds"""
+        result = {'count': self.count, 'total_sec': self.total}
+        if not self.count:
+            return result
+        cumulative = np.cumsum(self.counts)
+        ranks = np.maximum(np.ceil(np.array(PERCENTILES) / 100.0 * self.count), 1)
+        values = bucket_values()[np.searchsorted(cumulative, ranks)] / 1000.0
+        result['mean'] = self.total / self.count * 1000
+        result['min'] = self.min * 1000
+        for percentile, value in zip(PERCENTILES, values):
+            result['p%g' % percentile] = float(np.clip(value, self.min * 1000, self.max * 1000))
+        result['max'] = self.max * 1000
+        return result
+
+
+class Registry:
+    """Histograms of the current interval, trace events and the threads they ran on"""
+    def __init__(self, trace=True, trace_limit=TRACE_LIMIT):
+        self.trace = trace
+        self.trace_limit = trace_limit
+        self.origin = perf_counter()
+        self.window = {}
+        self.events = []
+        self.threads = {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, start=None):
+        with self._lock:
+            histogram = self.window.get(name)
+            if histogram is None:
+                histogram = self.window[name] = Histogram()
+            histogram.add(seconds)
+            if self.trace and start is not None:
+                if len(self.events) >= self.trace_limit:
+                    self.dropped += 1
+                    return
+                thread = threading.get_ident()
+                if thread not in self.threads:
+                    self.threads[thread] = threading.current_thread().name
+                self.events.append((name, start, seconds, thread))
+
+    def swap(self):
+        """(histograms, trace events) since the last swap"""
+        with self._lock:
+            window, self.window = self.window, {}
+            events, self.events = self.events, []
+        return window, events
+
+
+class Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = perf_counter()
+        registry = _registry
+        if registry is not None:
+            registry.add(self.name, end - self.start, self.start)
+
+
+class NullSpan:
+    """What span() returns while disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Exporter(threading.Thread):
+    """
+    Every interval seconds appends {time, elapsed, interval: {stage: stats}, all: {stage: stats}} to
+    <path>.jsonl and the new spans to <path>.trace.json
+    """
+    def __init__(self, registry, path, interval=EXPORT_INTERVAL):
+        super().__init__(daemon=True, name='instrument')
+        self.registry = registry
+        self.interval = interval
+        self.totals = {}
+        self.exported = registry.origin
+        self.lines = open(path + '.jsonl', 'a')
+        self.trace = open(path + '.trace.json', 'w') if registry.trace else None
+        self._named = set()
+        self._separator = '[\n'
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+        self.export()
+        self.lines.close()
+        if self.trace is not None:
+            self.trace.write(']\n' if self._separator == ',\n' else '[]\n')
+            self.trace.close()
+
+    def export(self):
+        with self._lock:
+            window, events = self.registry.swap()
+            for name, histogram in window.items():
+                if name not in self.totals:
+                    self.totals[name] = Histogram()
+                self.totals[name].merge(histogram)
+            now = perf_counter()
+            line = {'time': time.time(), 'elapsed': now - self.registry.origin, 'interval_sec': now - self.exported,
+                    'interval': {name: histogram.stats() for name, histogram in sorted(window.items())},
+                    'all': {name: histogram.stats() for name, histogram in sorted(self.totals.items())},
+                    'trace_dropped': self.registry.dropped}
+            self.exported = now
+            self.lines.write(json.dumps(line) + '\n')
+            self.lines.flush()
+            if self.trace is not None:
+                self._write_trace(events)
+
+    def totals_stats(self):
+        with self._lock:
+            return {name: histogram.stats() for name, histogram in self.totals.items()}
+
+    def _write_trace(self, events):
+        pid = os.getpid()
+        origin = self.registry.origin
+        entries = []
+        for thread, name in list(self.registry.threads.items()):
+            if thread not in self._named:
+                self._named.add(thread)
+                entries.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread, 'args': {'name': name}})
+        for name, start, seconds, thread in events:
+            entries.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': thread, 'ts': (start - origin) * 1e6,
+                            'dur': seconds * 1e6})
+        for entry in entries:
+            self.trace.write(self._separator + json.dumps(entry))
+            self._separator = ',\n'
+        self.trace.flush()
+
+
+enabled = False
+_registry = None
+_exporter = None
+
+def configure(directory, name, interval=EXPORT_INTERVAL, trace=True):
+    """
+    Start timing stages, exported to <directory>/<name>_<time>.jsonl and .trace.json. Returns the
+    path without extension.
+    """
+    global enabled, _registry, _exporter
+    close()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '%s_%d' % (name, time.time()))
+    _registry = Registry(trace)
+    _exporter = Exporter(_registry, path, interval)
+    _exporter.start()
+    enabled = True
+    return path
+
+def close():
+    """Export what is left and stop timing"""
+    global enabled, _registry, _exporter
+    enabled = False
+    if _exporter is not None:
+        _exporter.stop()
+    _registry = None
+    _exporter = None
+
+def span(name):
+    """Context manager timing its block as stage name"""
+    if not enabled:
+        return NULL_SPAN
+    return Span(name)
+
+def add(name, seconds, start=None):
+    """Add a duration measured elsewhere, traced when its perf_counter() start is given"""
+    if enabled:
+        registry = _registry
+        if registry is not None:
+            registry.add(name, seconds, start)
+
+def report():
+    """One line per stage of the whole run so far, the stages taking the most time first"""
+    if _exporter is None:
+        return 'instrumentation off'
+    _exporter.export()
+    return format_stages(_exporter.totals_stats())
+
+
+def format_stages(stages):
+    lines = []
+    for name, stats in sorted(stages.items(), key=lambda item: -item[1]['total_sec']):
+        if not stats['count']:
+            continue
+        lines.append('%-16s %8d x %8.2f s, mean %7.2f p50 %7.2f p99 %7.2f max %7.2f ms' % (
+            name, stats['count'], stats['total_sec'], stats['mean'], stats['p50'], stats['p99'], stats['max']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    with open(args['<jsonl>'], 'r') as f:
+        lines = [line for line in f if line.strip()]
+    if not lines:
+        print('No exports in', args['<jsonl>'])
+    else:
+        last = json.loads(lines[-1])
+        print('%.1f s, %d trace events dropped' % (last['elapsed'], last['trace_dropped']))
+        print(format_stages(last['all']))
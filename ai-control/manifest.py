@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Per-tub manifest: every scalar field of every record as one NumPy structured array.
+
+A PNG + JSON tub is scanned once and the manifest is saved in the tub's index directory. Later loads reuse
+it as long as the directory mtime and entry count are unchanged, and only parse the records added
+since otherwise. Tubfile tubs already store their scalars as columns, their manifest is built from
+those and not saved.
+
+Usage:
+    manifest.py (build) <tub>... [--full]
+    manifest.py (info) <tub>
+
+Options:
+    --full    Rescan every record instead of only the new ones
+"""
+import glob
+import json
+import os
+
+import numpy as np
+
+import tubfile
+
+# Generated files live in a subdirectory, saving them does not touch the tub directory's mtime
+INDEX_DIR = 'index'
+MANIFEST_FILE = os.path.join(INDEX_DIR, 'manifest.npz')
+VERSION = 2
+RECORD_NAME = 'record_%d.json'
+ID_FIELD = 'id'
+FRAME_FIELD = 'frame'  # Id of the record whose frame a record shows, its own unless recorded as a duplicate
+NAME_DTYPE = 'S32'  # Frame file names of image_array inputs
+
+
+def record_ids(tub_path, prefix='record_'):
+    """Sorted ids of the record_N.json files of a PNG + JSON tub, or of other <prefix>N.json files"""
+    ids = []
+    for name in os.listdir(tub_path):
+        if name.startswith(prefix) and name.endswith('.json'):
+            try:
+                ids.append(int(name[len(prefix):-5]))
+            except ValueError:
+                pass
+    return np.sort(np.array(ids, np.int64))
+
+def read_meta(tub_path):
+    with open(os.path.join(tub_path, 'meta.json'), 'r') as f:
+        return json.load(f)
+
+def manifest_dtype(meta):
+    """id and frame plus one field per scalar input, the image name for image_array inputs"""
+    fields = [(ID_FIELD, '<i8'), (FRAME_FIELD, '<i8')]
+    for key, type in zip(meta['inputs'], meta['types']):
+        if type == tubfile.IMAGE_TYPE:
+            fields.append((key, NAME_DTYPE))
+        elif type in tubfile.COLUMN_TYPES:
+            fields.append((key, tubfile.COLUMN_TYPES[type]))
+    return np.dtype(fields)
+
+def directory_state(tub_path):
+    # Adding or removing records updates both, rewriting a record in place does neither
+    return np.array([os.stat(tub_path).st_mtime_ns, len(os.listdir(tub_path))], np.int64)
+
+def frame_id(name, default):
+    """Id in a frame file name like shot_12.png"""
+    try:
+        return int(os.path.splitext(name)[0].rsplit('_', 1)[1])
+    except (IndexError, ValueError):
+        return default
+
+def scan(tub_path, ids, dtype, image_key=None, record_name=RECORD_NAME):
+    records = np.zeros(len(ids), dtype)
+    records[ID_FIELD] = ids
+    records[FRAME_FIELD] = ids
+    keys = dtype.names[2:]
+    for key in keys:
+        if dtype[key].kind == 'f':
+            records[key] = np.nan  # Missing values
+    for i, id in enumerate(ids):
+        with open(os.path.join(tub_path, record_name % id), 'r') as f:
+            data = json.load(f)
+        row = records[i]
+        for key in keys:
+            value = data.get(key)
+            if value is not None:
+                row[key] = value.encode() if dtype[key].kind == 'S' else value
+        if image_key is not None and image_key in data:
+            row[FRAME_FIELD] = frame_id(data[image_key], id)
+    return records
+
+def read(tub_path):
+    """Saved manifest and the directory state it was built at, None if there is none"""
+    path = os.path.join(tub_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None, None
+    with np.load(path) as data:
+        if int(data['version']) != VERSION:
+            return None, None
+        return data['records'], data['state']
+
+def save(tub_path, records, state):
+    path = os.path.join(tub_path, MANIFEST_FILE)
+    temp_path = path + '.tmp.npz'
+    np.savez(temp_path, records=records, state=state, version=np.array(VERSION))
+    os.replace(temp_path, path)
+
+def from_tubfile(tub_path):
+    reader = tubfile.Reader(tub_path)
+    columns = [(key, dtype) for key, dtype in reader.columns if key != tubfile.FRAME_REF]
+    dtype = np.dtype([(ID_FIELD, '<i8'), (FRAME_FIELD, '<i8')] + columns)
+    records = np.zeros(len(reader), dtype)
+    records[ID_FIELD] = np.arange(len(reader))
+    records[FRAME_FIELD] = reader.column(reader.frame_ref) if reader.frame_ref else np.arange(len(reader))
+    for key, _ in columns:
+        records[key] = reader.column(key)
+    reader.close()
+    return records
+
+def build(tub_path, incremental=True):
+    """Scan a PNG + JSON tub, reading only records newer than the saved manifest when incremental"""
+    meta = read_meta(tub_path)
+    dtype = manifest_dtype(meta)
+    image_keys = [key for key, type in zip(meta['inputs'], meta['types']) if type == tubfile.IMAGE_TYPE]
+    image_key = image_keys[0] if image_keys else None
+    os.makedirs(os.path.join(tub_path, INDEX_DIR), exist_ok=True)
+    state = directory_state(tub_path)
+    ids = record_ids(tub_path)
+    previous, _ = read(tub_path) if incremental else (None, None)
+    if previous is not None and previous.dtype == dtype and len(previous) <= len(ids) \
+            and np.array_equal(previous[ID_FIELD], ids[:len(previous)]):
+        records = np.concatenate([previous, scan(tub_path, ids[len(previous):], dtype, image_key)])
+    else:
+        records = scan(tub_path, ids, dtype, image_key)
+    save(tub_path, records, state)
+    return records
+
+def load(tub_path):
+    """Manifest of a tub, rebuilt (incrementally) first when the tub directory changed since"""
+    if tubfile.is_tubfile(tub_path):
+        return from_tubfile(tub_path)
+    records, state = read(tub_path)
+    if records is None or not np.array_equal(state, directory_state(tub_path)):
+        records = build(tub_path)
+    return records
+
+def record(records, position):
+    """One manifest row as a record dict, like the record_N.json it was read from"""
+    row = records[position]
+    result = {}
+    for key in records.dtype.names[2:]:
+        value = row[key]
+        result[key] = value.decode() if records.dtype[key].kind == 'S' else value.item()
+    return result
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    if args['build']:
+        for tub in [path for pattern in args['<tub>'] for path in sorted(glob.glob(pattern))]:
+            print('Scanned', len(build(tub, incremental=not args['--full'])), 'records of', tub)
+    elif args['info']:
+        records = load(args['<tub>'][0])
+        print(len(records), 'records')
+        for key in records.dtype.names:
+            print('%-20s %s' % (key, records.dtype[key]))
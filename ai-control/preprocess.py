@@ -0,0 +1,239 @@
+"""
+One preprocessing stage for recording, training and driving: crop, resize, colour conversion and normalisation.
+
+A Preprocess holds the parameters of a stage. The recorder stores its stage in the tub's meta.json,
+training stores the recording stage and the model's own stage in the model metadata, and the
+drive loop rebuilds both from there. compile() turns a chain of stages into a Pipeline for one
+source frame shape: the crops and nearest neighbour resizes of all stages fold into one gather,
+so a frame is never resized twice.
+"""
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+# Source pixel layouts
+RGB = 'rgb'
+BGRX = 'bgrx'  # Screen capture, 4 bytes per pixel
+SOURCE_CHANNELS = {RGB: [0, 1, 2], BGRX: [2, 1, 0]}
+
+# Output colours
+GRAY = 'gray'
+YUV = 'yuv'
+COLORS = (RGB, GRAY, YUV)
+# RGB -> colour matrices (BT.601, YUV with U and V around 128 like JPEG) and offsets
+COLOR_MATRICES = {
+    GRAY: (np.array([[0.299], [0.587], [0.114]], np.float32), np.zeros(1, np.float32)),
+    YUV: (np.array([[0.299, -0.168736, 0.5], [0.587, -0.331264, -0.418688], [0.114, 0.5, -0.081312]], np.float32),
+          np.array([0, 128, 128], np.float32)),
+}
+
+# Normalisations, None keeps uint8 pixels
+UNIT = 'unit'  # 0 - 1
+SIGNED = 'signed'  # -1 - 1
+NORMALIZATIONS = (None, UNIT, SIGNED)
+
+MODEL_META = '%s.meta.json'
+
+
+def nearest(count, size):
+    """Source indices of a nearest neighbour resize from count to size pixels"""
+    # Asked from PIL itself, its fixed point rounding differs from the exact scale for some sizes
+    indices = Image.fromarray(np.arange(count, dtype=np.int32)[None, :], 'I').resize((size, 1), Image.NEAREST)
+    return np.array(indices, np.intp)[0]
+
+
+class Preprocess:
+    """
+    crop: (top, bottom, left, right) pixels cut off first
+    size: (width, height) to resize to, like PIL, None keeps the size
+    color: rgb, gray or yuv
+    normalize: None for uint8 pixels, unit for 0 - 1 or signed for -1 - 1 float32
+    region: (left, top, width, height) of the screen the frames are taken from, before the crop. Only
+        for the recording stage, None takes the whole screen
+    """
+    def __init__(self, crop=(0, 0, 0, 0), size=None, color=RGB, normalize=None, region=None):
+        if color not in COLORS:
+            raise ValueError('Unknown colour %s, use one of %s' % (color, ', '.join(COLORS)))
+        if normalize not in NORMALIZATIONS:
+            raise ValueError('Unknown normalisation %s, use unit or signed' % normalize)
+        self.crop = tuple(int(value) for value in (crop or (0, 0, 0, 0)))
+        self.size = tuple(int(value) for value in size) if size else None
+        self.color = color
+        self.normalize = normalize
+        self.region = tuple(int(value) for value in region) if region else None
+
+    def __eq__(self, other):
+        return isinstance(other, Preprocess) and self.to_meta() == other.to_meta()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Preprocess(%s)' % ', '.join('%s=%r' % item for item in sorted(self.to_meta().items()))
+
+    def is_identity(self):
+        return self == Preprocess()
+
+    def to_meta(self):
+        return {'crop': list(self.crop), 'size': list(self.size) if self.size else None, 'color': self.color,
+                'normalize': self.normalize, 'region': list(self.region) if self.region else None}
+
+    @classmethod
+    def from_meta(cls, meta):
+        return cls(**meta) if meta is not None else None
+
+    def without_region(self):
+        """The stage for frames grabbed from its region already, like mss grabs them"""
+        meta = self.to_meta()
+        meta['region'] = None
+        return Preprocess.from_meta(meta)
+
+    def geometry(self, rows, cols):
+        """Region, crop and resize source row and column indices"""
+        if self.region:
+            left, top, width, height = self.region
+            if left + width > len(cols) or top + height > len(rows):
+                raise ValueError('Capture region %r does not fit a %dx%d screen' % (self.region, len(cols), len(rows)))
+            rows = rows[top:top + height]
+            cols = cols[left:left + width]
+        top, bottom, left, right = self.crop
+        rows = rows[top:len(rows) - bottom]
+        cols = cols[left:len(cols) - right]
+        if self.size:
+            width, height = self.size
+            rows = rows[nearest(len(rows), height)]
+            cols = cols[nearest(len(cols), width)]
+        return rows, cols
+
+
+def compile(source_shape, stages, source=RGB):
+    """
+    Pipeline running stages one after the other on frames of source_shape (height, width[, channels]).
+    Only the last stage may change colour or normalise, the earlier ones describe stored frames.
+    """
+    if isinstance(stages, Preprocess):
+        stages = [stages]
+    stages = [stage for stage in stages if stage is not None] or [Preprocess()]
+    for stage in stages[:-1]:
+        if stage.color != RGB or stage.normalize is not None:
+            raise ValueError('Only the last stage can convert colour or normalise, got %r' % stage)
+    rows = np.arange(source_shape[0])
+    cols = np.arange(source_shape[1])
+    for stage in stages:
+        rows, cols = stage.geometry(rows, cols)
+    return Pipeline(source_shape, rows, cols, source, stages[-1].color, stages[-1].normalize)
+
+
+class Pipeline:
+    """
+    A compiled chain of stages. Calling it converts one frame through preallocated buffers, without
+    allocations but not thread-safe. batch() converts any number of frames (..., H, W, C) at once.
+    """
+    def __init__(self, source_shape, rows, cols, source, color, normalize):
+        self.source_shape = tuple(source_shape)
+        self.rows = rows
+        self.cols = cols
+        self.channels = SOURCE_CHANNELS[source]
+        self.color = color
+        self.normalize = normalize
+        self.gather = not (np.array_equal(rows, np.arange(source_shape[0])) and
+                           np.array_equal(cols, np.arange(source_shape[1])))
+        self.dtype = np.dtype(np.uint8 if normalize is None else np.float32)
+        depth = 1 if color == GRAY else 3
+        self.shape = (len(rows), len(cols), depth)
+        self.convert = color != RGB or normalize is not None
+
+        source_depth = source_shape[2] if len(source_shape) > 2 else 3
+        self._rows = np.empty((len(rows), source_shape[1], source_depth), np.uint8)
+        self._pixels = np.empty((len(rows), len(cols), source_depth), np.uint8)
+        if self.convert:
+            self._float = np.empty((len(rows), len(cols), 3), np.float32)
+            self._color = np.empty(self.shape, np.float32)
+
+    def __call__(self, frame, out=None):
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+        if self.gather:
+            np.take(frame, self.rows, axis=0, out=self._rows)
+            np.take(self._rows, self.cols, axis=1, out=self._pixels)
+            frame = self._pixels
+        if not self.convert:
+            # Per channel copies are several times faster than one copy through a reversed channel view
+            for i, channel in enumerate(self.channels):
+                out[:, :, i] = frame[:, :, channel]
+            return out
+        for i, channel in enumerate(self.channels):
+            self._float[:, :, i] = frame[:, :, channel]
+        pixels = self._float
+        if self.color != RGB:
+            matrix, offset = COLOR_MATRICES[self.color]
+            np.dot(pixels, matrix, out=self._color)
+            self._color += offset
+            pixels = self._color
+        self._finish(pixels, out)
+        return out
+
+    def batch(self, frames, out=None):
+        frames = np.asarray(frames)
+        if self.gather:
+            frames = frames.take(self.rows, axis=-3).take(self.cols, axis=-2)
+        pixels = frames[..., self.channels]
+        if self.convert:
+            pixels = pixels.astype(np.float32)
+            if self.color != RGB:
+                matrix, offset = COLOR_MATRICES[self.color]
+                pixels = np.dot(pixels, matrix) + offset
+            if out is None:
+                out = np.empty(pixels.shape, self.dtype)
+            self._finish(pixels, out)
+            return out
+        if out is None:
+            return pixels
+        out[...] = pixels
+        return out
+
+    def _finish(self, pixels, out):
+        """Normalise float pixels in place into out"""
+        if self.normalize == UNIT:
+            np.multiply(pixels, 1 / 255.0, out=out)
+        elif self.normalize == SIGNED:
+            np.multiply(pixels, 1 / 127.5, out=out)
+            out -= 1
+        else:
+            np.clip(pixels, 0, 255, out=pixels)
+            pixels += 0.5
+            np.copyto(out, pixels, casting='unsafe')
+
+
+# record.py grabbed this screen region and resized it to 240x168 before tubs stored their stage
+LEGACY_REGION = (0, 72, 1280, 720)
+LEGACY_RECORD = Preprocess(size=(240, 168), region=LEGACY_REGION)
+
+
+def record_stage(stage_meta):
+    """
+    Recording stage saved in a tub or model meta. Stages saved before the region was stored are
+    given the region record.py grabbed with mss, its default capture.
+    """
+    if stage_meta is not None and 'region' not in stage_meta:
+        stage_meta = dict(stage_meta, region=LEGACY_REGION)
+    return Preprocess.from_meta(stage_meta)
+
+def tub_stage(meta):
+    """Stage the frames of a tub (its meta.json contents) were recorded with"""
+    return record_stage(meta['preprocess']) if 'preprocess' in meta else LEGACY_RECORD
+
+
+def save_model_meta(model_path, meta):
+    with open(MODEL_META % model_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+def load_model_meta(model_path):
+    """Metadata saved with a model by training, None for models trained before it was saved"""
+    path = MODEL_META % model_path
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
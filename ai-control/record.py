@@ -3,28 +3,54 @@
 Scripts to drive a donkey 2 car and train a model for it.
 
 Usage:
-    record.py
+    record.py [--rate=<hz>] [--telemetry_log=<path>] [--workers=<n>] [--queue=<n>] [--backpressure=<policy>] [--format=<format>] [--compress] [--dedup=<level>] [--profile=<dir>] [--track=<name>]
+
+Options:
+    --rate=<hz>              Frames recorded per second [default: 20]
+    --telemetry_log=<path>   Also append raw telemetry to a log for telemetrylog.py replay
+    --workers=<n>            Threads encoding and writing frames [default: 2]
+    --queue=<n>              Frames waiting for a worker before backpressure kicks in [default: 64]
+    --backpressure=<policy>  When the queue is full: block, drop_oldest or drop_newest [default: block]
+    --format=<format>        png for shot_N.png + record_N.json files, tub for one chunked tubfile per lap [default: png]
+    --compress               zlib compress tubfile frame chunks
+    --dedup=<level>          Store frames that differ from the last stored one by at most this mean pixel level
+                             (0 - 255) as a reference to it, capture timeouts always are. Off by default
+    --profile=<dir>          Time every stage into histograms exported as JSON lines and a Chrome trace in this
+                             directory, see instrument.py
+    --track=<name>           Track name in the session index, by default from the track length the game sends
 """
 
 import errno
+import io
+import json
 import os
 import numpy as np
-from datetime import datetime
 import time
 import signal
-from mss import mss
+from collections import namedtuple
 
 from PIL import Image
 from docopt import docopt
 
-from cffi import FFI
-
-import controller
+import capture
+import instrument
+import preprocess
 import telemetry
+import telemetrylog
+import recorder
+import scheduler
+import sessions
+import streams
+import tubfile
 
 # Optimus laptop fails native screengrab, so include a slower option
 disable_native_grab = True
-bbox = {'top': 72, 'left': 0, 'width': 1280, 'height': 720}
+CAPTURE_REGION = (0, 72, 1280, 720)  # (left, top, width, height) of the game on screen
+bbox = dict(zip(('left', 'top', 'width', 'height'), CAPTURE_REGION))
+FRAME_SIZE = (240, 168)  # Recorded frame (width, height)
+# Stored in the tub meta, training and driving rebuild the recorded frames from it. The native capture
+# grabs the whole screen and crops the region, mss grabs the region only
+RECORD_PREPROCESS = preprocess.Preprocess(size=FRAME_SIZE, region=CAPTURE_REGION)
 
 from enum import Enum, auto
 class State(Enum):
@@ -36,76 +62,200 @@ class State(Enum):
 def getImageName(id):
     return 'shot_{0}.png'.format(id)
 
-def capture_screen(ffi, msc, id, path):
-    start_time = datetime.now()
-    width = msc.get_capture_width()
-    height = msc.get_capture_height()
-    bytes = msc.get_bytes_per_pixel()
-    buffer_size = width * height * bytes
-    buffer = np.empty((buffer_size), np.uint8)
-    capture_result = msc.capture_frame(ffi.cast("uint8_t *", buffer.ctypes.data))
-    if capture_result < 0:
-        # see https://docs.microsoft.com/en-us/windows/desktop/direct3ddxgi/dxgi-error. Especially 0x887A0027 (DXGI_ERROR_WAIT_TIMEOUT) can happen
-        # if there was no new frame available since the last frame captured
-        print(ffi.string(msc.get_last_error()))
-        return
-    capture_time = datetime.now()
-
-    img = Image.frombytes("RGB", (width, height), buffer, "raw", "BGRX")
-    filename = path + getImageName(id)
-    img.save(filename)
-    save_time = datetime.now()
-    print('capture time:', (capture_time - start_time).microseconds / 1000, ', save time:',
-          (save_time - capture_time).microseconds / 1000)
-
-def capture_screen_py(sct, id, path):
+# Telemetry stored with every record, segment.py trims recordings by them
+TELEMETRY_COLUMNS = [('telemetry/lap', 'm_lap'), ('telemetry/lap_time', 'm_lapTime'),
+                     ('telemetry/gforce_lat', 'm_gforce_lat'), ('telemetry/gforce_lon', 'm_gforce_lon'),
+                     ('telemetry/in_pits', 'm_in_pits')]
+
+INPUTS = ['cam/image_array', 'telemetry/speed', 'user/throttle', 'user/angle', 'user/brake', 'user/mode'] + \
+         [key for key, _ in TELEMETRY_COLUMNS] + [streams.FRAME_TIME_KEY]
+TYPES = ['image_array', 'float', 'float', 'float', 'float', 'str'] + ['float'] * len(TELEMETRY_COLUMNS) + ['double']
+
+# A grabbed frame and its labels, written out by a recorder worker. telemetry holds TELEMETRY_COLUMNS values,
+# same_as the id of an earlier sample with the same frame or None, time the monotonic time of the grab
+Sample = namedtuple('Sample', ['id', 'path', 'size', 'pixels', 'speed', 'steering', 'throttle', 'brake', 'telemetry',
+                               'same_as', 'time'])
+
+def capture_screen(session):
+    # Converted and downscaled on the loop thread, the grab buffer goes back to the session pool
+    return session.shape[1::-1], session.grab_rgb()
+
+def capture_screen_py(sct):
     sct_img = sct.grab(bbox)
-    img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-    resized = img.resize((240, 168))
-    filename = path + getImageName(id)
-    resized.save(filename, compress_level=1)
-
-def captureJoystick(id, path, speed):
-    imageName = getImageName(id)
-    steering, throttle, brake = controller.getXZ()
+    return sct_img.size, sct_img.bgra
+
+def controller_sampler():
+    # Imported on first use, it opens SDL and the sample writers above are benchmarked headless
+    import controller
+    return controller.start()
+
+def captureJoystick(timestamp):
+    # Sampled on the controller thread, interpolated to the time the frame was grabbed
+    return controller_sampler().at(timestamp)
+
+def sample_telemetry(packet):
+    # Fields past the end of a short packet are left as missing values
+    return tuple(packet.get(name, float('nan')) for _, name in TELEMETRY_COLUMNS)
+
+def write_record(id, path, speed, steering, throttle, brake, telemetry_values, frame_id=None, captured=None):
+    imageName = getImageName(id if frame_id is None else frame_id)
+    columns = ''.join(',"%s":%f' % (key, value) for (key, _), value in zip(TELEMETRY_COLUMNS, telemetry_values)
+                      if value == value)
+    if captured is not None:
+        columns += ',"%s":%.6f' % (streams.FRAME_TIME_KEY, captured)
     with open(path + ('record_%d.json' % id), 'w') as f:
         f.write(
-            '{"cam/image_array":"%s","telemetry/speed":%f,"user/throttle":%f,"user/angle":%f,"user/brake":%f,"user/mode":"user"}' % (
-            imageName, speed, throttle, steering, brake))
+            '{"cam/image_array":"%s","telemetry/speed":%f,"user/throttle":%f,"user/angle":%f,"user/brake":%f,"user/mode":"user"%s}' % (
+            imageName, speed, throttle, steering, brake, columns))
+
+_pipelines = {}
+
+def sample_image(sample):
+    if isinstance(sample.pixels, np.ndarray):
+        return Image.fromarray(sample.pixels)  # Native capture delivers RGB at the final size
+    width, height = sample.size
+    pipeline = _pipelines.get(sample.size)
+    if pipeline is None:
+        pipeline = _pipelines[sample.size] = preprocess.compile((height, width, 4), RECORD_PREPROCESS.without_region(),
+                                                                preprocess.BGRX)
+    # batch() allocates its result, unlike a pipeline call it is safe on several recorder workers
+    with instrument.span('record/convert'):
+        return Image.fromarray(pipeline.batch(np.frombuffer(sample.pixels, np.uint8).reshape(height, width, 4)))
+
+def save_sample(sample):
+    """Recorder worker: convert, resize and PNG encode the frame, then write its record"""
+    if sample.same_as is None:
+        img = sample_image(sample)
+        # Encoded in memory first so encoding and writing are timed apart
+        with instrument.span('record/encode'):
+            png = io.BytesIO()
+            img.save(png, 'PNG', compress_level=1)
+        with instrument.span('record/write'):
+            with open(sample.path + getImageName(sample.id), 'wb') as f:
+                f.write(png.getbuffer())
+    with instrument.span('record/write'):
+        write_record(sample.id, sample.path, sample.speed, sample.steering, sample.throttle, sample.brake,
+                     sample.telemetry, sample.same_as, sample.time)
+
+class TubSink:
+    """Recorder handler appending samples to a tubfile per recording path. Appends must stay in order, use one worker"""
+    def __init__(self, compress=False, dedup=False):
+        self.compress = compress
+        self.dedup = dedup
+        self.path = None
+        self.writer = None
+        self.stored = (None, None)  # Sample id and tub index of the last stored frame
 
+    def __call__(self, sample):
+        if sample.path != self.path:
+            self.close()
+            self.path = sample.path
+            self.writer = tubfile.Writer(sample.path, INPUTS, TYPES, compress=self.compress,
+                                         meta={'preprocess': RECORD_PREPROCESS.to_meta()}, dedup=self.dedup)
+            self.stored = (None, None)
+        same_as = None
+        if sample.same_as is not None and sample.same_as == self.stored[0]:
+            same_as = self.stored[1]
+            img = None
+        else:
+            img = sample_image(sample)
+            self.stored = (sample.id, self.writer.count)
+        record = {'cam/image_array': np.asarray(img) if img is not None else None, 'telemetry/speed': sample.speed,
+                  'user/throttle': sample.throttle, 'user/angle': sample.steering,
+                  'user/brake': sample.brake, 'user/mode': 'user'}
+        record.update(zip([key for key, _ in TELEMETRY_COLUMNS], sample.telemetry))
+        record[streams.FRAME_TIME_KEY] = sample.time if sample.time is not None else np.nan
+        with instrument.span('record/write'):
+            self.writer.write(record, same_as)
 
-def get_record_path():
-    return './log/tub_' + str(time.time()) + '/'
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class Deduplicator:
+    """
+    Marks samples whose frame repeats the last stored one: capture timeouts, and frames whose mean
+    absolute difference from it on a grid of every step-th pixel is at most threshold. Sampling the grid
+    costs a few microseconds per frame on the capture loop.
+    Everything is decided here before queueing, the recorder workers only follow same_as.
+    """
+    def __init__(self, threshold=1.0, step=8):
+        self.threshold = threshold
+        self.step = step
+        self.duplicates = 0
+        self._stored = (None, None, None)  # Path, sample id and grid of the last stored frame
+
+    def grid(self, sample):
+        pixels = sample.pixels
+        if not isinstance(pixels, np.ndarray):
+            width, height = sample.size
+            pixels = np.frombuffer(pixels, np.uint8).reshape(height, width, 4)[:, :, :3]
+        return pixels[::self.step, ::self.step].astype(np.int16)
+
+    def __call__(self, sample, repeated=False):
+        path, id, grid = self._stored
+        if path == sample.path:
+            if repeated:
+                self.duplicates += 1
+                return sample._replace(same_as=id)
+            current = self.grid(sample)
+            if current.shape == grid.shape and np.mean(np.abs(current - grid)) <= self.threshold:
+                self.duplicates += 1
+                return sample._replace(same_as=id)
+        else:
+            current = self.grid(sample)
+        self._stored = (sample.path, sample.id, current)
+        return sample
+
+    def dropped(self, sample, queued):
+        """
+        Recorder on_drop hook: when a stored frame is dropped by backpressure, the first queued sample
+        referencing it stores the frame instead and the others reference that one
+        """
+        if sample.same_as is not None:
+            return
+        promoted = None
+        for i, other in enumerate(queued):
+            if other is not None and other.path == sample.path and other.same_as == sample.id:
+                if promoted is None:
+                    promoted = other.id
+                    queued[i] = other._replace(same_as=None)
+                else:
+                    queued[i] = other._replace(same_as=promoted)
+        path, id, grid = self._stored
+        if path == sample.path and id == sample.id:
+            self._stored = (path, promoted, grid) if promoted is not None else (None, None, None)
+
+
+def get_session_path():
+    return './log/session_' + str(time.time()) + '/'
+
+def get_record_path(session_path):
+    return session_path + 'tub_' + str(time.time()) + '/'
 
 def exit_gracefully(signum, frame):
     print('EXIT SIGNAL')
     quit()
 
-def record():
+def record(rate=20, telemetry_log=None, workers=2, queue_size=64, backpressure=recorder.BLOCK, format='png', compress=False,
+           dedup=None, profile=None, track=None):
     global disable_native_grab
     signal.signal(signal.SIGINT, exit_gracefully)
     signal.signal(signal.SIGTERM, exit_gracefully)
 
     time.sleep(5)
 
+    if profile:
+        print('Profiling stages to', instrument.configure(profile, 'record'))
     state = State.WAITING
     recordPath = '.'
     if (disable_native_grab == False):
-        ffi = FFI()
-        mscLib = ffi.dlopen('msc_x64.dll')
-        ffi.cdef('''
-            int init();
-            void close();
-            int get_capture_width();
-            int get_capture_height();
-            int get_bytes_per_pixel();
-            int capture_frame(uint8_t* buffer);
-            const char* get_last_error();
-        ''')
-        ret = mscLib.init()
-        print(ret)
-        print(ffi.string(mscLib.get_last_error()))
+        session = capture.NativeCapture(stages=[RECORD_PREPROCESS]).init()
+        print('Native capture %dx%d' % (session.width, session.height))
     else:
+        from mss import mss
         sct = mss()
 
     # if not os.path.exists(os.path.dirname(recordPath)):
@@ -120,50 +270,59 @@ def record():
     #     exit(1)
 
 
+    log = telemetrylog.LogWriter(telemetry_log) if telemetry_log else None
+    receiver = telemetry.start(log=log)
+    dedupe = Deduplicator(dedup) if dedup is not None else None
+    on_drop = dedupe.dropped if dedupe is not None else None
+    if format == 'tub':
+        sink = TubSink(compress, dedupe is not None)
+        writer = recorder.Recorder(sink, workers=1, maxsize=queue_size, policy=backpressure, on_drop=on_drop)
+    else:
+        sink = None
+        writer = recorder.Recorder(save_sample, workers=workers, maxsize=queue_size, policy=backpressure,
+                                   on_drop=on_drop)
+
+    loop = scheduler.LoopScheduler(rate)
+    stream_recorder = None
+    # Every tub of this run goes into one session, its index is kept up to date lap by lap
+    session_index = sessions.SessionWriter(get_session_path(), track)
+
     try:
         counter = 0
-        id = 0
-        prevSec = datetime.now().time().second
         while True:
-            # Excplicit update call because I'm lazy
-            telemetry.update()
-            speed = telemetry.get_telemetry_value('m_speed') * 3.6
-            laptime = telemetry.get_telemetry_value('m_lapTime')
-            g_lat = telemetry.get_telemetry_value('m_gforce_lat')
-            g_lon = telemetry.get_telemetry_value('m_gforce_lon')
+            loop.tick()
+            # Never blocks, the receiver thread keeps the newest packet
+            packet = receiver.latest
+            laptime = packet.m_lapTime
+            g_lat = packet.m_gforce_lat
+            g_lon = packet.m_gforce_lon
 
             if (laptime > 0 and state == State.WAITING):
                 print('Driving started')
                 counter = 0
                 state = State.DRIVING
-                recordPath = get_record_path()
+                recordPath = get_record_path(session_index.session_path)
                 try:
                     os.makedirs(os.path.dirname(recordPath))
                 except OSError as exc:  # Guard against race condition
                     if exc.errno != errno.EEXIST:
                         print('Recording name already exists. Please use another one')
                         raise
-                with open(recordPath + 'meta.json', 'w') as f:
-                    f.write(
-                        '{"inputs":['
-                        '"cam/image_array",'
-                        '"telemetry/speed",'
-                        '"user/throttle",'
-                        '"user/angle",'
-                        '"user/brake",'
-                        '"user/mode"],'
-                        '"types":['
-                        '"image_array",'
-                        '"float",'
-                        '"float",'
-                        '"float",'
-                        '"float",'
-                        '"str"]}')
+                if format == 'png':
+                    # The tubfile writer keeps its own meta.json
+                    with open(recordPath + 'meta.json', 'w') as f:
+                        json.dump({'inputs': INPUTS, 'types': TYPES, 'preprocess': RECORD_PREPROCESS.to_meta()}, f)
+                # Every controller sample and telemetry packet of the lap, for relabelling at training time
+                stream_recorder = streams.StreamRecorder(recordPath, controller_sampler(), receiver)
+                session_index.start_tub(recordPath)
 
                 # print(laptime)
             elif (laptime == 0 and state != State.WAITING):
                 print('New lap starting')
                 state = State.WAITING
+                stream_recorder.close()
+                stream_recorder = None
+                session_index.end_tub()
             elif (state == State.WAITING):
                 print('Waiting for start')
 
@@ -173,22 +332,39 @@ def record():
 
             if (state == State.DRIVING):
                 # print(speed, g_lon, g_lat)
-                captureJoystick(counter, recordPath, speed)
-                if (disable_native_grab):
-                    capture_screen_py(sct, counter, recordPath)
-                else:
-                    capture_screen(ffi, mscLib, counter, recordPath)
+                with instrument.span('record/frame'):
+                    frame_time = time.monotonic()
+                    timeouts = 0 if disable_native_grab else session.timeouts
+                    if (disable_native_grab):
+                        with instrument.span('capture/grab'):
+                            frame = capture_screen_py(sct)
+                    else:
+                        frame = capture_screen(session)
+                    steering, throttle, brake = captureJoystick(frame_time)
+                    if frame is not None:
+                        # Label the frame with the packet received closest to the grab
+                        _, frame_packet = receiver.closest(frame_time)
+                        size, pixels = frame
+                        sample = Sample(counter, recordPath, size, pixels, frame_packet.m_speed * 3.6, steering,
+                                        throttle, brake, sample_telemetry(frame_packet), None, frame_time)
+                        if dedupe is not None:
+                            # A capture timeout hands back the previous frame
+                            sample = dedupe(sample, not disable_native_grab and session.timeouts > timeouts)
+                        with instrument.span('record/enqueue'):
+                            writer.put(sample)
+                        session_index.add(counter, frame_packet)
+                    with instrument.span('record/streams'):
+                        stream_recorder.drain()
 
 
 
-            id = id + 1
             counter = counter + 1
-            currSec = datetime.now().time().second
-            if currSec is not prevSec:
-                print('Change', id, 'fps')
-                id = 0
-            prevSec = currSec
-            # sleep(0.1)
+            if loop.ticks % rate == 0:
+                stats = writer.stats()
+                print(loop.report() + ', queue', stats['depth'], 'max', stats['max_depth'],
+                      'written', stats['written'], 'dropped', stats['dropped'],
+                      'repeated', 0 if disable_native_grab else session.timeouts,
+                      'duplicates', dedupe.duplicates if dedupe is not None else 0)
     except Exception as e:
         print('\a')
         time.sleep(1)
@@ -196,8 +372,29 @@ def record():
         time.sleep(1)
         print('\a')
         quit()
+    finally:
+        # Flush frames still queued, also on the exit signal
+        writer.close()
+        if sink is not None:
+            sink.close()
+        if stream_recorder is not None:
+            stream_recorder.close()
+        # The receiver thread writes the telemetry log, stopped first so its last records are complete
+        telemetry.stop()
+        if log is not None:
+            log.close()
+        session_index.close()
+        if (disable_native_grab == False):
+            session.close()
+        if profile:
+            print(instrument.report())
+            instrument.close()
 
 
 if __name__ == '__main__':
     args = docopt(__doc__)
-    record()
+    record(rate=int(args['--rate']), telemetry_log=args['--telemetry_log'], workers=int(args['--workers']),
+           queue_size=int(args['--queue']), backpressure=args['--backpressure'],
+           format=args['--format'], compress=args['--compress'],
+           dedup=float(args['--dedup']) if args['--dedup'] else None, profile=args['--profile'],
+           track=args['--track'])
@@ -0,0 +1,99 @@
+import queue
+import threading
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class Recorder:
+    """
+    Runs the slow part of recording (resize, encode, file I/O) on worker threads.
+    The capture loop only put()s grabbed samples into a bounded queue, the policy decides what happens when it is full:
+    block the loop, drop the oldest queued sample or drop the new one.
+    PIL and zlib release the GIL while encoding so threads scale over cores.
+    on_drop(sample, queued) is called on the capture loop for every dropped sample, holding the queue lock so no
+    worker takes a sample meanwhile; it may replace items of the queued deque.
+    """
+    def __init__(self, handler, workers=2, maxsize=64, policy=BLOCK, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown backpressure policy %s, use one of %s' % (policy, ', '.join(POLICIES)))
+        self.handler = handler
+        self.policy = policy
+        self.on_drop = on_drop
+        self.queue = queue.Queue(maxsize)
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, sample):
+        if self.policy == BLOCK:
+            self.queue.put(sample)
+        elif self.policy == DROP_NEWEST:
+            try:
+                self.queue.put_nowait(sample)
+            except queue.Full:
+                with self.queue.mutex:
+                    self._dropped(sample)
+        else:
+            self._replace_oldest(sample)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _replace_oldest(self, sample):
+        """Queue the sample, dropping the oldest queued one when full, in one step so on_drop sees the new sample"""
+        with self.queue.mutex:
+            evicted = None
+            if self.queue.maxsize > 0 and len(self.queue.queue) >= self.queue.maxsize:
+                evicted = self.queue.queue.popleft()
+            else:
+                self.queue.unfinished_tasks += 1
+            self.queue.queue.append(sample)
+            self.queue.not_empty.notify()
+            if evicted is not None:
+                self._dropped(evicted)
+
+    def _dropped(self, sample):
+        """Count a dropped sample, the caller holds the queue lock"""
+        with self._lock:
+            self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(sample, self.queue.queue)
+
+    def _work(self):
+        while True:
+            sample = self.queue.get()
+            try:
+                if sample is None:
+                    break
+                self.handler(sample)
+                with self._lock:
+                    self.written += 1
+            except Exception as e:
+                print('Recorder failed to write a sample:', e)
+                with self._lock:
+                    self.errors += 1
+            finally:
+                self.queue.task_done()
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {'depth': self.depth, 'max_depth': self.max_depth, 'written': self.written,
+                'dropped': self.dropped, 'errors': self.errors}
+
+    def close(self):
+        """Write out everything queued and stop the workers"""
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,95 @@
+"""
+Fixed-rate loop pacing on the monotonic clock, shared by the record loop and the drive loop.
+"""
+from time import sleep, monotonic
+
+import numpy as np
+
+# What to do when a tick runs past the next deadline
+SKIP = 'skip'  # Drop the missed deadlines and continue on the original grid
+CATCH_UP = 'catch_up'  # Run the missed ticks back to back until on schedule again
+RESET = 'reset'  # Restart the schedule from now
+OVERRUN_POLICIES = (SKIP, CATCH_UP, RESET)
+
+
+def sleep_until(deadline):
+    # sleep() alone overshoots by a scheduler tick on Windows, spin the last millisecond
+    remaining = deadline - monotonic()
+    if remaining > 0.002:
+        sleep(remaining - 0.001)
+    while monotonic() < deadline:
+        pass
+
+
+class LoopScheduler:
+    """
+    Call tick() at the top of every loop iteration, it returns at the next deadline.
+    Deadlines are start + n * period so sleep error never accumulates into drift.
+    Keeps the last history ticks' latency (work time between tick() calls) and jitter
+    (how late tick() returned against its deadline) for percentiles.
+    """
+    def __init__(self, rate_hz, overrun=SKIP, history=1024):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError('Unknown overrun policy %s, use one of %s' % (overrun, ', '.join(OVERRUN_POLICIES)))
+        self.rate_hz = rate_hz
+        self.period = 1.0 / rate_hz
+        self.overrun = overrun
+        self.ticks = 0
+        self.missed = 0
+        self.started = None
+        self._deadline = None
+        self._tick_started = None
+        self._latency = np.zeros(history)
+        self._jitter = np.zeros(history)
+        self._size = history
+
+    def tick(self):
+        now = monotonic()
+        if self.started is None:
+            self.started = self._deadline = self._tick_started = now
+            self.ticks = 1
+            return now
+        i = (self.ticks - 1) % self._size
+        self._latency[i] = now - self._tick_started
+
+        deadline = self._deadline + self.period
+        if now > deadline:
+            late = int((now - deadline) / self.period)
+            if self.overrun == SKIP:
+                self.missed += late + 1
+                deadline += (late + 1) * self.period
+            elif self.overrun == RESET:
+                self.missed += late + 1
+                deadline = now
+            else:
+                self.missed += 1  # Still run, just late
+        sleep_until(deadline)
+        woke = monotonic()
+        self._jitter[i] = woke - deadline
+        self._deadline = deadline
+        self._tick_started = woke
+        self.ticks += 1
+        return woke
+
+    def stats(self):
+        """Tick counts, achieved rate and latency / jitter percentiles in milliseconds"""
+        n = min(self.ticks - 1, self._size)
+        result = {'ticks': self.ticks, 'missed': self.missed, 'target_hz': self.rate_hz}
+        if self.started is not None and self.ticks > 1:
+            result['rate_hz'] = (self.ticks - 1) / (self._tick_started - self.started)
+        if n > 0:
+            latency = self._latency[:n] * 1000 if n < self._size else self._latency * 1000
+            jitter = self._jitter[:n] * 1000 if n < self._size else self._jitter * 1000
+            for name, values in (('latency', latency), ('jitter', jitter)):
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                result[name] = {'p50': p50, 'p95': p95, 'p99': p99, 'max': values.max()}
+        return result
+
+    def report(self):
+        stats = self.stats()
+        line = '%.1f/%d Hz, %d missed' % (stats.get('rate_hz', 0), self.rate_hz, self.missed)
+        for name in ('latency', 'jitter'):
+            if name in stats:
+                line += ', %s p50 %.2f p99 %.2f max %.2f ms' % (name, stats[name]['p50'], stats[name]['p99'],
+                                                                stats[name]['max'])
+        return line
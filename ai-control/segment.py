@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Automatic trimming of recordings: marks the records training should skip, from their telemetry.
+
+Every record of a tub gets a bit mask of reasons to leave it out and a lap number, computed in a
+few vectorized passes over the tub's manifest columns:
+    standstill  speed below STANDSTILL_KMH for at least STANDSTILL_FRAMES records, as at the start
+                and end of a recording or after a crash
+    crash       g-forces above CRASH_G, plus CRASH_BEFORE records before and CRASH_AFTER after
+    pit         the car is in the pits
+    out_lap     the rest of a lap the car left the pits in
+Laps split where the lap number changes or the lap time starts over. The result is saved in the
+tub's index directory, records and frames are never deleted or rewritten. Tubs recorded before the
+lap and g-force columns were stored are trimmed by speed only.
+
+Usage:
+    segment.py (build) <tub>...
+    segment.py (info) <tub>...
+"""
+import glob
+import os
+
+import numpy as np
+
+import manifest
+
+STANDSTILL = 1
+CRASH = 2
+PIT = 4
+OUT_LAP = 8
+REASONS = (('standstill', STANDSTILL), ('crash', CRASH), ('pit', PIT), ('out_lap', OUT_LAP))
+
+SPEED_KEY = 'telemetry/speed'  # km/h
+LAP_KEY = 'telemetry/lap'
+LAP_TIME_KEY = 'telemetry/lap_time'
+GFORCE_KEYS = ('telemetry/gforce_lat', 'telemetry/gforce_lon')
+PIT_KEY = 'telemetry/in_pits'
+
+# Records are 1/20 s apart at the default recording rate
+STANDSTILL_KMH = 2.0
+STANDSTILL_FRAMES = 20
+CRASH_G = 6.0
+CRASH_BEFORE = 20
+CRASH_AFTER = 60
+LAP_RESET_SEC = 1.0  # A lap time drop larger than this starts a new lap
+
+SEGMENTS_FILE = os.path.join(manifest.INDEX_DIR, 'segments.npz')
+VERSION = 1
+
+
+def column(records, key):
+    """Column of the manifest as float64, None if the tub does not store it"""
+    if key not in records.dtype.names:
+        return None
+    return records[key].astype(np.float64)
+
+def long_runs(mask, length):
+    """Parts of mask that are runs of at least length True values"""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = ends - starts >= length
+    counts = np.zeros(len(mask) + 1, np.int32)
+    np.add.at(counts, starts[keep], 1)
+    np.add.at(counts, ends[keep], -1)
+    return np.cumsum(counts[:-1]) > 0
+
+def widen(mask, before, after):
+    """Mask with before records ahead of and after records behind every True value set too"""
+    hits = np.concatenate([[0], np.cumsum(mask)])
+    positions = np.arange(len(mask))
+    return hits[np.minimum(positions + before + 1, len(mask))] > hits[np.maximum(positions - after, 0)]
+
+def lap_starts(count, lap=None, lap_time=None):
+    """Which of count records start a new lap, from their lap numbers and lap times where known"""
+    boundaries = np.zeros(count, bool)
+    if lap is not None:
+        boundaries[1:] |= np.abs(np.diff(lap)) > 0  # Missing values never split
+    if lap_time is not None:
+        boundaries[1:] |= np.diff(lap_time) < -LAP_RESET_SEC
+    return boundaries
+
+def lap_numbers(records):
+    """Lap of every record, counted from 0 at the start of the tub"""
+    boundaries = lap_starts(len(records), column(records, LAP_KEY), column(records, LAP_TIME_KEY))
+    return np.cumsum(boundaries).astype(np.int32)
+
+
+class Segments:
+    """Exclusion reasons (bit mask, 0 keeps the record) and lap numbers by manifest position"""
+    def __init__(self, ids, reasons, lap):
+        self.ids = np.asarray(ids, np.int64)
+        self.reasons = np.asarray(reasons, np.uint8)
+        self.lap = np.asarray(lap, np.int32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def exclude(self):
+        return self.reasons != 0
+
+    def laps(self):
+        """(first, end) positions of every lap"""
+        starts = np.flatnonzero(np.diff(np.concatenate([[-1], self.lap])))
+        ends = np.concatenate([starts[1:], [len(self.lap)]])
+        return [(int(start), int(end)) for start, end in zip(starts, ends)]
+
+    def summary(self):
+        counts = ', '.join('%s %d' % (name, np.count_nonzero(self.reasons & bit)) for name, bit in REASONS)
+        return '%d records, %d excluded (%s), %d laps' % (
+            len(self), np.count_nonzero(self.exclude()), counts, len(self.laps()))
+
+    def save(self, tub_path):
+        path = os.path.join(tub_path, SEGMENTS_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, ids=self.ids, reasons=self.reasons, lap=self.lap, params=parameters(),
+                 version=np.array(VERSION))
+        os.replace(temp_path, path)
+
+
+def parameters():
+    return np.array([STANDSTILL_KMH, STANDSTILL_FRAMES, CRASH_G, CRASH_BEFORE, CRASH_AFTER, LAP_RESET_SEC])
+
+def segment(records):
+    """Segments of a tub's manifest records"""
+    reasons = np.zeros(len(records), np.uint8)
+    speed = column(records, SPEED_KEY)
+    if speed is not None:
+        reasons[long_runs(speed < STANDSTILL_KMH, STANDSTILL_FRAMES)] |= STANDSTILL
+    gforces = [column(records, key) for key in GFORCE_KEYS]
+    if all(values is not None for values in gforces):
+        crashed = np.maximum(np.abs(gforces[0]), np.abs(gforces[1])) > CRASH_G
+        reasons[widen(crashed, CRASH_BEFORE, CRASH_AFTER)] |= CRASH
+    lap = lap_numbers(records)
+    in_pits = column(records, PIT_KEY)
+    if in_pits is not None:
+        pit = in_pits > 0
+        reasons[pit] |= PIT
+        # Laps with any record in the pits are out laps
+        pit_laps = np.zeros(lap[-1] + 1 if len(lap) else 0, bool)
+        pit_laps[lap[pit]] = True
+        reasons[pit_laps[lap] & ~pit] |= OUT_LAP
+    return Segments(records[manifest.ID_FIELD], reasons, lap)
+
+def read_segments(tub_path):
+    path = os.path.join(tub_path, SEGMENTS_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if int(data['version']) != VERSION or not np.array_equal(data['params'], parameters()):
+            return None
+        return Segments(data['ids'], data['reasons'], data['lap'])
+
+def build(tub_path):
+    segments = segment(manifest.load(tub_path))
+    segments.save(tub_path)
+    return segments
+
+def load(tub_path, records=None):
+    """Saved segments of a tub, rebuilt first if missing, from other thresholds or behind the manifest"""
+    segments = read_segments(tub_path)
+    if records is None:
+        records = manifest.load(tub_path)
+    if segments is None or not np.array_equal(segments.ids, records[manifest.ID_FIELD]):
+        segments = segment(records)
+        segments.save(tub_path)
+    return segments
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    for tub in [path for pattern in args['<tub>'] for path in sorted(glob.glob(pattern))]:
+        segments = build(tub) if args['build'] else load(tub)
+        print(tub, segments.summary())
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Recording sessions: the tubs of one record.py run and an index of their laps.
+
+record.py records into log/session_<time>/, one tub per run from the start line, and keeps the
+session's session.json up to date while it records. The index lists every lap of every tub with
+its record id range, lap time, sector times and track, and whether it was finished, crashed or
+went through the pits, so training can pick laps like the fastest 20 on a track from the indexes
+alone. Laps split like segment.py splits them. Finished laps take the game's last lap time, sector
+3 is what is left of the lap after sectors 1 and 2. The track is named from the track length the
+game sends unless given.
+
+build indexes a directory of tubs recorded before sessions, or one a crash left behind, from the
+manifests and, where recorded, the telemetry streams. laps lists the laps a query selects.
+
+Usage:
+    sessions.py (build) <session> [--track=<name>]
+    sessions.py (laps) <path>... [--query=<query>]
+
+Options:
+    --track=<name>   Track name, by default from the track length
+    --query=<query>  Comma separated conditions, like track=track_4120,fastest=20,clean, see parse_query()
+                     [default: all]
+"""
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+import manifest
+import segment
+import streams
+
+SESSION_FILE = 'session.json'
+VERSION = 1
+
+# Per record values laps are computed from, and the telemetry field of each
+LAP_FIELDS = [('lap', 'm_lap'), ('lap_time', 'm_lapTime'), ('last_lap_time', 'm_last_lap_time'),
+              ('sector1', 'm_sector1_time'), ('sector2', 'm_sector2_time'), ('gforce_lat', 'm_gforce_lat'),
+              ('gforce_lon', 'm_gforce_lon'), ('in_pits', 'm_in_pits'), ('track_size', 'm_track_size')]
+# Manifest columns standing in for them in tubs recorded without streams
+MANIFEST_COLUMNS = {'lap': segment.LAP_KEY, 'lap_time': segment.LAP_TIME_KEY, 'gforce_lat': segment.GFORCE_KEYS[0],
+                    'gforce_lon': segment.GFORCE_KEYS[1], 'in_pits': segment.PIT_KEY}
+UNKNOWN_TRACK = 'unknown'
+SAVE_EVERY = 200  # Records between index updates within a lap, 10 s at the default rate
+
+
+def number(value):
+    """JSON friendly float, None for missing values"""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+def track_name(track_size):
+    sizes = track_size[np.isfinite(track_size) & (track_size > 0)]
+    return 'track_%d' % round(float(np.median(sizes))) if len(sizes) else UNKNOWN_TRACK
+
+def tub_laps(tub, ids, values, track=None, following=None):
+    """
+    Lap entries of a tub from its record ids and a dict of per record LAP_FIELDS arrays, missing
+    values NaN. following holds the LAP_FIELDS values of the record after the tub's last one, the first
+    of the session's next tub: record.py starts a new tub when the lap timer resets, so that record
+    tells whether the tub's last lap was finished and in what time.
+    """
+    if not len(ids):
+        return []
+    lap = values['lap']
+    starts = np.flatnonzero(segment.lap_starts(len(ids), lap, values['lap_time']))
+    starts = np.concatenate([[0], starts])
+    ends = np.concatenate([starts[1:], [len(ids)]])
+    gforce = np.maximum(np.abs(values['gforce_lat']), np.abs(values['gforce_lon']))
+    laps = []
+    for number_in_tub, (start, end) in enumerate(zip(starts, ends)):
+        last = end - 1
+        after = {name: values[name][end] for name, _ in LAP_FIELDS} if end < len(ids) else following
+        # Finished when the next lap starts with a higher lap number
+        complete = bool(after is not None and after['lap'] > lap[last])
+        lap_time = values['lap_time'][last]
+        if complete and after['last_lap_time'] > 0:
+            lap_time = after['last_lap_time']
+        sector1, sector2 = values['sector1'][last], values['sector2'][last]
+        sectors = None
+        if complete and sector1 > 0 and sector2 > 0:
+            sectors = [number(sector1), number(sector2), number(lap_time - sector1 - sector2)]
+        laps.append({
+            'tub': tub,
+            'lap': number_in_tub,
+            'first': int(ids[start]),
+            'last': int(ids[last]),
+            'records': int(end - start),
+            'lap_time': number(lap_time),
+            'sectors': sectors,
+            'complete': complete,
+            'crashed': bool(np.any(gforce[start:end] > segment.CRASH_G)),
+            'pit': bool(np.any(values['in_pits'][start:end] > 0)),
+            'track': track or track_name(values['track_size'][start:end]),
+        })
+    return laps
+
+def tub_values(tub_path, records):
+    """LAP_FIELDS arrays of a tub's records, from its telemetry stream or else its manifest columns"""
+    values = {name: np.full(len(records), np.nan) for name, _ in LAP_FIELDS}
+    for name, key in MANIFEST_COLUMNS.items():
+        if key in records.dtype.names:
+            values[name] = records[key].astype(np.float64)
+    stream = streams.read_stream(tub_path, streams.TELEMETRY)
+    if stream is not None and len(stream) and streams.FRAME_TIME_KEY in records.dtype.names:
+        for name, field in LAP_FIELDS:
+            valid = ~np.isnan(stream[field])
+            if valid.any():
+                values[name] = streams.resample(records[streams.FRAME_TIME_KEY], stream[streams.TIME_FIELD][valid],
+                                                stream[field][valid], streams.HOLD)
+    return values
+
+def read_tub(tub_path):
+    """(record ids, LAP_FIELDS arrays) of a tub"""
+    records = manifest.load(tub_path)
+    return records[manifest.ID_FIELD], tub_values(tub_path, records)
+
+def first_values(values):
+    """LAP_FIELDS values of the first record of a tub, None if it has none"""
+    if not len(values['lap']):
+        return None
+    return {name: values[name][0] for name, _ in LAP_FIELDS}
+
+def tub_name(tub_path):
+    return os.path.basename(os.path.normpath(tub_path))
+
+def build_tub(tub_path, track=None, following=None):
+    ids, values = read_tub(tub_path)
+    return tub_laps(tub_name(tub_path), ids, values, track, following)
+
+
+def session_tubs(session_path):
+    return [path for path in sorted(glob.glob(os.path.join(session_path, '*')))
+            if os.path.isfile(os.path.join(path, 'meta.json'))]
+
+def is_session(path):
+    return os.path.isfile(os.path.join(path, SESSION_FILE))
+
+def expand(paths):
+    """Paths with every session directory replaced by its tubs"""
+    tubs = []
+    for path in paths:
+        tubs.extend(session_tubs(path) if is_session(path) else [path])
+    return tubs
+
+def save(session_path, index):
+    path = os.path.join(session_path, SESSION_FILE)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(temp_path, path)
+
+def load(session_path):
+    """Index of a session, None if the directory has none"""
+    path = os.path.join(session_path, SESSION_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        index = json.load(f)
+    if index.get('version') != VERSION:
+        return None
+    return index
+
+def build(session_path, track=None):
+    """Index the tubs of a directory as one session"""
+    tubs = [(tub,) + read_tub(tub) for tub in session_tubs(session_path)]
+    laps = []
+    following = None
+    # Last tub first, each tub's last lap ends with the first record of the next tub that has one
+    for tub, ids, values in reversed(tubs):
+        laps[:0] = tub_laps(tub_name(tub), ids, values, track, following)
+        following = first_values(values) or following
+    index = {'version': VERSION, 'started': os.stat(session_path).st_mtime, 'track': track, 'laps': laps}
+    save(session_path, index)
+    return index
+
+
+class SessionWriter:
+    """
+    Keeps session.json of a recording session up to date. Call start_tub() when a tub is started,
+    add() with every recorded record's id and the telemetry packet it was labelled with, and
+    close() at the end. The index is rewritten when a lap or tub ends and every save_every records.
+    The last lap of a tub is final once the first record of the next tub arrives, until then it is
+    listed unfinished.
+    """
+    def __init__(self, session_path, track=None, save_every=SAVE_EVERY):
+        self.session_path = session_path
+        self.track = track
+        self.save_every = save_every
+        self.index = {'version': VERSION, 'started': time.time(), 'track': track, 'laps': []}
+        self.finished = []  # Laps of the earlier tubs
+        self.ended = None  # (tub, ids, values) of the last tub, waiting for the next tub's first record
+        self.tub = None
+        self._ids = []
+        self._values = []
+
+    def start_tub(self, tub_path):
+        self.end_tub()
+        self.tub = tub_name(tub_path)
+
+    def add(self, id, packet):
+        values = tuple(packet.get(field, float('nan')) for _, field in LAP_FIELDS)
+        # Same rule as segment.lap_starts(), the first record of a lap tells whether the last one was finished
+        new_lap = bool(self._values) and (abs(values[0] - self._values[-1][0]) > 0 or
+                                          values[1] - self._values[-1][1] < -segment.LAP_RESET_SEC)
+        if self.ended is not None:
+            self.finish_ended(dict(zip([name for name, _ in LAP_FIELDS], values)))
+            new_lap = True
+        self._ids.append(id)
+        self._values.append(values)
+        if new_lap or len(self._ids) % self.save_every == 0:
+            self.save()
+
+    def _laps(self, tub, ids, values, following=None):
+        if tub is None or not ids:
+            return []
+        columns = np.array(values, np.float64)
+        values = {name: columns[:, i] for i, (name, _) in enumerate(LAP_FIELDS)}
+        return tub_laps(tub, np.array(ids, np.int64), values, self.track, following)
+
+    def laps(self):
+        """Laps of the current tub so far"""
+        return self._laps(self.tub, self._ids, self._values)
+
+    def finish_ended(self, following=None):
+        """Final laps of the last ended tub, following is the first record of the next tub"""
+        if self.ended is not None:
+            self.finished.extend(self._laps(*self.ended, following=following))
+            self.ended = None
+
+    def save(self):
+        os.makedirs(self.session_path, exist_ok=True)
+        ended = self._laps(*self.ended) if self.ended is not None else []
+        self.index['laps'] = self.finished + ended + self.laps()
+        save(self.session_path, self.index)
+
+    def end_tub(self):
+        if self.tub is None:
+            return
+        if self._ids:
+            self.ended = (self.tub, self._ids, self._values)
+        self.tub = None
+        self._ids = []
+        self._values = []
+        self.save()
+
+    def close(self):
+        self.end_tub()
+        if self.ended is not None:
+            self.finish_ended()
+            self.save()
+
+
+def find_laps(tubs):
+    """
+    Laps of tubs, each with the tub's path, from the index of the session they are in. Tubs outside
+    a session or missing from its index are indexed on the fly.
+    """
+    indexes = {}
+    laps = []
+    for tub in tubs:
+        tub = os.path.normpath(tub)
+        session_path, name = os.path.split(tub)
+        if session_path not in indexes:
+            indexes[session_path] = load(session_path)
+        index = indexes[session_path]
+        found = [lap for lap in index['laps'] if lap['tub'] == name] if index is not None else []
+        if not found:
+            found = build_tub(tub, index['track'] if index is not None else None)
+        for lap in found:
+            lap = dict(lap)
+            lap['path'] = tub
+            laps.append(lap)
+    return laps
+
+def select(laps, track=None, complete=True, clean=False, max_time=None, fastest=None):
+    """
+    Laps on track, finished unless complete is False, without crashes and pit visits if clean,
+    at most max_time seconds long, and of those the fastest number. Fastest first when limited,
+    else in recording order.
+    """
+    selected = [lap for lap in laps
+                if (track is None or lap['track'] == track) and
+                (not complete or lap['complete']) and
+                (not clean or not (lap['crashed'] or lap['pit'])) and
+                (max_time is None or (lap['lap_time'] is not None and lap['lap_time'] <= max_time))]
+    if fastest is not None:
+        timed = [lap for lap in selected if lap['lap_time'] is not None]
+        selected = sorted(timed, key=lambda lap: lap['lap_time'])[:fastest]
+    return selected
+
+def parse_query(query):
+    """
+    select() arguments of a query like track=track_4120,fastest=20,clean: track=<name>, fastest=<n>,
+    max_time=<sec>, clean, and all to include unfinished laps
+    """
+    arguments = {}
+    for condition in query.split(','):
+        condition = condition.strip()
+        if not condition:
+            continue
+        key, _, value = condition.partition('=')
+        if key == 'track':
+            arguments['track'] = value
+        elif key == 'fastest':
+            arguments['fastest'] = int(value)
+        elif key == 'max_time':
+            arguments['max_time'] = float(value)
+        elif key == 'clean':
+            arguments['clean'] = True
+        elif key == 'all':
+            arguments['complete'] = False
+        else:
+            raise ValueError('Unknown lap condition %s, use track, fastest, max_time, clean or all' % condition)
+    return arguments
+
+def describe(lap):
+    sectors = ' '.join('%.2f' % sector for sector in lap['sectors']) if lap['sectors'] else '-'
+    flags = ''.join(flag for flag, on in (('C', lap['crashed']), ('P', lap['pit']), ('*', not lap['complete'])) if on)
+    lap_time = '%8.2f' % lap['lap_time'] if lap['lap_time'] is not None else '       -'
+    return '%-40s lap %2d %6d records %s s  sectors %-20s %-14s %s' % (
+        lap.get('path', lap['tub']), lap['lap'], lap['records'], lap_time, sectors, lap['track'], flags)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    if args['build']:
+        index = build(args['<session>'], args['--track'])
+        print('%d laps in %d tubs' % (len(index['laps']), len(session_tubs(args['<session>']))))
+    else:
+        tubs = expand([path for pattern in args['<path>'] for path in sorted(glob.glob(pattern))])
+        laps = select(find_laps(tubs), **parse_query(args['--query']))
+        for lap in laps:
+            print(describe(lap))
+        print('%d laps, C crashed, P pits, * unfinished' % len(laps))
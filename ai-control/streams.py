@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Timestamped input streams of a recording and their alignment to the frames.
+
+While a tub is recorded, every controller sample and every telemetry packet is appended with its
+time.monotonic() time to the tub's streams directory, and every record stores the monotonic time
+its frame was grabbed (time/captured). Labels can then be rebuilt at training time for any lead
+or lag between a frame and its controls, resampled by nearest, linear or hold, in one vectorized
+pass per tub. Tubs recorded before the streams keep their recorded labels.
+
+A stream is <name>.f8, rows of float64 (time, fields...), next to <name>.json naming the fields.
+
+Usage:
+    streams.py (info) <tub>
+    streams.py (relabel) <tub> [--lead=<sec>] [--mode=<mode>]
+
+Options:
+    --lead=<sec>   Labels are taken this long after the frame was grabbed, negative for before [default: 0]
+    --mode=<mode>  nearest, linear or hold [default: linear]
+"""
+import json
+import os
+
+import numpy as np
+
+import manifest
+import telemetry
+
+STREAMS_DIR = 'streams'
+CONTROLS = 'controls'
+CONTROL_FIELDS = ['steering', 'throttle', 'brake']
+TELEMETRY = 'telemetry'
+TIME_FIELD = 't'
+
+FRAME_TIME_KEY = 'time/captured'
+# Record key, stream, field and scale of every label rebuilt from the streams
+LABELS = [
+    ('user/angle', CONTROLS, 'steering', 1.0),
+    ('user/throttle', CONTROLS, 'throttle', 1.0),
+    ('user/brake', CONTROLS, 'brake', 1.0),
+    ('telemetry/speed', TELEMETRY, 'm_speed', 3.6),  # km/h
+    ('telemetry/lap', TELEMETRY, 'm_lap', 1.0),
+    ('telemetry/lap_time', TELEMETRY, 'm_lapTime', 1.0),
+    ('telemetry/gforce_lat', TELEMETRY, 'm_gforce_lat', 1.0),
+    ('telemetry/gforce_lon', TELEMETRY, 'm_gforce_lon', 1.0),
+    ('telemetry/in_pits', TELEMETRY, 'm_in_pits', 1.0),
+]
+# Counters and states, never interpolated
+DISCRETE = ('telemetry/lap', 'telemetry/in_pits')
+
+NEAREST = 'nearest'
+LINEAR = 'linear'
+HOLD = 'hold'  # Last sample at or before the time
+MODES = (NEAREST, LINEAR, HOLD)
+
+
+class StreamWriter:
+    """Appends (time, fields...) rows to a stream of a tub"""
+    def __init__(self, tub_path, name, fields):
+        path = os.path.join(tub_path, STREAMS_DIR)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, name + '.json'), 'w') as f:
+            json.dump({'fields': [TIME_FIELD] + list(fields)}, f)
+        self.file = open(os.path.join(path, name + '.f8'), 'ab')
+        self.width = len(fields) + 1
+        self.rows = 0
+
+    def write(self, rows):
+        rows = np.asarray(rows, '<f8').reshape(-1, self.width)
+        self.file.write(rows.tobytes())
+        self.rows += len(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def read_stream(tub_path, name):
+    """Rows of a stream as a structured array with a float64 field per column, None if the tub has none"""
+    path = os.path.join(tub_path, STREAMS_DIR, name)
+    if not os.path.exists(path + '.json'):
+        return None
+    with open(path + '.json', 'r') as f:
+        fields = json.load(f)['fields']
+    values = np.fromfile(path + '.f8', '<f8')
+    values = values[:len(values) // len(fields) * len(fields)]  # A row cut short by a crash
+    return values.view(np.dtype([(field, '<f8') for field in fields]))
+
+
+class StreamRecorder:
+    """
+    Copies the controller samples and telemetry packets that arrived since the last drain() into a
+    tub's streams. Call drain() from the record loop, the sampler and receiver rings hold seconds.
+    """
+    def __init__(self, tub_path, sampler, receiver):
+        self.sampler = sampler
+        self.receiver = receiver
+        self.controls = StreamWriter(tub_path, CONTROLS, CONTROL_FIELDS)
+        self.telemetry = StreamWriter(tub_path, TELEMETRY, telemetry.FULL_LAYOUT.names)
+        self._samples = sampler.count
+        self._packets = receiver.count
+
+    def drain(self):
+        self._samples, samples = self.sampler.since(self._samples)
+        if len(samples):
+            self.controls.write(samples)
+        self._packets, packets = self.receiver.since(self._packets)
+        if packets:
+            rows = np.full((len(packets), self.telemetry.width), np.nan)
+            for row, (time, packet) in zip(rows, packets):
+                row[0] = time
+                row[1:len(packet) + 1] = packet  # Short packets leave the fields they lack missing
+            self.telemetry.write(rows)
+
+    def close(self):
+        self.drain()
+        self.controls.close()
+        self.telemetry.close()
+
+
+def resample(times, stream_times, values, mode=LINEAR):
+    """
+    values of a stream sampled at sorted stream_times, looked up at times. Times outside the stream
+    get its first or last value.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown resampling mode %s, use one of %s' % (mode, ', '.join(MODES)))
+    times = np.asarray(times, np.float64)
+    if mode == LINEAR:
+        return np.interp(times, stream_times, values)
+    last = len(stream_times) - 1
+    if mode == HOLD:
+        positions = np.searchsorted(stream_times, times, side='right') - 1
+    else:
+        after = np.clip(np.searchsorted(stream_times, times), 0, last)
+        before = np.clip(after - 1, 0, last)
+        closer = np.abs(stream_times[before] - times) <= np.abs(stream_times[after] - times)
+        positions = np.where(closer, before, after)
+    return values[np.clip(positions, 0, last)]
+
+def relabel(tub_path, records, lead=0.0, mode=LINEAR):
+    """
+    Copy of a tub's manifest records with the LABELS resampled from its streams at the frame times
+    plus lead seconds. Records of tubs without streams come back unchanged.
+    """
+    if FRAME_TIME_KEY not in records.dtype.names:
+        return records
+    times = records[FRAME_TIME_KEY] + lead
+    records = records.copy()
+    streams = {}
+    for key, name, field, scale in LABELS:
+        if key not in records.dtype.names:
+            continue
+        if name not in streams:
+            streams[name] = read_stream(tub_path, name)
+        stream = streams[name]
+        if stream is None or not len(stream) or field not in stream.dtype.names:
+            continue
+        # Rows of packets missing the field are skipped
+        valid = ~np.isnan(stream[field])
+        if not valid.any():
+            continue
+        records[key] = resample(times, stream[TIME_FIELD][valid], stream[field][valid] * scale,
+                                HOLD if key in DISCRETE else mode)
+    return records
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    tub = args['<tub>']
+    if args['info']:
+        for name in (CONTROLS, TELEMETRY):
+            stream = read_stream(tub, name)
+            if stream is None:
+                print(name, 'not recorded')
+            elif len(stream):
+                span = stream[TIME_FIELD][-1] - stream[TIME_FIELD][0]
+                print('%-10s %7d samples over %.1f s, %.0f Hz' % (name, len(stream), span,
+                                                                   (len(stream) - 1) / span if span else 0))
+    else:
+        records = manifest.load(tub)
+        relabelled = relabel(tub, records, float(args['--lead']), args['--mode'])
+        for key, _, _, _ in LABELS:
+            if key in records.dtype.names:
+                change = np.nanmean(np.abs(relabelled[key] - records[key]))
+                print('%-22s mean change %.4f' % (key, change))
@@ -1,124 +1,306 @@
+#!/usr/bin/env python3
+"""
+DiRT UDP telemetry.
+
+Usage:
+    telemetry.py (test)
+    telemetry.py (bench) [--packets=<n>]
+
+Options:
+    --packets=<n>    Packets to decode per benchmark run [default: 100000]
+"""
+
 import socket
-from struct import unpack
-from time import sleep
-import select
+import struct
+import threading
+from collections import namedtuple
+from time import sleep, perf_counter, monotonic
+
+import instrument
 
 # https://github.com/martijnvankekem/f1_telemetry_python/blob/master/F1Telemetry/ArrayStructure.py
-returnData = [] # Create an empty array
-
-# Initialize data array -- BEGIN FUNCTION
-def initArray():
-    global returnData # Access the global variable returnData
-    # FLOATS
-    returnData.append(["m_time", 0, 'f']) # Total session time (in seconds)
-    returnData.append(["m_lapTime", 0, 'f']) # Current lap time (in seconds)
-    returnData.append(["m_lapDistance", 0, 'f']) # Current lap distance (in meters)
-    returnData.append(["m_totalDistance", 0, 'f']) # Total distance (in meters)
-    returnData.append(["m_x", 0, 'f']) # World space X-position
-    returnData.append(["m_y", 0, 'f']) # World space Y-position
-    returnData.append(["m_z", 0, 'f']) # World space Z-position
-    returnData.append(["m_speed", 0, 'f']) # Car speed in meters per second
-    returnData.append(["m_xv", 0, 'f']) # World space X-velocity
-    returnData.append(["m_yv", 0, 'f']) # World space Y-velocity
-    returnData.append(["m_zv", 0, 'f']) # World space Z-velocity
-    returnData.append(["m_xr", 0, 'f']) # World space right X-direction
-    returnData.append(["m_yr", 0, 'f']) # World space right Y-direction
-    returnData.append(["m_zr", 0, 'f']) # World space right Z-direction
-    returnData.append(["m_xd", 0, 'f']) # World space forward X-direction
-    returnData.append(["m_yd", 0, 'f']) # World space forward Y-direction
-    returnData.append(["m_zd", 0, 'f']) # World space forward Z-direction
-    returnData.append(["m_susp_pos_rl", 0, 'f']) # Suspension position - Rear left wheel
-    returnData.append(["m_susp_pos_rr", 0, 'f']) # Suspension position - Rear right wheel
-    returnData.append(["m_susp_pos_fl", 0, 'f']) # Suspension position - Front left wheel
-    returnData.append(["m_susp_pos_fr", 0, 'f']) # Suspension position - Front right wheel
-    returnData.append(["m_susp_vel_rl", 0, 'f']) # Suspension velocity - Rear left wheel
-    returnData.append(["m_susp_vel_rr", 0, 'f']) # Suspension velocity - Rear right wheel
-    returnData.append(["m_susp_vel_fl", 0, 'f']) # Suspension velocity - Front left wheel
-    returnData.append(["m_susp_vel_fr", 0, 'f']) # Suspension velocity - Front right wheel
-    returnData.append(["m_wheel_speed_rl", 0, 'f']) # Wheel speed - Rear left wheel
-    returnData.append(["m_wheel_speed_rr", 0, 'f']) # Wheel speed - Rear right wheel
-    returnData.append(["m_wheel_speed_fl", 0, 'f']) # Wheel speed - Front left wheel
-    returnData.append(["m_wheel_speed_fr", 0, 'f']) # Wheel speed - Front right wheel
-    returnData.append(["m_throttle", 0, 'f']) # Throttle value (min: 0, max: 1)
-    returnData.append(["m_steer", 0, 'f']) # Steering rotation (min: 1, max: -1)
-    returnData.append(["m_brake", 0, 'f']) # Brake value (min: 0, max: 1)
-    returnData.append(["m_clutch", 0, 'f']) # Clutch value (min: 0, max: 1)
-    returnData.append(["m_gear", 0, 'f']) # Current gear (0 => R, 1 => N, 2 => ...)
-    returnData.append(["m_gforce_lat", 0, 'f']) # G-Force latitude
-    returnData.append(["m_gforce_lon", 0, 'f']) # G-Force longitude
-    returnData.append(["m_lap", 0, 'f']) # Current lap
-    returnData.append(["m_engineRate", 0, 'f']) # Current RPM
-    returnData.append(["m_sli_pro_native_support", 0, 'f']) # SLI Pro support
-    returnData.append(["m_car_position", 0, 'f']) # Car race position
-    returnData.append(["m_kers_level", 0, 'f']) # KERS energy left
-    returnData.append(["m_kers_max_level", 0, 'f']) # KERS maximum energy
-    returnData.append(["m_drs", 0, 'f']) # DRS state, 0 = off, 1 = on
-    returnData.append(["m_traction_control", 0, 'f']) # Traction control enabled (off: 0, high: 2)
-    returnData.append(["m_anti_lock_brakes", 0, 'f']) # Anti lock brakes enabled (off: 0, on: 1)
-    returnData.append(["m_fuel_in_tank", 0, 'f']) # Current fuel mass
-    returnData.append(["m_fuel_capacity", 0, 'f']) # Fuel capacity
-    returnData.append(["m_in_pits", 0, 'f']) # Car in pit (0: no, 1: pitting, 2: in pit area)
-    returnData.append(["m_sector", 0, 'f']) # Current sector car is in (0: sector 1, 1: sector 2, 2: sector 3)
-    returnData.append(["m_sector1_time", 0, 'f']) # Current first sector time
-    returnData.append(["m_sector2_time", 0, 'f']) # Current second sector time
-    returnData.append(["m_brakes_temp_rl", 0, 'f']) # Brake temperature - Rear left wheel
-    returnData.append(["m_brakes_temp_rr", 0, 'f']) # Brake temperature - Rear right wheel
-    returnData.append(["m_brakes_temp_fl", 0, 'f']) # Brake temperature - Front left wheel
-    returnData.append(["m_brakes_temp_fr", 0, 'f']) # Brake temperature - Front right wheel
-    
-# Initialize data array -- END FUNCTION
-
-initArray() # Execute the function
+# Field name and struct format of every value in the packet, in packet order.
+# DiRT sends a prefix of this table depending on the extradata setting, extradata=3 sends all of it (264 bytes)
+FIELDS = [
+    ('m_time', 'f'),  # Total session time (in seconds)
+    ('m_lapTime', 'f'),  # Current lap time (in seconds)
+    ('m_lapDistance', 'f'),  # Current lap distance (in meters)
+    ('m_totalDistance', 'f'),  # Total distance (in meters)
+    ('m_x', 'f'),  # World space X-position
+    ('m_y', 'f'),  # World space Y-position
+    ('m_z', 'f'),  # World space Z-position
+    ('m_speed', 'f'),  # Car speed in meters per second
+    ('m_xv', 'f'),  # World space X-velocity
+    ('m_yv', 'f'),  # World space Y-velocity
+    ('m_zv', 'f'),  # World space Z-velocity
+    ('m_xr', 'f'),  # World space right X-direction
+    ('m_yr', 'f'),  # World space right Y-direction
+    ('m_zr', 'f'),  # World space right Z-direction
+    ('m_xd', 'f'),  # World space forward X-direction
+    ('m_yd', 'f'),  # World space forward Y-direction
+    ('m_zd', 'f'),  # World space forward Z-direction
+    ('m_susp_pos_rl', 'f'),  # Suspension position - Rear left wheel
+    ('m_susp_pos_rr', 'f'),  # Suspension position - Rear right wheel
+    ('m_susp_pos_fl', 'f'),  # Suspension position - Front left wheel
+    ('m_susp_pos_fr', 'f'),  # Suspension position - Front right wheel
+    ('m_susp_vel_rl', 'f'),  # Suspension velocity - Rear left wheel
+    ('m_susp_vel_rr', 'f'),  # Suspension velocity - Rear right wheel
+    ('m_susp_vel_fl', 'f'),  # Suspension velocity - Front left wheel
+    ('m_susp_vel_fr', 'f'),  # Suspension velocity - Front right wheel
+    ('m_wheel_speed_rl', 'f'),  # Wheel speed - Rear left wheel
+    ('m_wheel_speed_rr', 'f'),  # Wheel speed - Rear right wheel
+    ('m_wheel_speed_fl', 'f'),  # Wheel speed - Front left wheel
+    ('m_wheel_speed_fr', 'f'),  # Wheel speed - Front right wheel
+    ('m_throttle', 'f'),  # Throttle value (min: 0, max: 1)
+    ('m_steer', 'f'),  # Steering rotation (min: 1, max: -1)
+    ('m_brake', 'f'),  # Brake value (min: 0, max: 1)
+    ('m_clutch', 'f'),  # Clutch value (min: 0, max: 1)
+    ('m_gear', 'f'),  # Current gear (0 => R, 1 => N, 2 => ...)
+    ('m_gforce_lat', 'f'),  # G-Force latitude
+    ('m_gforce_lon', 'f'),  # G-Force longitude
+    ('m_lap', 'f'),  # Current lap
+    ('m_engineRate', 'f'),  # Current RPM
+    ('m_sli_pro_native_support', 'f'),  # SLI Pro support
+    ('m_car_position', 'f'),  # Car race position
+    ('m_kers_level', 'f'),  # KERS energy left
+    ('m_kers_max_level', 'f'),  # KERS maximum energy
+    ('m_drs', 'f'),  # DRS state, 0 = off, 1 = on
+    ('m_traction_control', 'f'),  # Traction control enabled (off: 0, high: 2)
+    ('m_anti_lock_brakes', 'f'),  # Anti lock brakes enabled (off: 0, on: 1)
+    ('m_fuel_in_tank', 'f'),  # Current fuel mass
+    ('m_fuel_capacity', 'f'),  # Fuel capacity
+    ('m_in_pits', 'f'),  # Car in pit (0: no, 1: pitting, 2: in pit area)
+    ('m_sector', 'f'),  # Current sector car is in (0: sector 1, 1: sector 2, 2: sector 3)
+    ('m_sector1_time', 'f'),  # Current first sector time
+    ('m_sector2_time', 'f'),  # Current second sector time
+    ('m_brakes_temp_rl', 'f'),  # Brake temperature - Rear left wheel
+    ('m_brakes_temp_rr', 'f'),  # Brake temperature - Rear right wheel
+    ('m_brakes_temp_fl', 'f'),  # Brake temperature - Front left wheel
+    ('m_brakes_temp_fr', 'f'),  # Brake temperature - Front right wheel
+    ('m_tyre_pressure_rl', 'f'),  # Tyre pressure - Rear left wheel
+    ('m_tyre_pressure_rr', 'f'),  # Tyre pressure - Rear right wheel
+    ('m_tyre_pressure_fl', 'f'),  # Tyre pressure - Front left wheel
+    ('m_tyre_pressure_fr', 'f'),  # Tyre pressure - Front right wheel
+    ('m_team_info', 'f'),  # Team ID
+    ('m_total_laps', 'f'),  # Total number of laps in the race
+    ('m_track_size', 'f'),  # Track length (in meters)
+    ('m_last_lap_time', 'f'),  # Last lap time (in seconds)
+    ('m_max_rpm', 'f'),  # Maximum RPM
+    ('m_idle_rpm', 'f'),  # Idle RPM
+    ('m_max_gears', 'f'),  # Number of forward gears
+]
 
 DIRT_IP = "127.0.0.1"
 DIRT_PORT = 20777
+HISTORY_SIZE = 4096  # Packets kept for timestamp lookups, ~70s at 60Hz
+
+
+def _packet_class(names):
+    index = {name: i for i, name in enumerate(names)}
+
+    class TelemetryPacket(namedtuple('TelemetryPacket', names)):
+        """Immutable decoded packet. Values by attribute (packet.m_speed) or name (packet['m_speed'])"""
+        __slots__ = ()
+
+        def __getitem__(self, key):
+            if key.__class__ is str:
+                return tuple.__getitem__(self, index[key])
+            return tuple.__getitem__(self, key)
+
+        def get(self, name, default=-1):
+            i = index.get(name)
+            return default if i is None else tuple.__getitem__(self, i)
+
+    return TelemetryPacket
+
+
+class Layout:
+    """Compiled decoder for the fields that fit in a datagram of a given size"""
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = [name for name, _ in fields]
+        self.struct = struct.Struct('<' + ''.join(fmt for _, fmt in fields))
+        self.size = self.struct.size
+        self.packet = _packet_class(self.names)
+
+    def decode(self, data):
+        return tuple.__new__(self.packet, self.struct.unpack_from(data))
+
+
+_layouts = {}
+
+def layout_for(size):
+    """Layout for a datagram of the given length, picked once per size and cached"""
+    layout = _layouts.get(size)
+    if layout is None:
+        fields = []
+        offset = 0
+        for name, fmt in FIELDS:
+            offset += struct.calcsize('<' + fmt)
+            if offset > size:
+                break
+            fields.append((name, fmt))
+        layout = _layouts[size] = Layout(fields)
+    return layout
 
-sock = socket.socket(socket.AF_INET, # Internet
-                     socket.SOCK_DGRAM) # UDP
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1)
+FULL_LAYOUT = layout_for(struct.calcsize('<' + ''.join(fmt for _, fmt in FIELDS)))
+EMPTY = FULL_LAYOUT.packet._make([0] * len(FIELDS))
 
-sock.bind((DIRT_IP, DIRT_PORT))
+def decode(data):
+    """Decode a whole datagram with a single unpack_from"""
+    layout = _layouts.get(len(data)) or layout_for(len(data))
+    return tuple.__new__(layout.packet, layout.struct.unpack_from(data))
 
-print('Connecting telemetry socket')
 
-def update():
-    global returnData  # Access the global variable returnData
-    index = 0  # Set starting index
-    ready = select.select([sock], [], [], 1)
-    if ready[0]:
-        data, addr = sock.recvfrom(4096)  # Receive value from UDP socket
-        for x in range(0, len(returnData)):  # Do for every item in the received array
-            size = 4 if returnData[x][2] == 'f' else 1  # Set size based on if it's a byte or float
-            returnData[x][1] = unpack('<' + returnData[x][2], data[index:index + size])[0]  # Add float to the array
-            index += size  # Increase starting index with the size
+class Receiver(threading.Thread):
+    """
+    Drains the telemetry socket on its own thread.
+    The newest (receive time, packet) pair is published with a single assignment so readers never lock,
+    older packets are kept in a ring buffer for closest(timestamp) lookups. Times are time.monotonic().
+    Raw datagrams are also written to log (a telemetrylog.LogWriter) when given.
+    """
+    def __init__(self, ip=DIRT_IP, port=DIRT_PORT, history=HISTORY_SIZE, log=None):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, # Internet
+                                  socket.SOCK_DGRAM) # UDP
+        self.sock.bind((ip, port))
+        self.sock.settimeout(0.1)  # Only to notice stop()
+        self.newest = (0.0, EMPTY)
+        self.count = 0
+        self._size = history
+        self._times = [0.0] * history
+        self._packets = [EMPTY] * history
+        self._lock = threading.Lock()
+        self.log = log
+        self._running = False
+
+    @property
+    def latest(self):
+        return self.newest[1]
+
+    def start(self):
+        self._running = True
+        super().start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self.is_alive():
+            self.join()
+        self.sock.close()
+
+    def run(self):
+        while self._running:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            now = monotonic()
+            if self.log is not None:
+                self.log.write(now, data)
+            with instrument.span('telemetry/decode'):
+                packet = decode(data)
+            with self._lock:
+                i = self.count % self._size
+                self._times[i] = now
+                self._packets[i] = packet
+                self.count += 1
+            self.newest = (now, packet)
+
+    def since(self, count):
+        """(count, [(receive time, packet)]) received after the first count packets, as far as the ring reaches"""
+        with self._lock:
+            first = max(count, self.count - self._size)
+            packets = [(self._times[i % self._size], self._packets[i % self._size]) for i in range(first, self.count)]
+            return self.count, packets
+
+    def closest(self, timestamp):
+        """(receive time, packet) received closest to the given monotonic timestamp"""
+        with self._lock:
+            count = self.count
+            if count == 0:
+                return self.newest
+            size = self._size
+            n = min(count, size)
+            first = count - n  # Oldest packet still in the buffer
+            times = self._times
+            lo, hi = first, count - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if times[mid % size] < timestamp:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo > first and timestamp - times[(lo - 1) % size] < times[lo % size] - timestamp:
+                lo -= 1
+            return times[lo % size], self._packets[lo % size]
+
+
+receiver = None
+
+def start(**kwargs):
+    """Start the shared receiver, further calls return the running one"""
+    global receiver
+    if receiver is None:
+        print('Connecting telemetry socket')
+        receiver = Receiver(**kwargs).start()
+    return receiver
+
+def stop():
+    """Stop the shared receiver, nothing is logged after it returns"""
+    global receiver
+    if receiver is not None:
+        receiver.stop()
+        receiver = None
 
 # Get UDP value by it's name
 def get_telemetry_value(name):
-    global returnData  # Access the global variable returnData
-    for x in range(0, len(returnData)): # Do for every item in returnData
-        if returnData[x][0] == name: # If this item matches the name
-            return returnData[x][1] # Return the value of this item
-    return -1 # Nothing found, return -1
+    return start().latest.get(name, -1)
 
 # Run continuously
 def test():
+    start()
     while True:
-        index = 0; # Set starting index
-        data, addr = sock.recvfrom(4096) # Receive value from UDP socket
-        for x in range(0, len(returnData)): # Do for every item in the received array
-            size = 4 if returnData[x][2] == 'f' else 1 # Set size based on if it's a byte or float
-            returnData[x][1] = unpack('<' + returnData[x][2], data[index:index+size])[0] # Add float to the array
-            index += size # Increase starting index with the size
-
-        speed = get_telemetry_value('m_speed')
-        laptime = get_telemetry_value('m_lapTime')
-        gforce_lat = get_telemetry_value('m_gforce_lat')
-        gforce_lon = get_telemetry_value('m_gforce_lon')
-        parsed = 'm_speed:' + str(speed) + ',m_lapTime:' + str(laptime) + ',m_gforce_lat:' + str(gforce_lat) + ',m_gforce_lon:' + str(gforce_lon)
+        packet = receiver.latest
+        parsed = 'm_speed:' + str(packet.m_speed) + ',m_lapTime:' + str(packet.m_lapTime) + ',m_gforce_lat:' + str(packet.m_gforce_lat) + ',m_gforce_lon:' + str(packet.m_gforce_lon)
         print(parsed)
         sleep(0.05)
 
+def bench(packets=100000):
+    """Per-packet cost of the old field-by-field decode versus the compiled one"""
+    data = FULL_LAYOUT.struct.pack(*(float(i) for i in range(len(FIELDS))))
+
+    def decode_per_field(data):
+        values = []
+        index = 0
+        for name, fmt in FIELDS:
+            size = 4 if fmt == 'f' else 1
+            values.append([name, struct.unpack('<' + fmt, data[index:index + size])[0]])
+            index += size
+
+        def lookup(name):
+            for value in values:
+                if value[0] == name:
+                    return value[1]
+            return -1
+        return lookup('m_speed'), lookup('m_lapTime'), lookup('m_gforce_lat'), lookup('m_gforce_lon')
+
+    def decode_compiled(data):
+        packet = decode(data)
+        return packet.m_speed, packet.m_lapTime, packet.m_gforce_lat, packet.m_gforce_lon
+
+    for label, fn in (('per field', decode_per_field), ('compiled', decode_compiled)):
+        start = perf_counter()
+        for _ in range(packets):
+            fn(data)
+        elapsed = perf_counter() - start
+        print('%-10s %8.2f us/packet, %10.0f packets/s' % (label, elapsed / packets * 1e6, packets / elapsed))
+
 
 if __name__ == '__main__':
-    print(get_telemetry_value('m_speed'))
-    #test()
+    from docopt import docopt
+    args = docopt(__doc__)
+    if args['bench']:
+        bench(int(args['--packets']))
+    else:
+        test()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Append-only binary log of raw telemetry datagrams and a UDP replay server for it.
+
+Usage:
+    telemetrylog.py (record) <log>
+    telemetrylog.py (replay) <log> [--speed=<speed>] [--rate=<hz>] [--loop] [--port=<port>]
+    telemetrylog.py (info) <log>
+
+Options:
+    --speed=<speed>  Replay speed multiplier, or max to send as fast as possible [default: 1]
+    --rate=<hz>      Ignore recorded timestamps and send at a fixed rate
+    --loop           Start over at the end of the log
+    --port=<port>    Destination port on 127.0.0.1 [default: 20777]
+"""
+
+import os
+import socket
+import struct
+from time import sleep, monotonic
+
+import numpy as np
+
+import telemetry
+from scheduler import sleep_until
+
+# File header: magic, format version, payload bytes per record
+MAGIC = b'DIRTLOG\0'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+# Record header: monotonic receive time, datagram length. The payload follows, zero padded to the header size
+RECORD = struct.Struct('<dI')
+
+
+def record_dtype(payload_size):
+    """Structured dtype of one record, with every telemetry field that fits in the payload as a float column"""
+    fields = [('t', '<f8'), ('size', '<u4')]
+    layout = telemetry.layout_for(payload_size)
+    fields.extend((name, '<' + fmt) for name, fmt in layout.fields)
+    if payload_size > layout.size:
+        fields.append(('extra', 'V%d' % (payload_size - layout.size)))
+    return np.dtype(fields)
+
+def raw_dtype(payload_size):
+    """Same records as record_dtype with the payload left as raw bytes"""
+    return np.dtype([('t', '<f8'), ('size', '<u4'), ('data', 'V%d' % payload_size)])
+
+
+class LogWriter:
+    """Appends (receive time, datagram) records, reopening an existing log continues it"""
+    def __init__(self, path, payload_size=telemetry.FULL_LAYOUT.size):
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER.size:
+            with open(path, 'rb') as f:
+                payload_size = read_header(f)
+            # Drop a record cut short by a crash, records appended after it would be misaligned
+            record_size = RECORD.size + payload_size
+            whole = HEADER.size + (os.path.getsize(path) - HEADER.size) // record_size * record_size
+            self.file = open(path, 'r+b')
+            self.file.truncate(whole)
+            self.file.seek(whole)
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, VERSION, payload_size))
+        self.payload_size = payload_size
+        self._padding = bytes(payload_size)
+
+    def write(self, timestamp, data):
+        data = data[:self.payload_size]
+        self.file.write(RECORD.pack(timestamp, len(data)))
+        self.file.write(data)
+        self.file.write(self._padding[len(data):])
+
+    def close(self):
+        self.file.close()
+
+
+def read_header(f):
+    magic, version, payload_size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a telemetry log: %s' % f.name)
+    return payload_size
+
+def load(path, raw=False):
+    """
+    Whole log as one structured array, e.g. log['t'] and log['m_speed'] are vectors over the session.
+    raw=True keeps the payload as bytes for replaying. A partially written last record is ignored.
+    """
+    with open(path, 'rb') as f:
+        payload_size = read_header(f)
+        buffer = f.read()
+    dtype = raw_dtype(payload_size) if raw else record_dtype(payload_size)
+    count = len(buffer) // dtype.itemsize
+    return np.frombuffer(buffer, dtype, count)
+
+
+def capture(path, **kwargs):
+    """Log datagrams from the game until interrupted"""
+    writer = LogWriter(path)
+    receiver = telemetry.Receiver(log=writer, **kwargs).start()
+    try:
+        while True:
+            sleep(1)
+            print('Logged', receiver.count, 'packets')
+    except KeyboardInterrupt:
+        pass
+    receiver.stop()
+    writer.close()
+
+def replay(path, ip=telemetry.DIRT_IP, port=telemetry.DIRT_PORT, speed=1.0, rate=None, loop=False):
+    """
+    Send a log to the telemetry port. speed scales the recorded timing, speed=None sends as fast as possible
+    and rate sends at a fixed frequency regardless of the recorded timestamps.
+    """
+    log = load(path, raw=True)
+    if len(log) == 0:
+        print('Empty log')
+        return
+    datagrams = [record['data'].tobytes()[:record['size']] for record in log]
+    offsets = None
+    if rate:
+        offsets = np.arange(len(log)) / float(rate)
+    elif speed:
+        offsets = (log['t'] - log['t'][0]) / speed
+    if offsets is not None:
+        # Gap before starting over when looping, one average packet interval
+        period = offsets[-1] + offsets[-1] / max(len(offsets) - 1, 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = 0
+    start = monotonic()
+    try:
+        while True:
+            lap_start = monotonic()
+            for i, data in enumerate(datagrams):
+                if offsets is not None:
+                    sleep_until(lap_start + offsets[i])
+                sock.sendto(data, (ip, port))
+            sent += len(datagrams)
+            if not loop:
+                break
+            if offsets is not None:
+                sleep_until(lap_start + period)
+    except KeyboardInterrupt:
+        pass
+    elapsed = monotonic() - start
+    print('Sent %d packets in %.2fs, %.0f packets/s' % (sent, elapsed, sent / elapsed if elapsed else 0))
+
+def info(path):
+    log = load(path)
+    print('%d packets, %d bytes each' % (len(log), log.dtype.itemsize - RECORD.size))
+    if len(log) > 1:
+        duration = log['t'][-1] - log['t'][0]
+        print('%.1fs, %.1f packets/s' % (duration, (len(log) - 1) / duration if duration else 0))
+    if 'm_speed' in log.dtype.names and len(log):
+        print('Max speed %.1f km/h' % (log['m_speed'].max() * 3.6))
+    if 'm_lap' in log.dtype.names and len(log):
+        print('Laps', np.unique(log['m_lap']).astype(int).tolist())
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    if args['record']:
+        capture(args['<log>'])
+    elif args['replay']:
+        speed = None if args['--speed'] == 'max' else float(args['--speed'])
+        replay(args['<log>'], port=int(args['--port']), speed=speed,
+               rate=float(args['--rate']) if args['--rate'] else None, loop=args['--loop'])
+    elif args['info']:
+        info(args['<log>'])
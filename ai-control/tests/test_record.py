@@ -0,0 +1,51 @@
+import glob
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import record
+import recorder
+
+
+def frame(value):
+    # Native capture delivers RGB frames at the recorded size
+    return np.full((record.FRAME_SIZE[1], record.FRAME_SIZE[0], 3), value, np.uint8)
+
+def samples(path, count):
+    # Frames 0-2 repeat each other and so do 3-5, every stored frame gets two references
+    return [record.Sample(id, path, record.FRAME_SIZE, frame(100 * (id // 3)), 0.0, 0.0, 0.0, 0.0,
+                          [0.0] * len(record.TELEMETRY_COLUMNS), None, None) for id in range(count)]
+
+
+def test_dropped_frame_is_stored_by_its_first_reference(tmp_path):
+    path = str(tmp_path) + '/'
+    gate = threading.Event()
+    def stalled(sample):
+        gate.wait()
+        record.save_sample(sample)
+
+    dedupe = record.Deduplicator(1.0)
+    writer = recorder.Recorder(stalled, workers=1, maxsize=2, policy=recorder.DROP_OLDEST, on_drop=dedupe.dropped)
+    for sample in samples(path, 6):
+        writer.put(dedupe(sample))
+        # Let the worker take sample 0 and stall on it, later samples wait in the queue
+        while sample.id == 0 and writer.depth:
+            pass
+    gate.set()
+    writer.close()
+
+    # Sample 0 is written, 1 and 2 were dropped, then the stored frame 3 was dropped and handed to 4
+    assert writer.dropped == 3
+    assert writer.errors == 0
+    shots = sorted(os.path.basename(shot) for shot in glob.glob(path + 'shot_*.png'))
+    assert shots == ['shot_0.png', 'shot_4.png']
+    refs = {}
+    for name in glob.glob(path + 'record_*.json'):
+        with open(name) as f:
+            data = json.load(f)
+        refs[int(os.path.basename(name)[len('record_'):-len('.json')])] = data['cam/image_array']
+    assert refs == {0: 'shot_0.png', 4: 'shot_4.png', 5: 'shot_4.png'}
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import sessions
+import streams
+import telemetry
+
+RATE_HZ = 20
+# Lap 0 takes 60.2 s, the tub ends on the last record before the timer resets and lap 1 starts a new tub
+TUBS = [('tub_1', 0, 0.0, 1200, 0.0), ('tub_2', 1, 60.2, 200, 0.05)]
+
+
+def packet(lap, lap_time, last_lap_time):
+    return {'m_lap': lap, 'm_lapTime': lap_time, 'm_last_lap_time': last_lap_time, 'm_sector1_time': 20.0,
+            'm_sector2_time': 40.0, 'm_gforce_lat': 0.1, 'm_gforce_lon': 0.1, 'm_in_pits': 0.0,
+            'm_track_size': 4120.0}
+
+def records(lap, last_lap_time, count, offset):
+    return [(id, packet(lap, offset + id / RATE_HZ, last_lap_time)) for id in range(count)]
+
+def write_tub(path, start, rows):
+    os.makedirs(path)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'inputs': ['telemetry/lap', 'telemetry/lap_time', streams.FRAME_TIME_KEY],
+                   'types': ['float', 'float', 'double']}, f)
+    stream = streams.StreamWriter(path, streams.TELEMETRY, telemetry.FULL_LAYOUT.names)
+    for id, values in rows:
+        time = start + id / RATE_HZ
+        with open(os.path.join(path, 'record_%d.json' % id), 'w') as f:
+            json.dump({'telemetry/lap': values['m_lap'], 'telemetry/lap_time': values['m_lapTime'],
+                       streams.FRAME_TIME_KEY: time}, f)
+        stream.write([time] + [values.get(name, np.nan) for name in telemetry.FULL_LAYOUT.names])
+    stream.close()
+
+def check(laps):
+    first, second = laps
+    assert first['tub'] == 'tub_1' and first['complete']
+    assert abs(first['lap_time'] - 60.2) < 1e-6
+    assert np.allclose(first['sectors'], [20.0, 40.0, 0.2])
+    # Nothing follows the last tub, its lap is still running
+    assert second['tub'] == 'tub_2' and not second['complete']
+    assert len(sessions.select(laps)) == 1
+
+
+def test_writer_finishes_the_last_lap_of_a_tub(tmpdir):
+    writer = sessions.SessionWriter(str(tmpdir))
+    for name, lap, last_lap_time, count, offset in TUBS:
+        writer.start_tub(os.path.join(str(tmpdir), name))
+        for id, values in records(lap, last_lap_time, count, offset):
+            writer.add(id, values)
+    writer.close()
+    check(sessions.load(str(tmpdir))['laps'])
+
+
+def test_build_finishes_the_last_lap_of_a_tub(tmpdir):
+    start = 1000.0
+    for name, lap, last_lap_time, count, offset in TUBS:
+        write_tub(os.path.join(str(tmpdir), name), start, records(lap, last_lap_time, count, offset))
+        start += count / RATE_HZ + 0.5
+    check(sessions.build(str(tmpdir))['laps'])
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Converts PNG + JSON tubs (shot_N.png + record_N.json) into tubfile tubs, one process per tub.
+
+Scalars come from the tub's manifest, the frames are decoded and written in chunks. The list inputs
+the old history.py added (custom/prev_image, custom/angle_array, custom/throttle_array) are left out,
+the history index rebuilds them from the converted records. The shotflipped_N.png +
+recordflipped_N.json copies mirror.py wrote are skipped, augment.py flips frames while training, or
+converted into a tub of their own named <tub>_flipped. A tub history.py wrote into output/ without
+frames of its own gets them from its parent directory.
+
+Conversion is resumable: the tubfile keeps every complete chunk of an interrupted run, the next run
+continues after them. Every converted tub is read back and its record count, frame CRCs and scalar
+columns are compared to the source before it is marked complete in index/convert.json, complete
+tubs are skipped unless their source grew.
+
+Usage:
+    tubconvert.py <tub>... --out=<dir> [--workers=<n>] [--chunk=<n>] [--compress] [--flipped]
+
+Options:
+    --out=<dir>      Directory the converted tubs are written to, under the name of their source
+    --workers=<n>    Tubs converted in parallel [default: 4]
+    --chunk=<n>      Records per tubfile chunk [default: 256]
+    --compress       zlib compress frame chunks
+    --flipped        Also convert the flipped copies of mirror.py
+"""
+import glob
+import json
+import os
+import shutil
+import zlib
+from multiprocessing import Pool
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+
+import history
+import manifest
+import streams
+import tubfile
+
+PROGRESS_FILE = os.path.join(manifest.INDEX_DIR, 'convert.json')
+# CRC32 of every converted frame, appended once its chunk is written
+CRC_FILE = os.path.join(manifest.INDEX_DIR, 'convert_crc.u4')
+FLIPPED_PREFIX = 'recordflipped_'
+FLIPPED_SUFFIX = '_flipped'
+# Meta entries of the source that the tubfile writer sets itself
+WRITER_META = ('inputs', 'types', 'format', 'chunk_size', 'compression')
+
+
+def frame_crc(frame):
+    return zlib.crc32(np.ascontiguousarray(frame))
+
+def target_inputs(meta):
+    """(inputs, types) of the converted tub, history list inputs left out, unsupported types refused"""
+    inputs, types = [], []
+    for key, type in zip(meta['inputs'], meta['types']):
+        if type in history.HISTORY_TYPES:
+            continue
+        if type != tubfile.IMAGE_TYPE and type not in tubfile.COLUMN_TYPES:
+            raise ValueError('Input %s has type %s, a tubfile stores %s' % (
+                key, type, ', '.join([tubfile.IMAGE_TYPE] + sorted(tubfile.COLUMN_TYPES))))
+        inputs.append(key)
+        types.append(type)
+    if types.count(tubfile.IMAGE_TYPE) > 1:
+        raise ValueError('A tubfile stores one image input, the tub has %d' % types.count(tubfile.IMAGE_TYPE))
+    return inputs, types
+
+def read_source(tub_path, flipped=False):
+    """Manifest records of a tub or of its flipped copies, (records, inputs, types, meta)"""
+    meta = manifest.read_meta(tub_path)
+    inputs, types = target_inputs(meta)
+    if not flipped:
+        return manifest.load(tub_path), inputs, types, meta
+    dtype = manifest.manifest_dtype(meta)
+    image_key = inputs[types.index(tubfile.IMAGE_TYPE)] if tubfile.IMAGE_TYPE in types else None
+    ids = manifest.record_ids(tub_path, FLIPPED_PREFIX)
+    return manifest.scan(tub_path, ids, dtype, image_key, FLIPPED_PREFIX + '%d.json'), inputs, types, meta
+
+def frame_path(tub_path, name):
+    path = os.path.join(tub_path, name)
+    if not os.path.exists(path):
+        parent = os.path.join(os.path.dirname(os.path.normpath(tub_path)), name)
+        if os.path.exists(parent):
+            return parent
+    return path
+
+def read_progress(out_path):
+    path = os.path.join(out_path, PROGRESS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_progress(out_path, progress):
+    path = os.path.join(out_path, PROGRESS_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def read_crcs(out_path):
+    path = os.path.join(out_path, CRC_FILE)
+    return np.fromfile(path, '<u4') if os.path.exists(path) else np.empty(0, '<u4')
+
+
+def same_values(a, b):
+    if a.dtype.kind == 'f':
+        return bool(np.all((a == b) | (np.isnan(a) & np.isnan(b))))
+    return np.array_equal(a, b)
+
+def verify(out_path, records, inputs, types, crcs):
+    """Compare a converted tub to its source records and frame CRCs, raises ValueError on the first difference"""
+    reader = tubfile.Reader(out_path)
+    try:
+        if len(reader) != len(records):
+            raise ValueError('%s has %d records, its source %d' % (out_path, len(reader), len(records)))
+        if tubfile.IMAGE_TYPE in types:
+            for position in range(len(reader)):
+                if frame_crc(reader.get_frame(position)) != crcs[position]:
+                    raise ValueError('Frame of record %d of %s differs from its source' % (position, out_path))
+        for key, type in zip(inputs, types):
+            if type == tubfile.IMAGE_TYPE:
+                continue
+            source = records[key]
+            if source.dtype.kind == 'S':
+                source = source.astype(str)
+            if not same_values(source, reader.column(key)):
+                raise ValueError('Column %s of %s differs from its source' % (key, out_path))
+    finally:
+        reader.close()
+
+def convert_tub(tub_path, out_path, chunk_size=256, compress=False, flipped=False):
+    """
+    Convert a PNG + JSON tub to a tubfile tub at out_path, continuing an interrupted conversion.
+    Returns the statistics of the run.
+    """
+    started = perf_counter()
+    records, inputs, types, meta = read_source(tub_path, flipped)
+    source = os.path.abspath(tub_path) + (' (flipped)' if flipped else '')
+    result = {'tub': tub_path, 'out': out_path, 'records': len(records), 'converted': 0, 'source_bytes': 0,
+              'dropped': [key for key in meta['inputs'] if key not in inputs]}
+    progress = read_progress(out_path)
+    if progress.get('source', source) != source:
+        raise ValueError('%s was converted from %s, not %s' % (out_path, progress['source'], source))
+    if not len(records):
+        result['status'] = 'empty'
+        return result
+    if progress.get('complete') and progress.get('records') == len(records):
+        result['status'] = 'up to date'
+        return result
+
+    image_key = inputs[types.index(tubfile.IMAGE_TYPE)] if tubfile.IMAGE_TYPE in types else None
+    same_as = np.arange(len(records))
+    if image_key is not None:
+        # Records recorded as duplicates name the frame of an earlier record
+        first = {}
+        for position, name in enumerate(records[image_key]):
+            same_as[position] = first.setdefault(name, position)
+    extra = {key: value for key, value in meta.items() if key not in WRITER_META}
+    writer = tubfile.Writer(out_path, inputs, types, chunk_size, compress, meta=extra,
+                            dedup=bool(np.any(same_as != np.arange(len(records)))))
+    done = writer.count  # Records of complete chunks from an earlier run
+    if done > len(records):
+        writer.close()
+        raise ValueError('%s has %d records, more than its source %d' % (out_path, done, len(records)))
+    write_progress(out_path, {'source': source, 'records': len(records), 'complete': False})
+
+    crcs = np.zeros(len(records), '<u4')
+    saved = read_crcs(out_path)[:done]
+    crcs[:len(saved)] = saved
+    crc_file = open(os.path.join(out_path, CRC_FILE), 'r+b' if len(saved) else 'wb')
+    crc_file.truncate(len(saved) * 4)
+    crc_file.seek(len(saved) * 4)
+    persisted = len(saved)
+    try:
+        columns = [key for key in inputs if key != image_key]
+        for position in range(persisted, len(records)):
+            row = records[position]
+            frame = None
+            if image_key is not None:
+                if same_as[position] == position:
+                    path = frame_path(tub_path, row[image_key].decode())
+                    frame = np.asarray(Image.open(path))
+                    if writer.frame_shape is not None and frame.shape != writer.frame_shape:
+                        raise ValueError('%s is %s, the tub\'s frames are %s' % (path, frame.shape,
+                                                                                 writer.frame_shape))
+                    crcs[position] = frame_crc(frame)
+                    result['source_bytes'] += os.path.getsize(path)
+                else:
+                    crcs[position] = crcs[same_as[position]]
+            if position < done:
+                continue  # Written by an earlier run, only its CRC was missing
+            record = {key: row[key] for key in columns}
+            if image_key is not None:
+                record[image_key] = frame
+            reference = int(same_as[position]) if same_as[position] != position else None
+            writer.write(record, reference)
+            result['converted'] += 1
+            if writer.pending == 0:
+                crc_file.write(crcs[persisted:writer.count].tobytes())
+                crc_file.flush()
+                persisted = writer.count
+        writer.close()
+        crc_file.write(crcs[persisted:writer.count].tobytes())
+    finally:
+        writer.file.close()
+        crc_file.close()
+
+    verify(out_path, records, inputs, types, crcs)
+    if not flipped and os.path.isdir(os.path.join(tub_path, streams.STREAMS_DIR)):
+        target = os.path.join(out_path, streams.STREAMS_DIR)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.copytree(os.path.join(tub_path, streams.STREAMS_DIR), target)
+    result['seconds'] = perf_counter() - started
+    result['out_bytes'] = os.path.getsize(os.path.join(out_path, tubfile.DATA_FILE))
+    result['resumed_at'] = done
+    result['status'] = 'converted'
+    write_progress(out_path, {'source': source, 'records': len(records), 'complete': True,
+                              'frame_crc': zlib.crc32(crcs.tobytes()), 'dropped': result['dropped']})
+    return result
+
+def _convert(job):
+    try:
+        return convert_tub(*job)
+    except Exception as e:
+        # One broken tub does not stop the others
+        return {'tub': job[0], 'out': job[1], 'status': 'failed', 'error': '%s: %s' % (type(e).__name__, e)}
+
+def convert_all(tub_paths, out_dir, workers=4, chunk_size=256, compress=False, flipped=False):
+    """Convert tubs in a process pool and print each as it finishes, returns the results"""
+    names = [os.path.basename(os.path.normpath(path)) for path in tub_paths]
+    if len(set(names)) != len(names):
+        raise ValueError('Tubs with the same name would be converted to the same directory, convert them one by one')
+    jobs = []
+    for path, name in zip(tub_paths, names):
+        jobs.append((path, os.path.join(out_dir, name), chunk_size, compress, False))
+        if flipped and len(manifest.record_ids(path, FLIPPED_PREFIX)):
+            jobs.append((path, os.path.join(out_dir, name + FLIPPED_SUFFIX), chunk_size, compress, True))
+    started = perf_counter()
+    results = []
+    with Pool(workers) as pool:
+        for result in pool.imap_unordered(_convert, jobs):
+            results.append(result)
+            print(describe(result))
+    elapsed = perf_counter() - started
+    converted = sum(result.get('converted', 0) for result in results)
+    source_bytes = sum(result.get('source_bytes', 0) for result in results)
+    print('%d records converted in %.1f s, %.0f records/s, %.1f MB/s of frames read, %d tubs failed' % (
+        converted, elapsed, converted / elapsed if elapsed else 0, source_bytes / 1e6 / elapsed if elapsed else 0,
+        sum(result['status'] == 'failed' for result in results)))
+    return results
+
+def describe(result):
+    if result['status'] == 'failed':
+        return 'Failed %s: %s' % (result['tub'], result['error'])
+    if result['status'] != 'converted':
+        return '%s %s, %d records' % (result['tub'], result['status'], result['records'])
+    seconds = result['seconds']
+    line = 'Converted %d of %d records of %s to %s in %.1f s, %.0f records/s, %.1f MB of frames -> %.1f MB' % (
+        result['converted'], result['records'], result['tub'], result['out'], seconds,
+        result['converted'] / seconds if seconds else 0, result['source_bytes'] / 1e6, result['out_bytes'] / 1e6)
+    if result['resumed_at']:
+        line += ', resumed at %d' % result['resumed_at']
+    if result['dropped']:
+        line += ', left out %s' % ', '.join(result['dropped'])
+    return line
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    tubs = [path for pattern in args['<tub>'] for path in sorted(glob.glob(pattern))
+            if os.path.isfile(os.path.join(path, 'meta.json')) and not tubfile.is_tubfile(path)]
+    results = convert_all(tubs, args['--out'], int(args['--workers']), int(args['--chunk']), args['--compress'],
+                          args['--flipped'])
+    if any(result['status'] == 'failed' for result in results):
+        raise SystemExit(1)
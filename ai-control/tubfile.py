@@ -0,0 +1,299 @@
+"""
+Chunked single-file tub format.
+
+A tub directory holds meta.json (same inputs/types as the PNG + JSON tubs) and one data file:
+    header: magic, version, JSON length, JSON describing the frame key, frame shape and columns
+    chunks: chunk header, then up to chunk_size frames as one uint8 block (optionally zlib compressed),
+            then every non-image input as a column of chunk count values
+Chunks are appended as they fill up, so a recording cut short loses at most the last partial chunk.
+Uncompressed frames are read as views into a memory map of the file.
+Tubs written with dedup have a FRAME_REF column with the index of the record whose frame each record
+shows, chunks then only store the frames of records that reference themselves.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+DATA_FILE = 'data.tub'
+FORMAT = 'tubfile'
+
+MAGIC = b'TUBFILE\0'
+VERSION = 2
+READ_VERSIONS = (1, 2)  # Version 1 has no frame references
+HEADER = struct.Struct('<8sII')  # magic, version, header JSON bytes
+CHUNK = struct.Struct('<4sIQQ')  # magic, records, stored frame bytes, column bytes
+CHUNK_MAGIC = b'CHNK'
+ALIGN = 64  # Blocks start at 64 byte offsets so memory mapped views are aligned
+
+# Meta type -> column dtype
+COLUMN_TYPES = {
+    'float': '<f4',
+    'double': '<f8',  # Monotonic timestamps
+    'int': '<i4',
+    'str': 'S16',
+}
+IMAGE_TYPE = 'image_array'
+FRAME_REF = 'frame_ref'
+
+
+def is_tubfile(path):
+    return os.path.exists(os.path.join(path, DATA_FILE))
+
+def _padding(position):
+    return (-position) % ALIGN
+
+
+class Writer:
+    """
+    Appends records (dicts of input key -> value, the frame as an HxWxC uint8 array) to a tub.
+    Frames are copied into a preallocated chunk buffer and written out chunk_size at a time.
+    dedup allows write(record, same_as) to reuse the frame of an earlier record.
+    """
+    def __init__(self, path, inputs, types, chunk_size=256, compress=False, frame_shape=None, meta=None,
+                 dedup=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.frame_key = None
+        self.columns = []
+        for key, type in zip(inputs, types):
+            if type == IMAGE_TYPE:
+                self.frame_key = key
+            else:
+                self.columns.append((key, COLUMN_TYPES[type]))
+        os.makedirs(path, exist_ok=True)
+        self.count = 0
+        data_path = os.path.join(path, DATA_FILE)
+        self.file = open(data_path, 'ab')
+        self._header_written = self.file.tell() > 0
+        if self._header_written:
+            # Continue an existing tub, dropping a partially written last chunk
+            reader = Reader(path)
+            frame_shape = reader.frame_shape
+            self.compress = reader.compressed
+            dedup = reader.frame_ref is not None
+            end = reader.end
+            self.count = len(reader)
+            reader.close()
+            self.file.truncate(end)
+        tub_meta = dict(meta or {})  # Extra meta.json entries
+        tub_meta.update({'inputs': list(inputs), 'types': list(types), 'format': FORMAT,
+                         'chunk_size': chunk_size, 'compression': 'zlib' if self.compress else None})
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(tub_meta, f)
+        self.dedup = dedup
+        if dedup:
+            self.columns.append((FRAME_REF, '<i4'))
+        self.frame_shape = tuple(frame_shape) if frame_shape else None
+        self._frames = None
+        self._values = {key: np.empty(chunk_size, dtype) for key, dtype in self.columns}
+        self.pending = 0
+        self.stored = 0  # Frames in the pending chunk
+
+    def _write_header(self):
+        header = json.dumps({'frame_key': self.frame_key, 'frame_shape': self.frame_shape,
+                             'columns': self.columns, 'compressed': self.compress,
+                             'frame_ref': FRAME_REF if self.dedup else None}).encode()
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(header)))
+        self.file.write(header)
+        self.file.write(bytes(_padding(HEADER.size + len(header))))
+        self._header_written = True
+
+    def write(self, record, same_as=None):
+        """same_as: index of an earlier record whose frame this one shows, its own frame is not stored"""
+        if same_as is not None:
+            if not self.dedup:
+                raise ValueError('Frame references need a tub written with dedup')
+            if not 0 <= same_as < self.count:
+                raise ValueError('Record %d references frame %d of %d' % (self.count, same_as, self.count))
+        elif self.frame_key is not None:
+            frame = record[self.frame_key]
+            if self._frames is None:
+                if self.frame_shape is None:
+                    self.frame_shape = frame.shape
+                self._frames = np.empty((self.chunk_size,) + self.frame_shape, np.uint8)
+            self._frames[self.stored] = frame
+            self.stored += 1
+        if self.dedup:
+            self._values[FRAME_REF][self.pending] = self.count if same_as is None else same_as
+        for key, _ in self.columns:
+            if key != FRAME_REF:
+                self._values[key][self.pending] = record[key]
+        self.pending += 1
+        self.count += 1
+        if self.pending == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write out the pending partial chunk"""
+        if self.pending == 0:
+            return
+        if not self._header_written:
+            self._write_header()
+        n = self.pending
+        frames = self._frames[:self.stored].tobytes() if self._frames is not None else b''
+        if self.compress:
+            frames = zlib.compress(frames, 1)
+        columns = b''.join(self._values[key][:n].tobytes() for key, _ in self.columns)
+        self.file.write(CHUNK.pack(CHUNK_MAGIC, n, len(frames), len(columns)))
+        self.file.write(bytes(_padding(CHUNK.size)))
+        self.file.write(frames)
+        self.file.write(bytes(_padding(len(frames))))
+        self.file.write(columns)
+        self.file.write(bytes(_padding(len(columns))))
+        self.file.flush()
+        self.pending = 0
+        self.stored = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Reader:
+    """
+    Random access to a tub written by Writer. get_record(i) returns the same keys as the JSON records,
+    with the frame as an array instead of a file name.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.inputs = self.meta['inputs']
+        self.file = open(os.path.join(path, DATA_FILE), 'rb')
+        self._map = None
+        self.frame_key = None
+        self.frame_shape = None
+        self.compressed = False
+        self.columns = []
+        self.frame_ref = None
+        self._cached_chunk = (None, None)
+        self._column_cache = {}
+        self.refresh()
+
+    def refresh(self):
+        """Pick up chunks appended since the tub was opened"""
+        size = os.fstat(self.file.fileno()).st_size
+        self.starts = []
+        self.chunks = []
+        self.count = 0
+        self.end = 0
+        self._refs = None
+        self._cached_chunk = (None, None)
+        self._column_cache = {}
+        if size == 0:
+            return
+        # The old map is released once no frame views point into it
+        self._map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version not in READ_VERSIONS:
+            raise ValueError('Not a tub data file: %s' % self.file.name)
+        header = json.loads(self._map[HEADER.size:HEADER.size + header_size].decode())
+        self.frame_key = header['frame_key']
+        self.frame_shape = tuple(header['frame_shape']) if header['frame_shape'] else None
+        self.columns = [(key, np.dtype(dtype)) for key, dtype in header['columns']]
+        self.compressed = header['compressed']
+        self.frame_ref = header.get('frame_ref')
+
+        position = HEADER.size + header_size
+        position += _padding(position)
+        while position + CHUNK.size <= size:
+            magic, n, frame_bytes, column_bytes = CHUNK.unpack_from(self._map, position)
+            if magic != CHUNK_MAGIC:
+                break
+            frames_at = position + CHUNK.size + _padding(CHUNK.size)
+            columns_at = frames_at + frame_bytes + _padding(frame_bytes)
+            end = columns_at + column_bytes + _padding(column_bytes)
+            if columns_at + column_bytes > size:
+                break  # Partially written last chunk
+            self.starts.append(self.count)
+            self.chunks.append((n, frames_at, frame_bytes, columns_at))
+            self.count += n
+            position = end
+        self.end = position
+        if self.frame_ref is not None and self.chunks:
+            # Position of every stored frame in its chunk's frame block
+            self._refs = self.column(self.frame_ref).astype(np.int64)
+            stored = self._refs == np.arange(self.count)
+            before = np.cumsum(stored) - stored
+            self._slots = before - np.repeat(before[self.starts], [n for n, _, _, _ in self.chunks])
+
+    def __len__(self):
+        return self.count
+
+    def _locate(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('Record %d out of range' % index)
+        chunk = bisect.bisect_right(self.starts, index) - 1
+        return chunk, index - self.starts[chunk]
+
+    def chunk_frames(self, chunk):
+        """All frames of a chunk as an (n, H, W, C) array, a view into the file unless compressed"""
+        cached_chunk, frames = self._cached_chunk
+        if cached_chunk == chunk:
+            return frames
+        n, frames_at, frame_bytes, _ = self.chunks[chunk]
+        if self.compressed:
+            frames = np.frombuffer(zlib.decompress(self._map[frames_at:frames_at + frame_bytes]), np.uint8)
+        else:
+            frames = np.frombuffer(self._map, np.uint8, frame_bytes, frames_at)
+        frames = frames.reshape((-1,) + self.frame_shape)
+        self._cached_chunk = (chunk, frames)
+        return frames
+
+    def get_frame(self, index):
+        chunk, offset = self._locate(index)
+        if self._refs is None:
+            return self.chunk_frames(chunk)[offset]
+        index = int(self._refs[self.starts[chunk] + offset])  # The record that stored the frame
+        chunk, _ = self._locate(index)
+        return self.chunk_frames(chunk)[self._slots[index]]
+
+    def chunk_column(self, chunk, key):
+        n, _, _, offset = self.chunks[chunk]
+        for column, dtype in self.columns:
+            if column == key:
+                return np.frombuffer(self._map, dtype, n, offset)
+            offset += n * dtype.itemsize
+        raise KeyError(key)
+
+    def column(self, key):
+        """Every value of a non-image input as one array"""
+        values = self._column_cache.get(key)
+        if values is None:
+            dtype = dict(self.columns)[key]
+            if self.chunks:
+                values = np.concatenate([self.chunk_column(chunk, key) for chunk in range(len(self.chunks))])
+            else:
+                values = np.empty(0, dtype)
+            if dtype.kind == 'S':
+                values = values.astype(str)
+            self._column_cache[key] = values
+        return values
+
+    def get_record(self, index):
+        chunk, offset = self._locate(index)
+        record = {}
+        if self.frame_key is not None:
+            record[self.frame_key] = self.get_frame(index)
+        for key, dtype in self.columns:
+            value = self.chunk_column(chunk, key)[offset]
+            record[key] = value.decode() if dtype.kind == 'S' else value.item()
+        return record
+
+    def close(self):
+        self._cached_chunk = (None, None)
+        self._column_cache = {}
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # Frames handed out are still in use, the map goes with them
+        self.file.close()
@@ -0,0 +1,91 @@
+"""
+On-the-fly batch augmentation for training, replaces the flipped copies mirror.py wrote to disk.
+
+Every transformation is drawn once per sample and applied the same way to all of the sample's
+frames (cam/image_array and cam/prev_images) and angles (user/angle and history/angle).
+"""
+import collections
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import instrument
+
+IMAGE_TYPES = ('image_array', 'custom/prev_image')
+ANGLE_KEYS = ('user/angle', 'history/angle')
+
+
+class Augmenter:
+    """
+    flip: probability of a horizontal flip, which also negates the angles
+    brightness: maximum relative brightness change, 0.2 scales pixels by 0.8 - 1.2
+    shift: maximum horizontal shift in pixels, edges are repeated
+    Random draws come from seed and the batch number only, so runs repeat exactly whatever the worker timing.
+    """
+    def __init__(self, input_keys, output_keys, meta, flip=0.5, brightness=0.0, shift=0, seed=0):
+        self.image_inputs = [i for i, key in enumerate(input_keys) if meta.get(key) in IMAGE_TYPES]
+        self.angle_inputs = [i for i, key in enumerate(input_keys) if key in ANGLE_KEYS]
+        self.angle_outputs = [i for i, key in enumerate(output_keys) if key in ANGLE_KEYS]
+        self.flip = flip
+        self.brightness = brightness
+        self.shift = shift
+        self.seed = seed
+
+    def __call__(self, batch_number, batch):
+        inputs, outputs = batch
+        n = len(inputs[0])
+        rng = np.random.RandomState((self.seed, batch_number))
+        flipped = rng.rand(n) < self.flip
+        factors = 1 + rng.uniform(-self.brightness, self.brightness, n) if self.brightness else None
+        shifts = rng.randint(-self.shift, self.shift + 1, n) if self.shift else None
+
+        inputs = list(inputs)
+        outputs = list(outputs)
+        for i in self.image_inputs:
+            inputs[i] = self._images(inputs[i], flipped, factors, shifts)
+        if flipped.any():
+            for values, indices in ((inputs, self.angle_inputs), (outputs, self.angle_outputs)):
+                for i in indices:
+                    values[i] = np.array(values[i], np.float32)
+                    values[i][flipped] *= -1
+        return inputs, outputs
+
+    def _images(self, images, flipped, factors, shifts):
+        """images are (n, H, W, C), or (n, k, H, W, C) for a window of previous frames, width is axis -2"""
+        images = np.array(images)  # Batch arrays may be shared with the loader
+        if flipped.any():
+            images[flipped] = images[flipped][..., ::-1, :]
+        if shifts is not None:
+            n = len(images)
+            height, width = images.shape[-3:-1]
+            # Every frame of a window shifts alike, the axes between batch and frame are gathered as one
+            frames = images.reshape((n, -1) + images.shape[-3:])
+            columns = np.clip(np.arange(width) - shifts[:, None], 0, width - 1)
+            frames = frames[np.arange(n)[:, None, None, None], np.arange(frames.shape[1])[None, :, None, None],
+                            np.arange(height)[None, None, :, None], columns[:, None, None, :]]
+            images = frames.reshape(images.shape)
+        if factors is not None:
+            scaled = images * factors.reshape((-1,) + (1,) * (images.ndim - 1)).astype(np.float32)
+            if images.dtype == np.uint8:
+                scaled = np.clip(scaled, 0, 255)  # Normalised frames are float already
+            images = scaled.astype(images.dtype)
+        return images
+
+
+def augmented(batches, augmenter, workers=2):
+    """
+    Augment a batch generator on a thread pool, NumPy releases the GIL for the heavy work.
+    Batches come out in order, with one batch per worker in flight.
+    """
+    def augment(number, batch):
+        with instrument.span('train/augment'):
+            return augmenter(number, batch)
+
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    for number, batch in enumerate(batches):
+        pending.append(pool.apply_async(augment, (number, batch)))
+        if len(pending) > workers:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
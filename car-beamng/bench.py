@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Headless benchmarks of the recording, training and driving hot paths.
+
+Everything runs on synthetic data: generated frames and tubs, a fake telemetry UDP sender, the fake
+capture library, a stub model and a stub joystick, so this runs on Linux without the game.
+Results are written as JSON. Given a baseline from an earlier run, metrics ending in _per_sec that
+dropped or metrics ending in _ms that grew by more than the threshold (and a millisecond) fail the run.
+
+Usage:
+    bench.py [--out=<path>] [--baseline=<path>] [--threshold=<percent>] [--only=<names>] [--quick]
+
+Options:
+    --out=<path>            Write results to this JSON file [default: bench.json]
+    --baseline=<path>       Compare against the results of an earlier run
+    --threshold=<percent>   Allowed regression against the baseline [default: 10]
+    --only=<names>          Comma separated benchmarks to run: telemetry, recorder, loader, drive, instrument
+    --quick                 Smaller runs, for a smoke test rather than numbers
+"""
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep, strftime
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ai-control'))
+import capture
+import instrument
+import preprocess
+import record
+import recorder
+import telemetry
+
+import dataset
+import engine
+import loader
+
+BENCHMARKS = ('telemetry', 'recorder', 'loader', 'drive', 'instrument')
+INPUTS = ['cam/image_array', 'cam/prev_images', 'history/angle', 'history/throttle']
+OUTPUTS = ['user/angle', 'user/throttle']
+MIN_REGRESSION_MS = 1.0  # Latencies must also grow this much, sub-millisecond stages are all noise
+
+
+def synthetic_frame(i, size=record.FRAME_SIZE):
+    # A gradient that moves per frame compresses like a game frame, unlike noise
+    width, height = size
+    x = np.arange(width, dtype=np.uint16)[None, :]
+    y = np.arange(height, dtype=np.uint16)[:, None]
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[:, :, 0] = x + i
+    frame[:, :, 1] = y + 2 * i
+    frame[:, :, 2] = (x + y) // 2
+    return frame
+
+def synthetic_telemetry(i):
+    # A 50 s lap at 20 frames per second, record.TELEMETRY_COLUMNS order
+    return (float(i // 1000), i % 1000 / 20.0, 0.5, 0.2, 0.0)
+
+def synthetic_packet(i):
+    values = [float(i % 1000)] * len(telemetry.FULL_LAYOUT.fields)
+    return telemetry.FULL_LAYOUT.struct.pack(*values)
+
+
+def bench_telemetry(quick):
+    packets = 20000 if quick else 200000
+    data = [synthetic_packet(i) for i in range(256)]
+    start = perf_counter()
+    for i in range(packets):
+        telemetry.decode(data[i & 255])
+    decode_time = perf_counter() - start
+
+    # Fake game: blast datagrams at a receiver on localhost
+    sent = 5000 if quick else 50000
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    receiver = telemetry.Receiver('127.0.0.1', port).start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = perf_counter()
+    for i in range(sent):
+        sender.sendto(data[i & 255], ('127.0.0.1', port))
+        if i % 64 == 63:
+            sleep(0)  # Let the receiver thread run, the game sends in bursts too
+    sleep(0.2)
+    elapsed = perf_counter() - start - 0.2
+    receiver.stop()
+    sender.close()
+    return {
+        'decode_packets_per_sec': packets / decode_time,
+        'decode_us': decode_time / packets * 1e6,
+        'udp_received_per_sec': receiver.count / elapsed,
+        'udp_loss': 1 - receiver.count / sent,
+    }
+
+
+def record_frames(handler, workers, frames, path):
+    sink = recorder.Recorder(handler, workers=workers, maxsize=64, policy=recorder.BLOCK)
+    pixels = [synthetic_frame(i) for i in range(32)]
+    start = perf_counter()
+    for i in range(frames):
+        sink.put(record.Sample(i, path, record.FRAME_SIZE, pixels[i & 31], 50.0, 0.1, 0.5, 0.0, synthetic_telemetry(i),
+                               None, i / 20.0))
+    sink.close()
+    if hasattr(handler, 'close'):
+        handler.close()
+    return frames / (perf_counter() - start)
+
+def bench_recorder(quick, workdir):
+    frames = 200 if quick else 2000
+    results = {}
+    for name, handler, workers in (('png', record.save_sample, 2),
+                                   ('tub', record.TubSink(), 1),
+                                   ('tub_compressed', record.TubSink(compress=True), 1)):
+        path = os.path.join(workdir, 'record_' + name) + '/'
+        os.makedirs(path)
+        if name == 'png':
+            with open(path + 'meta.json', 'w') as f:
+                json.dump({'inputs': record.INPUTS, 'types': record.TYPES}, f)
+        results[name + '_frames_per_sec'] = record_frames(handler, workers, frames, path)
+    return results
+
+
+def make_tub(path, records, format):
+    os.makedirs(path)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'inputs': record.INPUTS, 'types': record.TYPES}, f)
+    if format == 'tub':
+        handler = record.TubSink()
+    else:
+        handler = record.save_sample
+    for i in range(records):
+        handler(record.Sample(i, path + '/', record.FRAME_SIZE, synthetic_frame(i), 50.0,
+                              np.sin(i / 20.0), 0.5, 0.0, synthetic_telemetry(i), None, i / 20.0))
+    if format == 'tub':
+        handler.close()
+
+def loader_samples_per_sec(data, batches, batch_size, workers, cache_path=None):
+    batch_loader = loader.BatchLoader(data, dataset.TRAIN, batch_size, workers=workers, prefetch=2 * max(workers, 1),
+                                      cache_path=cache_path)
+    iterator = iter(batch_loader)
+    next(iterator)  # Worker start-up is not throughput
+    start = perf_counter()
+    for _ in range(batches):
+        next(iterator)
+    elapsed = perf_counter() - start
+    iterator.close()
+    return batches * batch_size / elapsed
+
+def bench_loader(quick, workdir):
+    records = 300 if quick else 2000
+    batches = 5 if quick else 40
+    batch_size = 32 if quick else 64
+    workers = min(4, os.cpu_count() or 1)
+    results = {'workers': workers}
+    for format in ('png', 'tub'):
+        path = os.path.join(workdir, 'loader_' + format)
+        make_tub(path, records, format)
+        start = perf_counter()
+        data = dataset.Dataset([path], INPUTS, OUTPUTS)
+        results['%s_index_ms' % format] = (perf_counter() - start) * 1000
+        results['%s_samples_per_sec' % format] = loader_samples_per_sec(data, batches, batch_size, 0)
+        results['%s_workers_samples_per_sec' % format] = loader_samples_per_sec(data, batches, batch_size, workers)
+        if format == 'png':
+            cache_path = os.path.join(workdir, 'cache')
+            loader_samples_per_sec(data, records // batch_size + 1, batch_size, 0, cache_path)  # Fill
+            results['png_cached_samples_per_sec'] = loader_samples_per_sec(data, batches, batch_size, 0, cache_path)
+    return results
+
+
+def bench_drive(quick, inference_ms=5.0):
+    library = capture.default_library()
+    if not os.path.exists(library):
+        return {'skipped': 'no capture library at %s, build dxgi-screen-capture/fake-msc' % library}
+    loops = 60 if quick else 400
+    model = np.random.RandomState(0).rand(120 * 160 * 3).astype(np.float32)
+
+    def stub_pilot(image, prev_image, angle_history, throttle_history):
+        # Touches every pixel like a first layer would, then sleeps for the rest of the inference time
+        start = perf_counter()
+        value = float(np.dot(image.reshape(-1).astype(np.float32), model[:image.size]))
+        sleep(max(0.0, inference_ms / 1000 - (perf_counter() - start)))
+        return np.tanh(value), 0.5
+
+    stages = [record.RECORD_PREPROCESS, preprocess.Preprocess(size=(160, 120))]
+    session = capture.NativeCapture(library, stages=stages).init()
+    joystick = engine.StubJoystick()
+    # A fast capture keeps frame age from depending on how the capture and drive clocks line up
+    drive_engine = engine.DriveEngine(stub_pilot, session, joystick, rate_hz=20, capture_hz=240,
+                                      report_every=float('inf'))
+    drive_engine.run(max_loops=loops)
+    session.close()
+    latency = drive_engine.latency.stats()
+    loop = drive_engine.loop.stats()
+    results = {
+        'loop_rate_per_sec': loop['rate_hz'],
+        'missed_ticks': loop['missed'],
+        'commands': joystick.updates,
+    }
+    for name, _, _ in engine.INTERVALS:
+        results['%s_p50_ms' % name] = latency[name]['p50']
+        results['%s_p99_ms' % name] = latency[name]['p99']
+    return results
+
+
+def bench_instrument(quick, workdir):
+    spans = 20000 if quick else 200000
+
+    def spans_per_sec():
+        start = perf_counter()
+        for _ in range(spans):
+            with instrument.span('bench'):
+                pass
+        return spans / (perf_counter() - start)
+
+    results = {'disabled_spans_per_sec': spans_per_sec()}
+    instrument.configure(workdir, 'bench', interval=0.5)
+    try:
+        results['enabled_spans_per_sec'] = spans_per_sec()
+    finally:
+        instrument.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(names, quick):
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    results = {}
+    try:
+        for name in names:
+            print('Running', name)
+            if name == 'telemetry':
+                results[name] = bench_telemetry(quick)
+            elif name == 'recorder':
+                results[name] = bench_recorder(quick, workdir)
+            elif name == 'loader':
+                results[name] = bench_loader(quick, workdir)
+            elif name == 'drive':
+                results[name] = bench_drive(quick)
+            elif name == 'instrument':
+                results[name] = bench_instrument(quick, workdir)
+            for metric, value in sorted(results[name].items()):
+                print('    %-36s %s' % (metric, '%.3f' % value if isinstance(value, float) else value))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'commit': git_commit(),
+        'time': strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'results': results,
+    }
+
+def regressions(current, baseline, threshold):
+    """(benchmark, metric, baseline, current) of every metric worse than threshold (a fraction)"""
+    worse = []
+    for name, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            base = baseline.get('results', {}).get(name, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or base <= 0:
+                continue
+            if metric.endswith('_per_sec') and value < base * (1 - threshold):
+                worse.append((name, metric, base, value))
+            elif metric.endswith('_ms') and value > base * (1 + threshold) and value - base > MIN_REGRESSION_MS:
+                worse.append((name, metric, base, value))
+    return worse
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    names = args['--only'].split(',') if args['--only'] else BENCHMARKS
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit('Unknown benchmarks %s, use %s' % (', '.join(unknown), ', '.join(BENCHMARKS)))
+    result = run(names, args['--quick'])
+    with open(args['--out'], 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print('Results written to', args['--out'])
+    if args['--baseline']:
+        with open(args['--baseline'], 'r') as f:
+            baseline = json.load(f)
+        threshold = float(args['--threshold']) / 100
+        worse = regressions(result, baseline, threshold)
+        for name, metric, base, value in worse:
+            print('REGRESSION %s %s: %.3f -> %.3f (%+.1f%%)' % (name, metric, base, value, (value / base - 1) * 100))
+        if worse:
+            sys.exit(1)
+        print('No regressions over %s%% against %s (%s)' % (args['--threshold'], args['--baseline'],
+                                                          baseline.get('commit')))
@@ -22,6 +22,7 @@ MODELS_PATH = os.path.join(CAR_PATH, 'models')
 
 #VEHICLE
 DRIVE_LOOP_HZ = 20
+DRIVE_CAPTURE_HZ = 60  # Screen capture runs on its own thread, inference takes the newest frame
 MAX_LOOPS = 100000
 
 #CAMERA
@@ -42,6 +43,40 @@ THROTTLE_REVERSE_PWM = 310
 #TRAINING
 BATCH_SIZE = 128
 TRAIN_TEST_SPLIT = 0.8
+DATASET_SEED = 0  # Seeds the train / validation split and the per epoch shuffle
+
+#HISTORY (model inputs, shared by training and driving, retrain after changing)
+IMAGE_HISTORY_WINDOW = 1  # Previous frames
+SENSOR_HISTORY_WINDOW = 10  # Previous angles and throttles
+
+#TRIMMING (standstill, crash, pit and out lap records found by ai-control/segment.py are not trained on)
+TRIM_RECORDINGS = True
+
+#LABEL ALIGNMENT (tubs with recorded streams, labels are resampled at the frame grab time plus the lead)
+LABEL_LEAD_SEC = 0.0  # Positive takes the controls after the frame, None keeps the labels as recorded
+LABEL_MODE = 'linear'  # nearest, linear or hold
+
+#PREPROCESSING (model input, applied to the recorded frames, saved with the model for driving)
+PREPROCESS_CROP = (0, 0, 0, 0)  # Pixels cut off (top, bottom, left, right)
+PREPROCESS_SIZE = None  # (width, height) to resize to, None keeps the recorded size
+PREPROCESS_COLOR = 'rgb'  # rgb, gray or yuv
+PREPROCESS_NORMALIZE = None  # None keeps uint8 pixels, unit for 0 - 1, signed for -1 - 1
+
+#FRAME CACHE (training, disable with --no_cache)
+CACHE_PATH = os.path.join(CAR_PATH, 'cache')
+CACHE_MEMORY_MB = 1024  # Decoded frames kept in memory per tub, the rest are read from the disk cache
+
+#LOADER (training batches are decoded in worker processes)
+LOADER_WORKERS = 4  # 0 decodes on the training thread
+LOADER_PREFETCH = 8  # Batches decoded ahead of the trainer
+LOADER_REPORT_EVERY = 100  # Print samples/s and queue wait every n batches, 0 to disable
+
+#AUGMENTATION (training batches only)
+AUGMENT_FLIP = 0.5  # Probability of a horizontal flip with negated angles
+AUGMENT_BRIGHTNESS = 0.0  # Maximum relative brightness change
+AUGMENT_SHIFT = 0  # Maximum horizontal shift in pixels
+AUGMENT_SEED = 0
+AUGMENT_WORKERS = 2
 
 
 #JOYSTICK
@@ -0,0 +1,197 @@
+"""
+Training data spanning any number of tubs.
+
+All records with a full history window form one global index of (tub, position) pairs. Every record
+is assigned to train or validation by a draw seeded with its tub's name, so the split stays the same
+across runs and a tub that grows keeps the split of its older records. The training records are
+shuffled per epoch from the seed and the epoch number.
+"""
+import glob
+import json
+import os
+import zlib
+
+import numpy as np
+
+import history
+import manifest
+import preprocess
+import segment
+import sessions
+import streams
+
+TRAIN = 'train'
+VALIDATION = 'validation'
+
+
+def expand_tubs(tub_names):
+    """
+    Tub directories of a comma separated list of paths and wildcards, in order without duplicates.
+    Recording sessions stand for their tubs.
+    """
+    tubs = []
+    for pattern in tub_names.split(','):
+        pattern = os.path.expanduser(pattern.strip())
+        if not pattern:
+            continue
+        for path in sessions.expand(sorted(glob.glob(pattern))):
+            if os.path.isfile(os.path.join(path, 'meta.json')) and path not in tubs:
+                tubs.append(path)
+    return tubs
+
+def read_tub_meta(path):
+    with open('%s/meta.json' % path, 'r') as f:
+        return json.load(f)
+
+def get_meta(path):
+    with open('%s/meta.json' % path, 'r') as f:
+        meta = json.load(f)
+        meta_dict = {}
+        for i, key in enumerate(meta['inputs']):
+            meta_dict[key] = meta['types'][i]
+        # History inputs come from the tub's history index
+        for key, type in zip(history.HISTORY_INPUTS, history.HISTORY_TYPES):
+            meta_dict.setdefault(key, type)
+        return meta_dict
+
+
+class Dataset:
+    """
+    tubs: tub directories, see expand_tubs()
+    image_window, sensor_window: history depths, records without a full window are left out
+    stage: preprocess.Preprocess the model's frames go through after the recording stage, None for none
+    trim: leave out the records segment.py marks (standstill, crashes, pits)
+    label_lead, label_mode: labels are resampled from the recorded streams label_lead seconds after each
+    frame was grabbed, see streams.relabel(). None keeps the labels as recorded
+    laps: only train on these laps, entries of sessions.find_laps(), None for all records
+    Raises ValueError if a tub lacks one of the keys, stores it as another type than the first tub or
+    was recorded with another preprocessing stage.
+    """
+    def __init__(self, tubs, input_keys, output_keys, train_split=0.8, seed=0,
+                 image_window=history.IMAGE_HISTORY_WINDOW, sensor_window=history.SENSOR_HISTORY_WINDOW, stage=None,
+                 trim=True, label_lead=None, label_mode=streams.LINEAR, laps=None):
+        if not tubs:
+            raise ValueError('No tubs to train on')
+        self.tubs = list(tubs)
+        self.input_keys = input_keys
+        self.output_keys = output_keys
+        self.seed = seed
+        self.image_window = image_window
+        self.sensor_window = sensor_window
+        self.meta = self._validate([get_meta(tub) for tub in self.tubs])
+        self.record_stage = self._record_stage()
+        self.stage = stage
+        if label_mode not in streams.MODES:
+            raise ValueError('Unknown resampling mode %s, use one of %s' % (label_mode, ', '.join(streams.MODES)))
+        self.label_lead = label_lead
+        self.label_mode = label_mode
+
+        self.excluded = 0
+        self.unselected = 0
+        self.laps = laps
+        tub_numbers, positions, train = [], [], []
+        for number, tub in enumerate(self.tubs):
+            tub_positions = history.load_index(tub, image_window, sensor_window).positions()
+            # Splits are drawn before trimming and lap selection, so neither changes a record's split
+            keep = np.ones(len(tub_positions), bool)
+            if trim:
+                keep &= ~segment.load(tub).exclude()[tub_positions]
+                self.excluded += len(tub_positions) - np.count_nonzero(keep)
+            if laps is not None:
+                selected = self._lap_records(tub, manifest.load(tub)[manifest.ID_FIELD][tub_positions])
+                self.unselected += np.count_nonzero(keep & ~selected)
+                keep &= selected
+            rng = np.random.RandomState((seed, zlib.crc32(os.path.basename(os.path.normpath(tub)).encode())))
+            tub_train = rng.rand(len(tub_positions)) < train_split
+            tub_positions = tub_positions[keep]
+            tub_numbers.append(np.full(len(tub_positions), number, np.int32))
+            positions.append(tub_positions)
+            train.append(tub_train[keep])
+        self.tub_numbers = np.concatenate(tub_numbers)
+        self.positions = np.concatenate(positions).astype(np.int64)
+        train = np.concatenate(train)
+        self.splits = {TRAIN: np.flatnonzero(train), VALIDATION: np.flatnonzero(~train)}
+        self._epoch = (None, None, None)
+
+    def _lap_records(self, tub, ids):
+        """Which of a tub's record ids are in one of the selected laps"""
+        selected = np.zeros(len(ids), bool)
+        for lap in self.laps:
+            if os.path.normpath(lap['path']) == os.path.normpath(tub):
+                selected |= (ids >= lap['first']) & (ids <= lap['last'])
+        return selected
+
+    def _validate(self, metas):
+        keys = self.input_keys + self.output_keys
+        common = {}
+        for tub, meta in zip(self.tubs, metas):
+            missing = [key for key in keys if key not in meta]
+            if missing:
+                raise ValueError('Tub %s has no %s' % (tub, ', '.join(missing)))
+            for key in keys:
+                if common.setdefault(key, meta[key]) != meta[key]:
+                    raise ValueError('Tub %s stores %s as %s, %s has it as %s' % (
+                        tub, key, meta[key], self.tubs[0], common[key]))
+        return common
+
+    def _record_stage(self):
+        # Frames of one model input must all have gone through the same stage
+        stages = [preprocess.tub_stage(read_tub_meta(tub)) for tub in self.tubs]
+        for tub, stage in zip(self.tubs, stages):
+            if stage != stages[0]:
+                raise ValueError('Tub %s was recorded with %r, %s with %r' % (tub, stage, self.tubs[0], stages[0]))
+        return stages[0]
+
+    def model_meta(self):
+        """What drive needs to feed the model frames like these, saved next to the model"""
+        return {
+            'preprocess': [stage.to_meta() for stage in (self.record_stage, self.stage) if stage is not None],
+            'image_window': self.image_window,
+            'label_lead': self.label_lead,
+            'sensor_window': self.sensor_window,
+            'inputs': self.input_keys,
+            'outputs': self.output_keys,
+        }
+
+    def __len__(self):
+        return len(self.positions)
+
+    def count(self, split):
+        return len(self.splits[split])
+
+    def epoch(self, split, number):
+        """Global index order of one epoch, training records are shuffled per epoch"""
+        if self._epoch[:2] == (split, number):
+            return self._epoch[2]
+        order = self.splits[split]
+        if split == TRAIN:
+            order = order[np.random.RandomState((self.seed, number)).permutation(len(order))]
+        self._epoch = (split, number, order)
+        return order
+
+    def batch(self, split, batch_size, number):
+        """(tub numbers, positions) of batch number, batches run on from one epoch into the next"""
+        count = self.count(split)
+        if not count:
+            raise ValueError(self.empty_split(split))
+        offsets = number * batch_size + np.arange(batch_size)
+        epochs = offsets // count
+        records = np.empty(batch_size, np.int64)
+        for epoch in np.unique(epochs):
+            selected = epochs == epoch
+            records[selected] = self.epoch(split, int(epoch))[offsets[selected] % count]
+        return self.tub_numbers[records], self.positions[records]
+
+    def empty_split(self, split):
+        """Why a split has no records, for the error raised when batches of it are asked for"""
+        if not len(self):
+            return 'No records in split %s, the %d tubs have none left after the history window, trimming and ' \
+                   'lap selection' % (split, len(self.tubs))
+        return 'No records in split %s of %d records, check TRAIN_TEST_SPLIT' % (split, len(self))
+
+    def summary(self):
+        line = '%d tubs, %d records, %d train, %d validation, %d trimmed' % (
+            len(self.tubs), len(self), self.count(TRAIN), self.count(VALIDATION), self.excluded)
+        if self.laps is not None:
+            line += ', %d laps selected, %d records outside them' % (len(self.laps), self.unselected)
+        return line
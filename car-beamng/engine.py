@@ -0,0 +1,285 @@
+"""
+Threaded drive engine: capture, inference and actuation each run on their own thread.
+
+The grabber thread keeps one persistent capture session and always holds the newest RGB frame.
+The inference loop runs at the drive rate on whatever frame is newest when it ticks, and hands
+its command to the actuator thread, which writes it to the joystick as soon as it arrives.
+Every frame carries timestamps of its stages so glass-to-joystick latency can be reported.
+"""
+import threading
+from time import monotonic
+
+import numpy as np
+
+import history
+import instrument
+import scheduler
+
+# Timestamps of a frame's stages, in order
+STAGES = ('captured', 'converted', 'picked', 'inferred', 'actuated')
+# Reported intervals between stages
+INTERVALS = (
+    ('convert', 'captured', 'converted'),
+    ('wait', 'converted', 'picked'),
+    ('inference', 'picked', 'inferred'),
+    ('actuate', 'inferred', 'actuated'),
+    ('total', 'captured', 'actuated'),
+)
+
+
+class VJoy:
+    """vJoy device, throttle 0 - 1 on the RZ axis and steering -1 - 1 on the RX axis"""
+    def __init__(self, device=1):
+        import pyvjoy
+        self.pyvjoy = pyvjoy
+        self.device = pyvjoy.VJoyDevice(device)
+
+    def set_throttle(self, value):
+        scaledValue = int(1 + (value * (0x8000 - 1)))
+        self.device.set_axis(self.pyvjoy.HID_USAGE_RZ, scaledValue)
+
+    def set_steering(self, value):
+        scaledValue = int(((1 + value) / 2) * 0x8000)
+        self.device.set_axis(self.pyvjoy.HID_USAGE_RX, scaledValue)
+
+
+class StubJoystick:
+    """Stands in for vJoy where there is none, keeps the last values"""
+    def __init__(self):
+        self.throttle = 0.0
+        self.steering = 0.0
+        self.updates = 0
+
+    def set_throttle(self, value):
+        self.throttle = value
+        self.updates += 1
+
+    def set_steering(self, value):
+        self.steering = value
+
+
+class LatencyStats:
+    """Stage timestamps of the last history frames, intervals reported as percentiles in milliseconds"""
+    def __init__(self, history=1024):
+        self._stamps = np.zeros((history, len(STAGES)))
+        self._size = history
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, stamps):
+        with self._lock:
+            self._stamps[self.count % self._size] = stamps
+            self.count += 1
+
+    def stats(self):
+        with self._lock:
+            stamps = self._stamps[:min(self.count, self._size)].copy()
+        result = {'frames': self.count}
+        if len(stamps):
+            for name, start, end in INTERVALS:
+                values = (stamps[:, STAGES.index(end)] - stamps[:, STAGES.index(start)]) * 1000
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                result[name] = {'p50': p50, 'p95': p95, 'p99': p99, 'max': values.max()}
+        return result
+
+    def report(self):
+        stats = self.stats()
+        if 'total' not in stats:
+            return 'no frames actuated'
+        return ', '.join('%s p50 %.1f p99 %.1f' % (name, stats[name]['p50'], stats[name]['p99'])
+                         for name, _, _ in INTERVALS) + ' ms'
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Captures from a NativeCapture or MssCapture session at up to rate_hz and keeps the newest converted frame
+    in a pair of buffers. Frames the screen did not change for are not published again.
+    """
+    def __init__(self, session, rate_hz=60):
+        super().__init__(daemon=True)
+        self.session = session
+        self.loop = scheduler.LoopScheduler(rate_hz)
+        self.number = 0
+        self.error = None
+        self._buffers = [np.empty(session.shape, session.dtype) for _ in range(2)]
+        self._stamps = (0.0, 0.0)
+        self._condition = threading.Condition()
+        self._running = True
+
+    def start(self):
+        super().start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self.join()
+
+    def run(self):
+        try:
+            while self._running:
+                self.loop.tick()
+                frames = self.session.frames
+                frame = self.session.grab()
+                captured = monotonic()
+                if self.session.frames == frames:
+                    continue
+                # Readers copy the published buffer under the lock, this one is free to write
+                with instrument.span('capture/convert'):
+                    self.session.convert(frame, self._buffers[(self.number + 1) % 2])
+                converted = monotonic()
+                with self._condition:
+                    self.number += 1
+                    self._stamps = (captured, converted)
+                    self._condition.notify_all()
+        except Exception as e:
+            self.error = e
+            with self._condition:
+                self._condition.notify_all()
+
+    def newest(self, after, out, timeout=1.0):
+        """Copy the newest frame into out once there is one newer than frame number after"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.number > after or self.error is not None, timeout)
+            if self.error is not None:
+                raise self.error
+            if self.number <= after:
+                return None, None
+            np.copyto(out, self._buffers[self.number % 2])
+            return self.number, self._stamps
+
+
+class Actuator(threading.Thread):
+    """Writes the newest (angle, throttle) command to the joystick, older pending commands are dropped"""
+    def __init__(self, joystick, latency):
+        super().__init__(daemon=True)
+        self.joystick = joystick
+        self.latency = latency
+        self.dropped = 0
+        self._command = None
+        self._condition = threading.Condition()
+        self._running = True
+
+    def start(self):
+        super().start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self.join()
+
+    def submit(self, angle, throttle, stamps):
+        with self._condition:
+            if self._command is not None:
+                self.dropped += 1
+            self._command = (angle, throttle, stamps)
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._command is not None or not self._running)
+                if not self._running:
+                    return
+                angle, throttle, stamps = self._command
+                self._command = None
+            with instrument.span('drive/actuate'):
+                self.joystick.set_throttle(throttle)
+                self.joystick.set_steering(angle)
+            stamps[STAGES.index('actuated')] = monotonic()
+            self.latency.add(stamps)
+
+
+class DriveEngine:
+    """
+    pilot(image, prev_images, angle_history, throttle_history) returns (angle, throttle), like the
+    model's run(). Inference ticks at rate_hz so the history windows keep the recording rate.
+    The inputs are views into ring buffers, valid until the pilot returns.
+    """
+    def __init__(self, pilot, session, joystick, rate_hz=20, capture_hz=60, image_window=history.IMAGE_HISTORY_WINDOW,
+                 sensor_window=history.SENSOR_HISTORY_WINDOW, report_every=5.0):
+        self.pilot = pilot
+        self.session = session
+        self.joystick = joystick
+        self.rate_hz = rate_hz
+        self.latency = LatencyStats()
+        self.grabber = FrameGrabber(session, capture_hz)
+        self.actuator = Actuator(joystick, self.latency)
+        self.loop = scheduler.LoopScheduler(rate_hz)
+        # The newest frame and image_window previous ones
+        self.frames = history.RingHistory(image_window + 1, session.shape, session.dtype)
+        self.throttle_history = history.RingHistory(sensor_window)
+        self.angle_history = history.RingHistory(sensor_window)
+        self.report_every = report_every
+        self.stale = 0
+
+    def run(self, max_loops=None):
+        self.grabber.start()
+        self.actuator.start()
+        number = 0
+        rounds = 0
+        reported = monotonic()
+        try:
+            while max_loops is None or rounds < max_loops:
+                self.loop.tick()
+                with instrument.span('drive/frame_wait'):
+                    newest, frame_stamps = self.grabber.newest(number, self.frames.slot())
+                if newest is None:
+                    self.stale += 1  # No new frame within the timeout
+                    continue
+                self.frames.commit()
+                stamps = np.zeros(len(STAGES))
+                stamps[:2] = frame_stamps
+                stamps[STAGES.index('picked')] = monotonic()
+                if self.frames.full():
+                    angle, throttle = self.infer()
+                    stamps[STAGES.index('inferred')] = monotonic()
+                    self.actuator.submit(angle, throttle, stamps)
+                number = newest
+                rounds += 1
+                if monotonic() - reported >= self.report_every:
+                    print(self.report())
+                    reported = monotonic()
+        finally:
+            self.grabber.stop()
+            self.actuator.stop()
+
+    def infer(self):
+        """Run the pilot on the frame ring and push its command into the sensor histories"""
+        frames = self.frames.window()
+        with instrument.span('drive/inference'):
+            angle, throttle = self.pilot(frames[-1], history.prev_images_input(frames[:-1]),
+                                         self.angle_history.window(), self.throttle_history.window())
+        self.throttle_history.push(throttle)
+        self.angle_history.push(angle)
+        return angle, throttle
+
+    def run_lockstep(self, max_loops=None):
+        """
+        Grab, convert, infer and actuate one frame after the other on the calling thread, without
+        pacing. Every grab() is used, so with a replayed capture the commands only depend on the
+        frames and the pilot. Runs until max_loops or until the session raises.
+        """
+        rounds = 0
+        while max_loops is None or rounds < max_loops:
+            frame = self.session.grab()
+            stamps = np.zeros(len(STAGES))
+            stamps[STAGES.index('captured')] = monotonic()
+            with instrument.span('capture/convert'):
+                self.session.convert(frame, self.frames.slot())
+            self.frames.commit()
+            stamps[STAGES.index('converted')] = stamps[STAGES.index('picked')] = monotonic()
+            if self.frames.full():
+                angle, throttle = self.infer()
+                stamps[STAGES.index('inferred')] = monotonic()
+                with instrument.span('drive/actuate'):
+                    self.joystick.set_throttle(throttle)
+                    self.joystick.set_steering(angle)
+                stamps[STAGES.index('actuated')] = monotonic()
+                self.latency.add(stamps)
+            rounds += 1
+
+    def report(self):
+        return '%s | %d frames, %d stale ticks, %d commands dropped | %s' % (
+            self.loop.report(), self.grabber.number, self.stale, self.actuator.dropped, self.latency.report())
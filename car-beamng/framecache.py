@@ -0,0 +1,122 @@
+"""
+Decoded frame cache for training, so only the first epoch pays for PNG decoding.
+
+Frames of a PNG + JSON tub are decoded once into a uint8 memmap under cfg.CACHE_PATH, one file per
+tub keyed by its absolute path. The memmap is invalidated when the tub's record count or the mtime of
+its newest frame changes. A memory-bounded LRU of decoded arrays sits in front of the memmap.
+Tubfile tubs are already stored decoded and are not cached.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+class FrameCache:
+    """
+    ids are the sorted ids of the tub's frames, image_name formats an id into its frame file name
+    and load_image decodes a frame file into an array.
+    """
+    def __init__(self, tub_path, ids, image_name, load_image, cache_path, memory_bytes=1 << 30):
+        self.tub_path = tub_path
+        self.ids = np.asarray(ids)
+        self.image_name = image_name
+        self.load_image = load_image
+        self.memory_bytes = memory_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lru = collections.OrderedDict()
+        self._lru_bytes = 0
+        self._lock = threading.Lock()
+
+        key = hashlib.sha1(os.path.abspath(tub_path).encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_path, key)
+        os.makedirs(self.path, exist_ok=True)
+        self.version = self._tub_version()
+        self.frames = None
+        self.filled = None
+        meta = self._read_meta()
+        if meta is not None and meta['version'] == self.version:
+            self._open(tuple(meta['shape']), 'r+')
+
+    def _tub_version(self):
+        if len(self.ids) == 0:
+            return [0, -1, 0]
+        last = int(self.ids[-1])
+        return [len(self.ids), last, os.path.getmtime(os.path.join(self.tub_path, self.image_name % last))]
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _open(self, shape, mode):
+        count = len(self.ids)
+        frames = np.memmap(os.path.join(self.path, 'frames.u8'), np.uint8, mode, shape=(count,) + shape)
+        self.filled = np.memmap(os.path.join(self.path, 'filled.u8'), np.uint8, mode, shape=(count,))
+        self.frames = frames  # Last, other threads check frames before touching filled
+
+    def _create(self, shape):
+        self._open(shape, 'w+')
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'tub': os.path.abspath(self.tub_path), 'version': self.version, 'shape': list(shape)}, f)
+
+    def _remember(self, position, frame):
+        with self._lock:
+            self._lru[position] = frame
+            self._lru_bytes += frame.nbytes
+            while self._lru_bytes > self.memory_bytes and self._lru:
+                _, evicted = self._lru.popitem(last=False)
+                self._lru_bytes -= evicted.nbytes
+
+    def get(self, id):
+        position = int(np.searchsorted(self.ids, id))
+        with self._lock:
+            frame = self._lru.get(position)
+            if frame is not None:
+                self._lru.move_to_end(position)
+                self.hits += 1
+                return frame
+        if self.filled is not None and self.filled[position]:
+            frame = np.array(self.frames[position])
+            self.hits += 1
+        else:
+            frame = self.load_image(os.path.join(self.tub_path, self.image_name % id))
+            if self.frames is None:
+                with self._lock:
+                    if self.frames is None:
+                        self._create(frame.shape)
+            self.frames[position] = frame
+            self.filled[position] = 1
+            self.misses += 1
+        self._remember(position, frame)
+        return frame
+
+    def warm(self, workers=4):
+        """Decode every frame not cached yet"""
+        missing = self.ids if self.filled is None else self.ids[self.filled == 0]
+        if len(missing):
+            self.get(missing[0])  # Creates the memmap before the workers race for it
+            pool = ThreadPool(workers)
+            pool.map(self._fill, missing[1:], chunksize=64)
+            pool.close()
+        self.flush()
+        return len(missing)
+
+    def _fill(self, id):
+        # Warm-up must not push the training working set out of the LRU
+        position = int(np.searchsorted(self.ids, id))
+        if not self.filled[position]:
+            self.frames[position] = self.load_image(os.path.join(self.tub_path, self.image_name % id))
+            self.filled[position] = 1
+
+    def flush(self):
+        if self.frames is not None:
+            self.frames.flush()
+            self.filled.flush()
@@ -3,79 +3,90 @@
 Scripts to drive a donkey 2 car and train a model for it.
 
 Usage:
-    joystick.py (drive) [--model=<model>]
-    joystick.py (reset)
-    joystick.py (throttle)
-    joystick.py (steering)
+    joystick.py (drive) [--model=<model>] [--stub] [--mss] [--profile=<dir>]
+    joystick.py (reset) [--stub]
+    joystick.py (throttle) [--stub]
+    joystick.py (steering) [--stub]
 
+Options:
+    --stub           Drive a stub instead of the vJoy device, with the fake capture library this runs on Linux
+    --mss            Capture with mss instead of the native capture, which is also the fallback when it fails
+    --profile=<dir>  Time capture, conversion, inference and actuation into histograms exported as JSON lines
+                     and a Chrome trace in this directory, see instrument.py
 """
 import os
-import numpy
+import sys
 
 from docopt import docopt
-from PIL import Image
-from time import sleep, time
-import mss
-import pyvjoy
-import collections
+from time import sleep
 
+import donkeycar as dk
 #import parts
 from donkeycar.parts.keras import KerasCategorical
 
-j = pyvjoy.VJoyDevice(1)
+# Loop timing and capture are shared with the recorder in ai-control
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ai-control'))
+import capture
+import engine
+import instrument
+import preprocess
+
+j = None
 
 def setThrottle(value):
-    scaledValue = int(1 + (value * (0x8000 - 1)))
-    j.set_axis(pyvjoy.HID_USAGE_RZ, scaledValue)
+    j.set_throttle(value)
 def setSteering(value):
-    scaledValue = int(((1 + value) / 2) * 0x8000)
-    j.set_axis(pyvjoy.HID_USAGE_RX, scaledValue)
+    j.set_steering(value)
 
-def captureScreen(sct):
-    img = sct.grab(sct.monitors[1])
-    img = Image.frombytes("RGB", img.size, img.bgra, "raw", "BGRX")
-    return img.resize((160, 120))
-    
+def model_setup(model_path, stage, image_window, sensor_window):
+    """Preprocessing stages and history windows the model was trained with, the given ones for older models"""
+    meta = preprocess.load_model_meta(model_path) if model_path else None
+    if meta is None:
+        print('No training metadata for %s, assuming legacy recordings and the configured stage' % model_path)
+        return [preprocess.LEGACY_RECORD, stage], image_window, sensor_window
+    # The first stage is the recording's, it holds the screen region the model was trained on
+    stages = [preprocess.record_stage(meta['preprocess'][0])] + \
+             [preprocess.Preprocess.from_meta(stage_meta) for stage_meta in meta['preprocess'][1:]]
+    return stages, meta['image_window'], meta['sensor_window']
 
-def drive(model_path=None):
+def drive(model_path=None, rate_hz=20, capture_hz=60, stage=None, image_window=1, sensor_window=10, profile=None,
+          open_capture=None, vjoy=None, lockstep=False, max_loops=None, native=True):
+    """
+    Drive with a model. open_capture(stages) returns an initialised capture session, by default a
+    NativeCapture, or an MssCapture without native or when the native capture fails. vjoy replaces the
+    global joystick. lockstep runs DriveEngine.run_lockstep() instead of the threaded loop. Returns
+    the engine for its statistics.
+    """
     kl = KerasCategorical()
     if model_path:
         kl.load(model_path)
     print('Model loaded')
-    # testImage = Image.open('test.png');
-    # testImage = numpy.array(testImage)
-    
-    throttle_history = collections.deque(maxlen=10)
-    angle_history = collections.deque(maxlen=10)
-    for i in range(10):
-        throttle_history.append(0)
-        angle_history.append(0)
-    print(len(throttle_history))    
-    print(len(angle_history))
-    round = 0
-    while True:
-        with mss.mss() as sct:
-            image = captureScreen(sct)
-            image = numpy.array(image)
-            if (round > 0):
-                angle, throttle = kl.run(image, prevImage, numpy.array(angle_history), numpy.array(throttle_history))
-
-                # print('Raw throttle', throttle)
-                # throttle = min(0.8, max(0.1, throttle * 3000000))
-                
 
-                setThrottle(throttle)
-                setSteering(angle)
-                #s = input(">>")
-                #if len(s) >= 1: 
-                #    break
-                # if (round % 100 == 0):
-                # print(throttle, angle)
-                throttle_history.append(throttle)
-                angle_history.append(angle)
-                
-            prevImage = image
-            round = round + 1
+    stages, image_window, sensor_window = model_setup(model_path, stage, image_window, sensor_window)
+    print('Preprocessing', ', '.join(repr(stage) for stage in stages))
+    if open_capture is None:
+        session = capture.open_session(stages, native)
+    else:
+        session = open_capture(stages)
+    print('Capturing %dx%d at up to %d Hz, driving at %d Hz' % (session.width, session.height, capture_hz, rate_hz))
+    drive_engine = engine.DriveEngine(kl.run, session, vjoy or j, rate_hz=rate_hz, capture_hz=capture_hz,
+                                      image_window=image_window, sensor_window=sensor_window)
+    if profile:
+        print('Profiling stages to', instrument.configure(profile, 'drive'))
+    try:
+        if lockstep:
+            drive_engine.run_lockstep(max_loops)
+        else:
+            drive_engine.run(max_loops)
+    except capture.CaptureFinished:
+        print('Capture finished')
+    finally:
+        print(drive_engine.report())
+        session.close()
+        if profile:
+            print(instrument.report())
+            instrument.close()
+    return drive_engine
 
         #V.add(kl, inputs=['cam/image_array'],
         #          outputs=['pilot/angle', 'pilot/throttle'],
@@ -85,6 +96,7 @@ def drive(model_path=None):
 if __name__ == '__main__':
     try:
         args = docopt(__doc__)
+        j = engine.StubJoystick() if args['--stub'] else engine.VJoy(1)
         if args['throttle']:
             print("Pressing throttle")
             while (True):
@@ -107,11 +119,19 @@ if __name__ == '__main__':
             setThrottle(0)
             setSteering(0)
             print("Starting driving")
-            drive(model_path = args['--model'])
+            cfg = dk.load_config()
+            drive(model_path = args['--model'], rate_hz = cfg.DRIVE_LOOP_HZ, capture_hz = cfg.DRIVE_CAPTURE_HZ,
+                  stage = preprocess.Preprocess(cfg.PREPROCESS_CROP, cfg.PREPROCESS_SIZE, cfg.PREPROCESS_COLOR,
+                                                cfg.PREPROCESS_NORMALIZE),
+                  image_window = cfg.IMAGE_HISTORY_WINDOW,
+                  sensor_window = cfg.SENSOR_HISTORY_WINDOW,
+                  profile = args['--profile'],
+                  native = not args['--mss'])
         elif args['reset']:
             setThrottle(0)
             setSteering(0)
     except Exception as e:
-        setThrottle(0)
-        setSteering(0)
+        if j is not None:
+            setThrottle(0)
+            setSteering(0)
         raise(e)
@@ -0,0 +1,310 @@
+"""
+Prefetching batch loader for training.
+
+Worker processes take whole batches of record positions, decode them (PNG or tubfile) and write
+the samples straight into preallocated batch arrays in shared memory. The trainer gets the batches
+in order, with up to prefetch batches decoded ahead of it.
+"""
+import multiprocessing
+import queue
+import traceback
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+
+import framecache
+import history
+import instrument
+import manifest
+import preprocess
+import streams
+import tubfile
+
+
+def load_image(path):
+    img = Image.open(path)
+    return np.array(img)
+
+def load_frame(tub_path, id, reader=None, cache=None):
+    if reader is not None:
+        return reader.get_frame(id)
+    if cache is not None:
+        return cache.get(id)
+    return load_image("%s/%s" % (tub_path, history.IMAGE_NAME % id))
+
+
+class SampleReader:
+    """
+    Reads (inputs, outputs) of one tub by history index position. cache_path enables the frame cache
+    for PNG + JSON tubs, tubfile tubs are read through their memory map. Frames go through stage, a
+    preprocess.Preprocess, after they are read, the cache keeps them as recorded. Unless label_lead is
+    None, labels and sensor history are resampled from the tub's streams first.
+    """
+    def __init__(self, tub_path, input_keys, output_keys, meta, cache_path=None, cache_bytes=1 << 30,
+                 image_window=history.IMAGE_HISTORY_WINDOW, sensor_window=history.SENSOR_HISTORY_WINDOW, stage=None,
+                 label_lead=None, label_mode=streams.LINEAR):
+        self.tub_path = tub_path
+        self.input_keys = input_keys
+        self.output_keys = output_keys
+        self.input_types = [meta[key] for key in input_keys]
+        self.reader = tubfile.Reader(tub_path) if tubfile.is_tubfile(tub_path) else None
+        self.records = manifest.load(tub_path)
+        if label_lead is not None:
+            self.records = streams.relabel(tub_path, self.records, label_lead, label_mode)
+        self.index = history.index_from_manifest(self.records, image_window, sensor_window)
+        self.cache = None
+        if cache_path and self.reader is None:
+            self.cache = framecache.FrameCache(tub_path, np.unique(self.index.frames), history.IMAGE_NAME, load_image,
+                                               cache_path, cache_bytes)
+        self.stage = stage if stage is not None and not stage.is_identity() else None
+        self.pipeline = None
+
+    def frames(self, frames):
+        """Frames (..., H, W, C) through the stage"""
+        if self.stage is None:
+            return frames
+        if self.pipeline is None:
+            self.pipeline = preprocess.compile(np.shape(frames)[-3:], self.stage)
+        return self.pipeline.batch(frames)
+
+    def sample(self, position):
+        # Positions index the tub's manifest, the history index provides the history inputs
+        record = manifest.record(self.records, position)
+        record.update(self.index.window(position))
+        inputs = [record.get(key) for key in self.input_keys]
+        outputs = [record[key] for key in self.output_keys]
+        for i, type in enumerate(self.input_types):
+            if type == 'image_array':
+                inputs[i] = self.frames(load_frame(self.tub_path, self.index.frames[position], self.reader, self.cache))
+            elif type == 'custom/prev_image':
+                frames = [load_frame(self.tub_path, id, self.reader, self.cache) for id in inputs[i]]
+                inputs[i] = self.frames(history.prev_images_input(frames))
+        return inputs, outputs
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        if self.cache is not None:
+            self.cache.flush()
+
+
+class DatasetReader:
+    """SampleReaders of a dataset's tubs, opened as batches first touch them"""
+    def __init__(self, dataset, cache_path=None, cache_bytes=1 << 30):
+        self.dataset = dataset
+        self.cache_path = cache_path
+        self.cache_bytes = cache_bytes
+        self.readers = {}
+
+    def reader(self, tub_number):
+        if tub_number not in self.readers:
+            self.readers[tub_number] = SampleReader(self.dataset.tubs[tub_number], self.dataset.input_keys,
+                                                    self.dataset.output_keys, self.dataset.meta, self.cache_path,
+                                                    self.cache_bytes, self.dataset.image_window,
+                                                    self.dataset.sensor_window, self.dataset.stage,
+                                                    self.dataset.label_lead, self.dataset.label_mode)
+        return self.readers[tub_number]
+
+    def sample(self, tub_number, position):
+        return self.reader(tub_number).sample(position)
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+
+
+class Slot:
+    """One batch worth of input and output arrays, in shared memory when shared is set"""
+    def __init__(self, batch_size, sample, shared=False):
+        self.buffers = []
+        self.arrays = []
+        for value in sample[0] + sample[1]:
+            value = np.asarray(value)
+            shape = (batch_size,) + value.shape
+            nbytes = int(np.prod(shape)) * value.dtype.itemsize
+            buffer = multiprocessing.RawArray('B', nbytes) if shared else bytearray(nbytes)
+            self.buffers.append(buffer)
+            self.arrays.append(np.frombuffer(buffer, value.dtype).reshape(shape))
+        self.inputs = len(sample[0])
+
+    @staticmethod
+    def attach(buffers, specs):
+        slot = Slot.__new__(Slot)
+        slot.buffers = buffers
+        slot.arrays = [np.frombuffer(buffer, dtype).reshape(shape) for buffer, (dtype, shape) in zip(buffers, specs)]
+        slot.inputs = None
+        return slot
+
+    def specs(self):
+        return [(array.dtype, array.shape) for array in self.arrays]
+
+    def fill(self, samples, tub_numbers, positions):
+        for row, (tub_number, position) in enumerate(zip(tub_numbers, positions)):
+            inputs, outputs = samples.sample(tub_number, position)
+            for array, value in zip(self.arrays, inputs + outputs):
+                array[row] = value
+
+    def batch(self):
+        """Copy of the batch, Keras queues batches of its own so the slot must not leak out"""
+        arrays = [np.array(array) for array in self.arrays]
+        return arrays[:self.inputs], arrays[self.inputs:]
+
+
+def _worker(dataset, split, batch_size, cache_args, slots, specs, jobs, done):
+    try:
+        samples = DatasetReader(dataset, *cache_args)
+        slots = [Slot.attach(buffers, specs) for buffers in slots]
+    except Exception:
+        done.put((None, None, traceback.format_exc()))
+        return
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        number, slot = job
+        start = perf_counter()
+        try:
+            slots[slot].fill(samples, *dataset.batch(split, batch_size, number))
+        except Exception:
+            done.put((number, slot, traceback.format_exc()))
+            continue
+        done.put((number, slot, perf_counter() - start))
+    samples.close()
+
+
+class BatchLoader:
+    """
+    Endless (inputs, outputs) batches of one split of a dataset.Dataset.
+    workers: decoding processes, 0 decodes on the calling thread
+    prefetch: batches decoded ahead of the trainer, at least workers to keep all of them busy
+    """
+    def __init__(self, dataset, split, batch_size, workers=4, prefetch=8, cache_path=None, cache_bytes=1 << 30):
+        self.dataset = dataset
+        self.split = split
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch = max(prefetch, workers, 1)
+        if not dataset.count(split):
+            raise ValueError(dataset.empty_split(split))
+        # The main process creates the frame caches before workers open them
+        self.samples = DatasetReader(dataset, cache_path, cache_bytes)
+        for tub_number in np.unique(dataset.tub_numbers):
+            first = np.argmax(dataset.tub_numbers == tub_number)
+            sample = self.samples.sample(tub_number, dataset.positions[first])
+        if workers:
+            self.samples.close()
+            self.samples = None
+        self.slots = [Slot(batch_size, sample, shared=workers > 0) for _ in range(self.prefetch if workers else 1)]
+        self.cache_args = (cache_path, cache_bytes // max(workers, 1))
+        self.processes = []
+        self._ready = {}
+        self.batches = 0
+        self.started = None
+        self.waited = 0.0
+        self.busy = 0.0
+
+    def start(self):
+        if not self.workers:
+            return self
+        self.jobs = multiprocessing.Queue()
+        self.done = multiprocessing.Queue()
+        buffers = [slot.buffers for slot in self.slots]
+        for _ in range(self.workers):
+            process = multiprocessing.Process(target=_worker, args=(
+                self.dataset, self.split, self.batch_size, self.cache_args, buffers, self.slots[0].specs(), self.jobs,
+                self.done))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        for slot in range(len(self.slots)):
+            self.jobs.put((slot, slot))
+        return self
+
+    def __iter__(self):
+        self.start()
+        self.started = perf_counter()
+        try:
+            while True:
+                yield self._next()
+        finally:
+            self.close()
+
+    def _next(self):
+        number = self.batches
+        if not self.workers:
+            start = perf_counter()
+            self.slots[0].fill(self.samples, *self.dataset.batch(self.split, self.batch_size, number))
+            self.busy += perf_counter() - start
+            instrument.add('train/batch', perf_counter() - start, start)
+            self.batches += 1
+            return self.slots[0].batch()
+        start = perf_counter()
+        while number not in self._ready:
+            finished, slot, result = self._get()
+            if isinstance(result, str):
+                raise RuntimeError('Loader worker failed:\n%s' % result)
+            self.busy += result
+            # Decoded in a worker process, in the histograms but not on this process's trace
+            instrument.add('train/batch', result)
+            self._ready[finished] = slot
+        self.waited += perf_counter() - start
+        instrument.add('train/wait', perf_counter() - start, start)
+        slot = self._ready.pop(number)
+        batch = self.slots[slot].batch()
+        self.jobs.put((number + len(self.slots), slot))
+        self.batches += 1
+        return batch
+
+    def _get(self):
+        while True:
+            try:
+                return self.done.get(timeout=1.0)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError('Loader worker exited unexpectedly')
+
+    def close(self):
+        for _ in self.processes:
+            self.jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        if self.samples is not None:
+            self.samples.close()
+
+    def stats(self):
+        """Throughput and where the trainer's time went, waiting on the queue means training is I/O-bound"""
+        elapsed = perf_counter() - self.started if self.started is not None else 0.0
+        samples = self.batches * self.batch_size
+        return {
+            'batches': self.batches,
+            'samples': samples,
+            'samples_per_sec': samples / elapsed if elapsed else 0.0,
+            'wait_sec': self.waited,
+            'wait_fraction': self.waited / elapsed if elapsed else 0.0,
+            'decode_ms_per_batch': self.busy / self.batches * 1000 if self.batches else 0.0,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return '%d batches, %.0f samples/s, waited %.1f s (%.0f%%), %.1f ms decode/batch' % (
+            stats['batches'], stats['samples_per_sec'], stats['wait_sec'], stats['wait_fraction'] * 100,
+            stats['decode_ms_per_batch'])
+
+
+def batches(loader, report_every=0):
+    """Iterate a loader, printing its report every report_every batches"""
+    for number, batch in enumerate(loader, 1):
+        if report_every and number % report_every == 0:
+            print(loader.report())
+        yield batch
+
+def timed(batches, name):
+    """Pass batches through, timing how long the consumer works on each one as stage name"""
+    for batch in batches:
+        start = perf_counter()
+        yield batch
+        instrument.add(name, perf_counter() - start, start)
@@ -4,15 +4,22 @@ Scripts to drive a donkey 2 car and train a model for it.
 
 Usage:
     manage.py (drive) [--model=<model>] [--js] [--chaos]
-    manage.py (train) [--tub=<tub1,tub2,..tubn>]  (--model=<model>) [--base_model=<base_model>] [--no_cache]
+    manage.py (train) [--tub=<tub1,tub2,..tubn>]  (--model=<model>) [--base_model=<base_model>] [--no_cache] [--profile=<dir>] [--laps=<query>]
+    manage.py (cache) [--tub=<tub1,tub2,..tubn>]
 
 Options:
     -h --help        Show this screen.
     --tub TUBPATHS   List of paths to tubs. Comma separated. Use quotes to use wildcards. ie "~/tubs/*"
     --js             Use physical joystick.
     --chaos          Add periodic random steering when manually driving
+    --no_cache       Decode every frame from its PNG each epoch instead of using the frame cache
+    --profile=<dir>  Time batch decoding, waiting, augmentation and training steps into histograms exported as
+                     JSON lines and a Chrome trace in this directory, see instrument.py
+    --laps=<query>   Only train on the laps a query selects from the session indexes, like
+                     "track=track_4120,fastest=20,clean", see ai-control/sessions.py
 """
 import os
+import sys
 from docopt import docopt
 
 import donkeycar as dk
@@ -26,11 +33,24 @@ from donkeycar.parts.datastore import TubGroup, TubWriter
 from donkeycar.parts.controller import LocalWebController, JoystickController
 from donkeycar.parts.clock import Timestamp
 
+import framecache
+
 import numpy as np
 import glob
 import json
 from PIL import Image
 
+# Tub storage is shared with the recorder in ai-control
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ai-control'))
+import tubfile
+import history
+import augment
+import dataset
+import instrument
+import loader
+import preprocess
+import sessions
+
 def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
     """
     Construct a working robotic vehicle from many parts.
@@ -134,75 +154,63 @@ def drive(cfg, model_path=None, use_joystick=False, use_chaos=False):
     V.start(rate_hz=cfg.DRIVE_LOOP_HZ,
             max_loop_count=cfg.MAX_LOOPS)
 
-def load_image(path):
-    img = Image.open(path)
-    return np.array(img)
-
-def get_generator(input_keys, output_keys, record_paths, meta, tub_path):
-    while True:
-        for record_path in record_paths:
-            with open(record_path, 'r') as record_file:
-                record = json.load(record_file)
-                inputs = [record[key] for key in input_keys]
-                outputs = [record[key] for key in output_keys]
-                input_types = [meta[key] for key in input_keys]
-                # output_types = [meta[key] for key in output_keys]
-                for i in range(len(inputs)):
-                    type = input_types[i]
-                    if (type == 'image_array'):
-                        inputs[i] = load_image("%s/%s" % (tub_path, inputs[i]))
-                    elif (type == 'custom/prev_image'):
-                        # Currently previous images are in array, but there is only one
-                        imagePath = inputs[i][0]
-                        inputs[i] = load_image("%s/%s" % (tub_path, imagePath))
-                yield inputs, outputs
-
-def get_batch_generator(input_keys, output_keys, records, meta, tub_path):
+def get_batch_generator(data, split, use_cache=True):
     # Yield here a tuple (inputs, outputs)
     # both having arrays with batch_size length like:
     # 0: [input_1[batch_size],input_2[batch_size]]
     # 1: [output_1[batch_size],output_2[batch_size]]
-    record_gen = get_generator(input_keys, output_keys, records, meta, tub_path)
-    while True:
-        raw_batch = [next(record_gen) for _ in range(cfg.BATCH_SIZE)]
-        inputs = [[] for _ in range(len(input_keys))]
-        outputs = [[] for _ in range(len(output_keys))]
-        for rec in raw_batch:
-            for i in range(len(input_keys)):
-                inputs[i].append(rec[0][i])
-            for i in range(len(output_keys)):
-                outputs[i].append(rec[1][i])
-        numpyInputs = [np.asarray(ar) for ar in inputs]
-        numpyOutputs = [np.asarray(ar) for ar in outputs]
-        yield numpyInputs, numpyOutputs
-
-def get_meta(path):
-    with open('%s/meta.json' % path, 'r') as f:
-        meta = json.load(f)
-        meta_dict = {}
-        for i, key in enumerate(meta['inputs']):
-            meta_dict[key] = meta['types'][i]
-        return meta_dict
-            # TODO: filter out values not listed in inputs or outputs
-
-
-def get_train_val_gen(inputs, outputs, tub_names):
+    batch_loader = loader.BatchLoader(data, split, cfg.BATCH_SIZE, workers=cfg.LOADER_WORKERS,
+                                      prefetch=cfg.LOADER_PREFETCH, cache_path=cfg.CACHE_PATH if use_cache else None,
+                                      cache_bytes=cfg.CACHE_MEMORY_MB << 20)
+    return loader.batches(batch_loader, cfg.LOADER_REPORT_EVERY)
+
+def get_train_val_gen(inputs, outputs, tub_names, use_cache=True, laps_query=None):
     print('Loading data', tub_names)
     print('Inputs', inputs)
     print('Outputs', outputs)
-    tubs = glob.glob('%s' % tub_names)
+    tubs = dataset.expand_tubs(tub_names)
+    laps = None
+    if laps_query:
+        laps = sessions.select(sessions.find_laps(tubs), **sessions.parse_query(laps_query))
+        print('Selected %d laps by %s' % (len(laps), laps_query))
+        lap_tubs = set(lap['path'] for lap in laps)
+        tubs = [tub for tub in tubs if os.path.normpath(tub) in lap_tubs]
     for tub in tubs:
         print(tub)
-        meta = get_meta(tub)
-        print(meta)
-        # TODO: Check if meta.json specs match with given inputs and outputs
-        record_files = glob.glob('%s/record*.json' % tub)
-        np.random.shuffle(record_files)
-        split = int(round(len(record_files) * cfg.TRAIN_TEST_SPLIT))
-        train_files, validation_files = record_files[:split], record_files[split:]
-    return get_batch_generator(inputs, outputs, train_files, meta, tub), get_batch_generator(inputs, outputs, validation_files, meta, tub), len(record_files)
-
-def train(cfg, tub_names, new_model_path, base_model_path=None):
+    data = dataset.Dataset(tubs, inputs, outputs, cfg.TRAIN_TEST_SPLIT, cfg.DATASET_SEED, cfg.IMAGE_HISTORY_WINDOW,
+                           cfg.SENSOR_HISTORY_WINDOW, model_stage(cfg), cfg.TRIM_RECORDINGS, cfg.LABEL_LEAD_SEC,
+                           cfg.LABEL_MODE, laps)
+    print(data.summary())
+    print('Recorded with', data.record_stage, 'model input', data.stage)
+    augmenter = augment.Augmenter(inputs, outputs, data.meta, flip=cfg.AUGMENT_FLIP, brightness=cfg.AUGMENT_BRIGHTNESS,
+                                  shift=cfg.AUGMENT_SHIFT, seed=cfg.AUGMENT_SEED)
+    train_gen = augment.augmented(get_batch_generator(data, dataset.TRAIN, use_cache), augmenter, cfg.AUGMENT_WORKERS)
+    # Time spent between batches is the model's training step
+    train_gen = loader.timed(train_gen, 'train/step')
+    val_gen = loader.timed(get_batch_generator(data, dataset.VALIDATION, use_cache), 'train/validate')
+    return train_gen, val_gen, data
+
+def model_stage(cfg):
+    return preprocess.Preprocess(cfg.PREPROCESS_CROP, cfg.PREPROCESS_SIZE, cfg.PREPROCESS_COLOR,
+                                 cfg.PREPROCESS_NORMALIZE)
+
+def warm_cache(cfg, tub_names):
+    """
+    Decode the frames of the given tubs into the frame cache ahead of training
+    """
+    if not tub_names:
+        tub_names = os.path.join(cfg.DATA_PATH, '*')
+    for tub in dataset.expand_tubs(tub_names):
+        if tubfile.is_tubfile(tub):
+            # Tubfile frames are stored decoded already
+            print('Skipping tubfile', tub)
+            continue
+        index = history.load_index(tub, cfg.IMAGE_HISTORY_WINDOW, cfg.SENSOR_HISTORY_WINDOW)
+        cache = framecache.FrameCache(tub, np.unique(index.frames), history.IMAGE_NAME, loader.load_image,
+                                      cfg.CACHE_PATH, cfg.CACHE_MEMORY_MB << 20)
+        print('Cached', cache.warm(), 'new frames of', tub)
+
+def train(cfg, tub_names, new_model_path, base_model_path=None, use_cache=True, profile=None, laps_query=None):
     """
     use the specified data in tub_names to train an artifical neural network
     saves the output trained model as model_name
@@ -222,11 +230,9 @@ def train(cfg, tub_names, new_model_path, base_model_path=None):
     print('tub_names', tub_names)
     if not tub_names:
         tub_names = os.path.join(cfg.DATA_PATH, '*')
-    else:
-        print('No support for custom tubs yet')
-        exit(0)
 
-    train_gen, val_gen, total_train = get_train_val_gen(inputs, outputs, tub_names)
+    train_gen, val_gen, data = get_train_val_gen(inputs, outputs, tub_names, use_cache, laps_query)
+    total_train = data.count(dataset.TRAIN)
 
     #tubgroup = TubGroup(tub_names)
     # orig_train_gen, orig_val_gen = tubgroup.get_train_val_gen(inputs, outputs,
@@ -244,11 +250,20 @@ def train(cfg, tub_names, new_model_path, base_model_path=None):
 
     steps_per_epoch = total_train // cfg.BATCH_SIZE
 
-    kl.train(train_gen,
-             val_gen,
-             saved_model_path=new_model_path,
-             steps=steps_per_epoch,
-             train_split=cfg.TRAIN_TEST_SPLIT)
+    if profile:
+        print('Profiling stages to', instrument.configure(profile, 'train'))
+    try:
+        kl.train(train_gen,
+                 val_gen,
+                 saved_model_path=new_model_path,
+                 steps=steps_per_epoch,
+                 train_split=cfg.TRAIN_TEST_SPLIT)
+    finally:
+        if profile:
+            print(instrument.report())
+            instrument.close()
+    # Drive rebuilds the preprocessing and history windows from this
+    preprocess.save_model_meta(new_model_path, data.model_meta())
 
 
 if __name__ == '__main__':
@@ -263,4 +278,7 @@ if __name__ == '__main__':
         new_model_path = args['--model']
         base_model_path = args['--base_model']
         cache = not args['--no_cache']
-        train(cfg, tub, new_model_path, base_model_path)
+        train(cfg, tub, new_model_path, base_model_path, cache, args['--profile'], args['--laps'])
+
+    elif args['cache']:
+        warm_cache(cfg, args['--tub'])
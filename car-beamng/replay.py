@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Replays recorded tubs through joystick.drive() with a model, to measure inference throughput and
+latency and how close the model's commands come to the recorded controls, without the game.
+
+ReplayCapture stands in for the screen capture and shows the tub's frames, ReplayJoystick stands in
+for vJoy and keeps every command with the record that was on screen when it arrived. By default the
+replay runs in lockstep: every frame is inferred once, as fast as the model goes, so the commands
+only depend on the frames and the model and runs can be compared exactly (predictions_crc). In
+real time every frame is shown at the time it was recorded and the threaded drive loop picks frames
+like a live drive would. The drive loop reads no telemetry, the recorded controls come from the
+tub's manifest. Tubs and models are replayed in every combination, each replay in a process of its
+own when running several in parallel.
+
+Usage:
+    replay.py <tub>... --model=<model>... [--realtime] [--limit=<n>] [--workers=<n>] [--out=<path>] [--predictions=<dir>]
+
+Options:
+    --model=<model>      Model to replay, repeat it to compare models
+    --realtime           Show frames at their recorded times and run the threaded drive loop
+    --limit=<n>          Replay at most this many records of each tub
+    --workers=<n>        Replays running in parallel [default: 1]
+    --out=<path>         Write the results as JSON
+    --predictions=<dir>  Save the commands and recorded controls of every replay as .npz
+"""
+import json
+import multiprocessing
+import os
+import sys
+import zlib
+from time import monotonic
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'ai-control'))
+import capture
+import manifest
+import preprocess
+import streams
+import tubfile
+
+import dataset
+import engine
+import loader
+
+RECORD_RATE_HZ = 20  # record.py's default, for tubs recorded without frame times
+
+
+class ReplayCapture:
+    """
+    Stands in for capture.NativeCapture, grab() returns the RGB frames of a tub. stages are the
+    model's preprocessing stages, the first one must be the stage the tub was recorded with, the
+    rest are applied by convert(). In lockstep every grab() shows the next record, in real time the
+    record recorded at the time since the first grab(). Raises capture.CaptureFinished at the end.
+    """
+    def __init__(self, tub_path, stages, realtime=False, limit=None):
+        self.tub_path = tub_path
+        self.stages = stages
+        self.realtime = realtime
+        self.limit = limit
+        self.frames = 0
+        self.timeouts = 0
+        self.position = -1  # Record on screen
+        self.previous = None
+        self.started = None
+        self._frame_id = None
+
+    def init(self):
+        recorded = preprocess.tub_stage(dataset.read_tub_meta(self.tub_path))
+        if self.stages[0] != recorded:
+            raise ValueError('The model takes frames recorded with %r, %s was recorded with %r' % (
+                self.stages[0], self.tub_path, recorded))
+        self.records = manifest.load(self.tub_path)[:self.limit]
+        if not len(self.records):
+            raise ValueError('Tub %s has no records' % self.tub_path)
+        self.reader = tubfile.Reader(self.tub_path) if tubfile.is_tubfile(self.tub_path) else None
+        frame = self._load(0)
+        self.height, self.width = frame.shape[:2]
+        self.convert = preprocess.compile(frame.shape, self.stages[1:])
+        self.shape = self.convert.shape
+        self.dtype = self.convert.dtype
+        self.times = self._times()
+        self.end = self.times[-1] + 1.0 / RECORD_RATE_HZ
+        return self
+
+    def _times(self):
+        """Seconds from the first record to every record"""
+        if streams.FRAME_TIME_KEY in self.records.dtype.names:
+            times = self.records[streams.FRAME_TIME_KEY].astype(np.float64)
+            if np.all(np.isfinite(times)):
+                return times - times[0]
+        ids = self.records[manifest.ID_FIELD]
+        return (ids - ids[0]) / float(RECORD_RATE_HZ)
+
+    def _load(self, position):
+        frame_id = self.records[manifest.FRAME_FIELD][position]
+        if frame_id != self._frame_id:
+            self.previous = loader.load_frame(self.tub_path, frame_id, self.reader)
+            self._frame_id = frame_id
+        return self.previous
+
+    def grab(self):
+        if self.realtime:
+            now = monotonic()
+            if self.started is None:
+                self.started = now
+            if now - self.started >= self.end:
+                raise capture.CaptureFinished()
+            position = int(np.searchsorted(self.times, now - self.started, side='right')) - 1
+        else:
+            position = self.position + 1
+            if position >= len(self.records):
+                raise capture.CaptureFinished()
+        if position == self.position:
+            self.timeouts += 1
+            return self.previous
+        frame = self._load(position)
+        self.position = position
+        self.frames += 1
+        return frame
+
+    def grab_rgb(self, out=None):
+        return self.convert(self.grab(), out)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+
+
+class ReplayJoystick(engine.StubJoystick):
+    """Keeps every (record on screen, angle, throttle, monotonic time) command, set capture before driving"""
+    def __init__(self):
+        super().__init__()
+        self.capture = None
+        self.commands = []
+
+    def set_steering(self, value):
+        # The actuator sets the throttle first, the steering completes a command
+        super().set_steering(value)
+        self.commands.append((self.capture.position, value, self.throttle, monotonic()))
+
+
+def compare(records, commands):
+    """Command counts and rates, and errors against the controls recorded with the records on screen"""
+    result = {'commands': len(commands)}
+    if not len(commands):
+        return result
+    positions = commands[:, 0].astype(np.int64)
+    angle = commands[:, 1]
+    throttle = commands[:, 2]
+    recorded_angle = records['user/angle'][positions].astype(np.float64)
+    recorded_throttle = records['user/throttle'][positions].astype(np.float64)
+    elapsed = commands[-1, 3] - commands[0, 3]
+    result.update({
+        'commands_per_sec': (len(commands) - 1) / elapsed if elapsed > 0 else 0.0,
+        'angle_mae': float(np.mean(np.abs(angle - recorded_angle))),
+        'angle_rmse': float(np.sqrt(np.mean((angle - recorded_angle) ** 2))),
+        'throttle_mae': float(np.mean(np.abs(throttle - recorded_throttle))),
+        # Equal in two runs when they sent the same commands for the same records
+        'predictions_crc': zlib.crc32(commands[:, :3].astype(np.float32).tobytes()),
+    })
+    return result
+
+def replay(tub_path, model_path, realtime=False, limit=None, predictions=None):
+    """Drive a model on a tub's frames and return the statistics of the run"""
+    import donkeycar as dk
+    import joystick  # Imports Keras, only the processes that replay need it
+    cfg = dk.load_config()
+    vjoy = ReplayJoystick()
+
+    def open_capture(stages):
+        vjoy.capture = ReplayCapture(tub_path, stages, realtime, limit).init()
+        return vjoy.capture
+
+    stage = preprocess.Preprocess(cfg.PREPROCESS_CROP, cfg.PREPROCESS_SIZE, cfg.PREPROCESS_COLOR,
+                                  cfg.PREPROCESS_NORMALIZE)
+    drive_engine = joystick.drive(model_path, cfg.DRIVE_LOOP_HZ, cfg.DRIVE_CAPTURE_HZ, stage, cfg.IMAGE_HISTORY_WINDOW,
+                                  cfg.SENSOR_HISTORY_WINDOW, open_capture=open_capture, vjoy=vjoy,
+                                  lockstep=not realtime)
+    records = vjoy.capture.records
+    commands = np.array(vjoy.commands, np.float64).reshape(-1, 4)
+    result = {'tub': tub_path, 'model': model_path, 'mode': 'realtime' if realtime else 'lockstep',
+              'records': len(records), 'frames_shown': vjoy.capture.frames}
+    result.update(compare(records, commands))
+    latency = drive_engine.latency.stats()
+    for name in ('inference', 'total'):
+        if name in latency:
+            result['%s_p50_ms' % name] = latency[name]['p50']
+            result['%s_p99_ms' % name] = latency[name]['p99']
+    if predictions:
+        os.makedirs(predictions, exist_ok=True)
+        name = '%s_%s.npz' % tuple(os.path.basename(os.path.normpath(path)) for path in (model_path, tub_path))
+        positions = commands[:, 0].astype(np.int64)
+        np.savez(os.path.join(predictions, name), ids=records[manifest.ID_FIELD][positions], angle=commands[:, 1],
+                 throttle=commands[:, 2], recorded_angle=records['user/angle'][positions],
+                 recorded_throttle=records['user/throttle'][positions])
+    return result
+
+def _replay_job(job):
+    return replay(*job)
+
+def run(jobs, workers=1):
+    """Results of replay(*job) for every job, workers processes at a time"""
+    if workers <= 1:
+        return [replay(*job) for job in jobs]
+    # Fresh processes, each loads its own model and Keras session
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(workers, maxtasksperchild=1)
+    try:
+        return pool.map(_replay_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    tubs = dataset.expand_tubs(','.join(args['<tub>']))
+    limit = int(args['--limit']) if args['--limit'] else None
+    jobs = [(tub, model, args['--realtime'], limit, args['--predictions']) for model in args['--model'] for tub in tubs]
+    results = run(jobs, int(args['--workers']))
+    for result in results:
+        print('%s on %s: %d commands, %.1f/s, inference p50 %.1f ms, angle MAE %.3f, throttle MAE %.3f, crc %08x' % (
+            result['model'], result['tub'], result['commands'], result.get('commands_per_sec', 0),
+            result.get('inference_p50_ms', 0), result.get('angle_mae', 0), result.get('throttle_mae', 0),
+            result.get('predictions_crc', 0)))
+    if args['--out']:
+        with open(args['--out'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
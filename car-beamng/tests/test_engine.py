@@ -0,0 +1,74 @@
+import os
+import sys
+import types
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'ai-control'))
+import capture
+import engine
+import preprocess
+
+
+class FakeScreenShot:
+    def __init__(self, width, height, value):
+        self.raw = bytearray(np.full((height, width, 4), value, np.uint8).tobytes())
+
+
+class FakeMss:
+    """Stands in for mss.mss(), a 1920x1080 monitor whose pixels count the grabs"""
+    monitors = [{}, {'left': 0, 'top': 0, 'width': 1920, 'height': 1080}]
+
+    def __init__(self):
+        self.grabs = []
+
+    def grab(self, bbox):
+        self.grabs.append(dict(bbox))
+        return FakeScreenShot(bbox['width'], bbox['height'], len(self.grabs) % 256)
+
+    def close(self):
+        pass
+
+
+def fake_mss(monkeypatch):
+    module = types.ModuleType('mss')
+    module.mss = FakeMss
+    monkeypatch.setitem(sys.modules, 'mss', module)
+
+
+def test_mss_capture_grabs_the_region(monkeypatch):
+    fake_mss(monkeypatch)
+    stage = preprocess.Preprocess(size=(240, 168), region=(0, 72, 1280, 720))
+    session = capture.MssCapture([stage, preprocess.Preprocess(size=(160, 120))]).init()
+    frame = session.grab()
+    assert frame.shape == (720, 1280, 4)
+    assert session.sct.grabs == [{'left': 0, 'top': 72, 'width': 1280, 'height': 720}]
+    assert session.convert(frame).shape == session.shape == (120, 160, 3)
+    session.close()
+
+
+def test_open_session_falls_back_to_mss(monkeypatch):
+    fake_mss(monkeypatch)
+    monkeypatch.setenv('MSC_LIBRARY', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'missing.so'))
+    session = capture.open_session([preprocess.Preprocess(size=(240, 168))])
+    assert isinstance(session, capture.MssCapture)
+    assert (session.width, session.height) == (1920, 1080)
+
+
+def test_drive_engine_on_mss_capture(monkeypatch):
+    fake_mss(monkeypatch)
+    session = capture.MssCapture([preprocess.Preprocess(size=(240, 168), region=(0, 72, 1280, 720))]).init()
+    seen = []
+
+    def pilot(image, prev_image, angle_history, throttle_history):
+        seen.append(image.shape)
+        return 0.25, 0.5
+
+    joystick = engine.StubJoystick()
+    drive_engine = engine.DriveEngine(pilot, session, joystick, rate_hz=100, capture_hz=200, report_every=float('inf'))
+    drive_engine.run(max_loops=20)
+    session.close()
+    assert session.frames > 0
+    assert seen and all(shape == (168, 240, 3) for shape in seen)
+    assert joystick.steering == 0.25 and joystick.throttle == 0.5
@@ -0,0 +1,81 @@
+// fake_msc.c: stand-in for msc_x64.dll on Linux, exports the same C API and renders synthetic frames
+//
+// Build with: cc -O2 -shared -fPIC -o libmsc_fake.so fake_msc.c
+//
+// Environment variables:
+//   FAKE_MSC_WIDTH, FAKE_MSC_HEIGHT   capture size, defaults to 1920x1080
+//   FAKE_MSC_TIMEOUT_EVERY            every n-th capture_frame() returns DXGI_ERROR_WAIT_TIMEOUT, 0 to disable
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define DXGI_ERROR_WAIT_TIMEOUT ((int)0x887A0027)
+
+static int initialized = 0;
+static int width = 1920;
+static int height = 1080;
+static int timeout_every = 0;
+static unsigned int frame = 0;
+static const char* last_error = "";
+
+static int env_int(const char* name, int fallback) {
+    const char* value = getenv(name);
+    return value != NULL ? atoi(value) : fallback;
+}
+
+int init(unsigned int output_skip) {
+    (void)output_skip;
+    width = env_int("FAKE_MSC_WIDTH", 1920);
+    height = env_int("FAKE_MSC_HEIGHT", 1080);
+    timeout_every = env_int("FAKE_MSC_TIMEOUT_EVERY", 0);
+    frame = 0;
+    initialized = 1;
+    last_error = "";
+    return 0;
+}
+
+int get_capture_width() {
+    return initialized ? width : -1;
+}
+
+int get_capture_height() {
+    return initialized ? height : -1;
+}
+
+int get_bytes_per_pixel() {
+    return initialized ? 4 : -1;
+}
+
+void close() {
+    initialized = 0;
+}
+
+const char* get_last_error() {
+    return last_error;
+}
+
+// Fills the buffer with a BGRX gradient that scrolls one pixel per frame, so every frame differs
+int capture_frame(uint8_t* buffer) {
+    if (!initialized) {
+        last_error = "init() not called";
+        return -1;
+    }
+
+    frame++;
+    if (timeout_every > 0 && frame % timeout_every == 0) {
+        last_error = "IDXGIOutputDuplication::AcquireNextFrame() failed with  0x887a0027";
+        return DXGI_ERROR_WAIT_TIMEOUT;
+    }
+
+    for (int row = 0; row < height; row++) {
+        uint32_t* dest = (uint32_t*)(buffer + (size_t)row * width * 4);
+        uint8_t g = (uint8_t)(row * 255 / height);
+        for (int col = 0; col < width; col++) {
+            uint8_t b = (uint8_t)(col + frame);
+            uint8_t r = (uint8_t)(frame * 3);
+            dest[col] = (uint32_t)b | ((uint32_t)g << 8) | ((uint32_t)r << 16);
+        }
+    }
+    return 0;
+}